@@ -1,108 +1,133 @@
-from allensdk.brain_observatory.ecephys.align_timestamps.__main__ import align_timestamps
-import np_session
 import pathlib
 import re
-from np_probes.utils import get_probe_metrics_path
+from np_probes.session_index import get_session_index, get_probe_path, is_weird_session
+from np_probes.profiling import profiled
+from np_probes.staging import stage_file
+from np_probes.sync import get_sync_line_edges, get_sync_edges_path
 import numpy as np
+import np_logging
+import json
+import os
+import concurrent.futures
+import tempfile
+from typing import TYPE_CHECKING, Union, Optional
 
-def apply_sample_number_adjustment(event_path:pathlib.Path, probe:str, spike_path:pathlib.Path) -> None:
-    sample_numbers_data_path  = list(spike_path.glob('sample_numbers.npy'.format(probe)))[0].as_posix()
-    sample_numbers_data = np.load(sample_numbers_data_path)
+if TYPE_CHECKING:
+    import np_session
 
-    sample_number_path = list(event_path.glob('*{}-AP/*/sample_numbers.npy'.format(probe)))[0].as_posix()
-    sample_numbers = np.load(sample_number_path)
+logger = np_logging.getLogger(__name__)
 
-    sample_numbers_adjusted = sample_numbers - sample_numbers_data[0]
-    np.save(pathlib.Path(pathlib.Path(sample_number_path).parent, 'sample_numbers_adjusted.npy'), sample_numbers_adjusted)
+ALIGN_TIMESTAMPS_OUTPUT_FILENAME = 'align_timestamps_output.json'
+ALIGN_BLOCK_SIZE = 10_000_000
 
-def apply_lfp_sample_number_adjustment(lfp_path:pathlib.Path, probe:str):
-    sample_number_path = list(lfp_path.glob('*{}-LFP/sample_numbers.npy'.format(probe)))[0].as_posix()
-    lfp_samples = np.load(pathlib.Path(sample_number_path))
-    lfp_samples=lfp_samples-np.min(lfp_samples)
-    lfp_samples=lfp_samples*12
+def get_min_sample_number(sample_numbers:np.ndarray, block_size:int=ALIGN_BLOCK_SIZE):
+    return min(sample_numbers[start:start + block_size].min() for start in range(0, len(sample_numbers), block_size))
 
-    np.save(pathlib.Path(pathlib.Path(sample_number_path).parent, 'sample_numbers_adjusted.npy'), lfp_samples)
+def is_adjusted_sample_numbers_current(input_paths:list[pathlib.Path], output_path:pathlib.Path, sample_numbers:np.ndarray) -> bool:
+    """Whether `output_path` is newer than all of `input_paths` and has the expected shape and dtype."""
+    if not output_path.exists() or output_path.stat().st_mtime < max(path.stat().st_mtime for path in input_paths):
+        return False
+    try:
+        adjusted = np.load(output_path, mmap_mode='r')
+    except ValueError:
+        return False
 
-def get_align_timestamps_input_dictionary_weird(session:np_session.Session) -> dict:
-    probe_metrics_path = get_probe_metrics_path(session)
+    return adjusted.shape == sample_numbers.shape and adjusted.dtype == sample_numbers.dtype
 
-    align_timestamps_input_dictionary: dict = {'probes': []}
-    if not pathlib.Path(session.npexp_path, 'SDK_outputs').exists():
-        pathlib.Path(session.npexp_path, 'SDK_outputs').mkdir()
-
-    for probe in probe_metrics_path:
-        spike_path = probe_metrics_path[probe].parent
-        event_path = spike_path.parent.parent / 'events'
-        lfp_path = spike_path.parent
-        apply_sample_number_adjustment(event_path, probe, spike_path)
-        apply_lfp_sample_number_adjustment(lfp_path, probe)
-        probe_dict = {
-            "name": 'probe{}'.format(probe),
-            "sampling_rate": 30000.0,
-            "lfp_sampling_rate": 2500.0,
-            "barcode_channel_states_path": list(event_path.glob('*{}-AP/*/states.npy'.format(probe)))[0].as_posix(),
-            "barcode_timestamps_path": list(event_path.glob('*{}-AP/*/sample_numbers_adjusted.npy'.format(probe)))[0].as_posix(),
-            "mappable_timestamp_files": [
-                {
-                    "name": "spike_timestamps",
-                    "input_path": pathlib.Path(spike_path, 'spike_times.npy').as_posix(),
-                    "output_path": pathlib.Path(session.npexp_path, 'SDK_outputs', 'spike_times_{}_aligned.npy'.format(probe)).as_posix()
-                },
-                {
-                    "name": "lfp_timestamps",
-                    "input_path": list(lfp_path.glob('*{}-LFP/sample_numbers_adjusted.npy'.format(probe)))[0].as_posix(),
-                    "output_path": pathlib.Path(session.npexp_path, 'SDK_outputs', 'lfp_times_{}_aligned.npy'.format(probe)).as_posix()
-                }
-            ],
-            'start_index': 0
-        }
+def write_adjusted_sample_numbers(sample_numbers:np.ndarray, output_path:pathlib.Path, offset, scale:int=1, 
+                                  block_size:int=ALIGN_BLOCK_SIZE) -> None:
+    """Write `(sample_numbers - offset) * scale` in blocks through a memmap."""
+    adjusted = np.lib.format.open_memmap(output_path, mode='w+', dtype=sample_numbers.dtype, shape=sample_numbers.shape)
+    for start in range(0, len(sample_numbers), block_size):
+        block = np.array(sample_numbers[start:start + block_size])
+        block -= offset
+        block *= scale
+        adjusted[start:start + block_size] = block
 
-        align_timestamps_input_dictionary['probes'].append(probe_dict)
-    
-    sync_file = list(session.npexp_path.glob('*.h5'))[0].as_posix()
-    align_timestamps_input_dictionary['sync_h5_path'] = sync_file
+    adjusted.flush()
+    del adjusted
 
-    return align_timestamps_input_dictionary
+def apply_sample_number_adjustment(sample_number_path:pathlib.Path, sample_numbers_data_path:pathlib.Path, lazy:bool=False) -> dict:
+    """
+    Offset the AP event sample numbers by the first sample number of the spike
+    data, writing `sample_numbers_adjusted.npy` unless it is already up to date.
 
-def get_align_timestamps_input_dictionary(session:np_session.Session) -> dict:
-    probe_metrics_path = get_probe_metrics_path(session)
-    
+    Returns the path of the sample numbers to use with the offset and scale still
+    to be applied to them: the raw sample numbers if `lazy`, otherwise the adjusted file.
+    """
+    adjusted_path = pathlib.Path(sample_number_path.parent, 'sample_numbers_adjusted.npy')
+
+    offset = np.load(stage_file(sample_numbers_data_path), mmap_mode='r')[0]
+    if lazy:
+        return {'path': stage_file(sample_number_path).as_posix(), 'offset': offset.item(), 'scale': 1}
+
+    sample_numbers = np.load(stage_file(sample_number_path), mmap_mode='r')
+    if not is_adjusted_sample_numbers_current([sample_number_path, sample_numbers_data_path], adjusted_path, sample_numbers):
+        write_adjusted_sample_numbers(sample_numbers, adjusted_path, offset)
+
+    return {'path': adjusted_path.as_posix(), 'offset': 0, 'scale': 1}
+
+def apply_lfp_sample_number_adjustment(sample_number_path:pathlib.Path, lazy:bool=False) -> dict:
+    """
+    Convert LFP sample numbers to AP samples since the start of the LFP
+    (`(samples - min) * 12`), as for `apply_sample_number_adjustment`.
+    """
+    adjusted_path = pathlib.Path(sample_number_path.parent, 'sample_numbers_adjusted.npy')
+
+    lfp_samples = np.load(stage_file(sample_number_path), mmap_mode='r')
+    if lazy:
+        return {'path': stage_file(sample_number_path).as_posix(), 'offset': get_min_sample_number(lfp_samples).item(), 'scale': 12}
+
+    if not is_adjusted_sample_numbers_current([sample_number_path], adjusted_path, lfp_samples):
+        write_adjusted_sample_numbers(lfp_samples, adjusted_path, get_min_sample_number(lfp_samples), 12)
+
+    return {'path': adjusted_path.as_posix(), 'offset': 0, 'scale': 1}
+
+def get_sample_number_adjustment_fields(adjustment:dict, prefix:str='sample_number') -> dict:
+    """Input dictionary fields for a lazy adjustment, read by `align_timestamps_numpy`."""
+    if adjustment['offset'] == 0 and adjustment['scale'] == 1:
+        return {}
+
+    return {f'{prefix}_offset': adjustment['offset'], f'{prefix}_scale': adjustment['scale']}
+
+def get_align_timestamps_input_dictionary(session:'np_session.Session', lazy_sample_numbers:bool=False) -> dict:
+    """
+    With `lazy_sample_numbers`, sample number adjustments are recorded as offset
+    and scale fields instead of being written to `sample_numbers_adjusted.npy`;
+    only `align_timestamps_numpy` applies them.
+    """
+    session_index = get_session_index(session)
     align_timestamps_input_dictionary: dict = {'probes': []}
-    if not pathlib.Path(session.npexp_path, 'SDK_outputs').exists():
-        pathlib.Path(session.npexp_path, 'SDK_outputs').mkdir()
-
-    for probe in probe_metrics_path:
-        if '626791' in str(session.id):
-            return get_align_timestamps_input_dictionary_weird(session)
-        
-        if 'Data2' in str(session.npexp_path):
-            npexp_path = session.storage_dirs[1] / session.id
+
+    for probe in session_index['probes']:
+        lfp_adjustment = apply_lfp_sample_number_adjustment(get_probe_path(session, probe, 'lfp_sample_numbers_path'), 
+                                                            lazy=lazy_sample_numbers)
+        if is_weird_session(session):
+            # barcodes are in the raw event sample numbers, offset to the start of the spike data
+            barcode_adjustment = apply_sample_number_adjustment(get_probe_path(session, probe, 'ap_sample_numbers_path'), 
+                                                                get_probe_path(session, probe, 'spike_sample_numbers_path'),
+                                                                lazy=lazy_sample_numbers)
         else:
-            npexp_path = session.npexp_path
-            
-        ap_path = list(session.datajoint_path.glob('*{}*/*/*100*/metrics.csv'.format(probe)))[0].parent
-        #spike_path = ap_path.parent
-        event_path = list(session.datajoint_path.glob('*{}*/*/*100*/metrics.csv'.format(probe)))[0].parent.parent.parent / 'events'
-        state_event_path = list(npexp_path.glob('*/*/*/*/continuous/*{}-AP'.format(probe)))[0].parent.parent / 'events'
-        lfp_path = list(npexp_path.glob('*/*/*/*/continuous/*{}-AP'.format(probe)))[0].parent
-        #apply_sample_number_adjustment(event_path, probe, probe_metrics_path[probe].parent)
-        apply_lfp_sample_number_adjustment(lfp_path, probe)
+            barcode_adjustment = {'path': get_probe_path(session, probe, 'event_timestamps_path', staged=True).as_posix(), 'offset': 0, 'scale': 1}
+
         probe_dict = {
             "name": 'probe{}'.format(probe),
             "sampling_rate": 30000.0,
             "lfp_sampling_rate": 2500.0,
-            "barcode_channel_states_path": list(state_event_path.glob('*{}-AP/*/states.npy'.format(probe)))[0].as_posix(),
-            "barcode_timestamps_path": list(event_path.glob('*/*/event_timestamps.npy'))[0].as_posix(),
+            "barcode_channel_states_path": get_probe_path(session, probe, 'states_path', staged=True).as_posix(),
+            "barcode_timestamps_path": barcode_adjustment['path'],
+            **get_sample_number_adjustment_fields(barcode_adjustment, 'barcode_timestamps'),
             "mappable_timestamp_files": [
                 {
                     "name": "spike_timestamps",
-                    "input_path": pathlib.Path(ap_path, 'spike_times.npy').as_posix(),
-                    "output_path": pathlib.Path(npexp_path, 'SDK_outputs', 'spike_times_{}_aligned.npy'.format(probe)).as_posix()
+                    "input_path": stage_file(pathlib.Path(get_probe_path(session, probe, 'ap_path'), 'spike_times.npy')).as_posix(),
+                    "output_path": pathlib.Path(session_index['sdk_outputs_path'], 'spike_times_{}_aligned.npy'.format(probe)).as_posix()
                 },
                 {
                     "name": "lfp_timestamps",
-                    "input_path": list(lfp_path.glob('*{}-LFP/sample_numbers_adjusted.npy'.format(probe)))[0].as_posix(),
-                    "output_path": pathlib.Path(npexp_path, 'SDK_outputs', 'lfp_times_{}_aligned.npy'.format(probe)).as_posix()
+                    "input_path": lfp_adjustment['path'],
+                    **get_sample_number_adjustment_fields(lfp_adjustment),
+                    "output_path": pathlib.Path(session_index['sdk_outputs_path'], 'lfp_times_{}_aligned.npy'.format(probe)).as_posix()
                 }
             ],
             'start_index': 0
@@ -110,16 +135,358 @@ def get_align_timestamps_input_dictionary(session:np_session.Session) -> dict:
 
         align_timestamps_input_dictionary['probes'].append(probe_dict)
     
-    sync_file = list(session.npexp_path.glob('*.h5'))[0].as_posix()
-    align_timestamps_input_dictionary['sync_h5_path'] = sync_file
+    align_timestamps_input_dictionary['sync_h5_path'] = stage_file(session_index['sync_path']).as_posix()
+    # only read by `align_timestamps_numpy`
+    align_timestamps_input_dictionary['sync_edges_path'] = get_sync_edges_path(session).as_posix()
 
     return align_timestamps_input_dictionary
 
-def get_align_timestamps_output_dictionary(session:np_session.Session) -> dict:
-    align_timestamps_input_dictionary = get_align_timestamps_input_dictionary(session)
+def extract_barcodes_from_times(on_times:np.ndarray, off_times:np.ndarray, inter_barcode_interval:float=10,
+                                bar_duration:float=0.03, barcode_duration_ceiling:float=2, 
+                                nbits:int=32) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized `allensdk...align_timestamps.barcode.extract_barcodes_from_times`.
+
+    As in AllenSDK, the first barcode is skipped. Barcodes with no falling edge
+    within `barcode_duration_ceiling` are dropped, with their start times.
+    """
+    on_times = np.asarray(on_times, dtype=np.float64)
+    off_times = np.asarray(off_times, dtype=np.float64)
+    barcode_start_times = on_times[np.where(np.diff(on_times) > inter_barcode_interval)[0] + 1]
+
+    first_off_index = np.searchsorted(off_times, barcode_start_times, side='right')
+    has_off = first_off_index < len(off_times)
+    has_off[has_off] = off_times[first_off_index[has_off]] < barcode_start_times[has_off] + barcode_duration_ceiling
+    starts = barcode_start_times[has_off]
+    ends = starts + barcode_duration_ceiling
+    no_edge = starts + inter_barcode_interval
+
+    # sample times of each bit (barcodes x bits), accumulated as AllenSDK does
+    steps = np.full((len(starts), nbits), bar_duration)
+    steps[:, 0] = off_times[first_off_index[has_off]]
+    bit_times = np.cumsum(steps, axis=1)
+
+    def next_edge(edge_times:np.ndarray) -> np.ndarray:
+        # first edge after each bit time, if it falls before the end of the barcode
+        index = np.searchsorted(edge_times, bit_times, side='right')
+        edges = np.append(edge_times, np.inf)[index]
+        return np.where(edges < ends[:, None], edges, no_edge[:, None])
+
+    bits = next_edge(on_times) < next_edge(off_times)
+    barcodes = bits.astype(np.float64) @ (2.0 ** np.arange(nbits))
+
+    return starts, barcodes
+
+def extract_barcodes_from_states(channel_states:np.ndarray, timestamps:np.ndarray, sampling_rate:float,
+                                 **barcode_kwargs) -> tuple[np.ndarray, np.ndarray]:
+    """Barcodes from OpenEphys event states (1 rising, -1 falling) and sample numbers."""
+    on_times = timestamps[channel_states == 1] / float(sampling_rate)
+    off_times = timestamps[channel_states == -1] / float(sampling_rate)
+    return extract_barcodes_from_times(on_times, off_times, **barcode_kwargs)
+
+def extract_split_times(channel_states:np.ndarray, timestamps:np.ndarray, sampling_rate:float, 
+                        barcode_times:np.ndarray, tolerance:float=0.0001) -> np.ndarray:
+    """
+    Times at which the probe recording may have dropped data: `0` events in
+    `channel_states`, and barcodes either side of irregular inter-barcode intervals.
+    """
+    state_split_times = timestamps[channel_states == 0] / float(sampling_rate)
+    if len(state_split_times) == 0:
+        state_split_times = np.array([0])
+
+    barcode_intervals = np.diff(barcode_times)
+    median_interval = np.median(barcode_intervals)
+    irregular = np.where(np.abs(barcode_intervals - median_interval) > tolerance * median_interval)[0]
+    barcode_split_times = np.concatenate([[0], barcode_times[irregular[irregular >= 1] - 1], barcode_times[irregular + 1]])
+
+    return np.union1d(state_split_times, barcode_split_times)
+
+def find_matching_indices(master_barcodes:np.ndarray, probe_barcodes:np.ndarray) -> tuple[Optional[int], Optional[int], Optional[int], Optional[int]]:
+    """
+    Indices (master start, probe start, master end, probe end) of the first and
+    last probe barcodes found on the master line, searched as AllenSDK does.
+    """
+    unique_barcodes, first_index, counts = np.unique(master_barcodes, return_index=True, return_counts=True)
+    if len(unique_barcodes) == 0:
+        return None, None, None, None
+
+    position = np.minimum(np.searchsorted(unique_barcodes, probe_barcodes), len(unique_barcodes) - 1)
+    matched = unique_barcodes[position] == probe_barcodes
+    if np.any(matched & (counts[position] > 1)):
+        raise ValueError('Barcode found more than once on the master line')
+
+    # AllenSDK never checks the first probe barcode when searching from the end
+    start_candidates = np.where(matched)[0]
+    end_candidates = np.where(matched[1:])[0] + 1
+    master_start = probe_start = master_end = probe_end = None
+    if len(start_candidates):
+        probe_start = int(start_candidates[0])
+        master_start = int(first_index[position[probe_start]])
+    if len(probe_barcodes) > 2 and len(end_candidates):
+        probe_end = int(end_candidates[-1])
+        master_end = int(first_index[position[probe_end]])
+
+    return master_start, probe_start, master_end, probe_end
+
+def get_probe_time_offset(master_times:np.ndarray, master_barcodes:np.ndarray, probe_times:np.ndarray, 
+                          probe_barcodes:np.ndarray, acq_start_index:int, local_probe_rate:float) -> tuple[float, float]:
+    """
+    Linear clock model (total time shift, sampling rate on the master clock) from
+    the first and last barcodes shared by the probe and master lines.
+    """
+    master_start, probe_start, master_end, probe_end = find_matching_indices(master_barcodes, probe_barcodes)
+    if master_start is None:
+        logger.warning('No matching barcodes: setting sampling rate to 0')
+        return 0.0, 0.0
+
+    scale = 1.0
+    if probe_end is not None:
+        scale = (probe_times[probe_end] - probe_times[probe_start]) / (master_times[master_end] - master_times[master_start])
+    translation = probe_times[probe_start] / scale - master_times[master_start]
+    probe_rate = local_probe_rate * scale
+
+    return translation - acq_start_index / probe_rate, probe_rate
+
+def get_probe_synchronizers(sync_times:np.ndarray, sync_barcodes:np.ndarray, probe_barcode_times:np.ndarray, 
+                            probe_barcodes:np.ndarray, split_times:np.ndarray, start_index:int, 
+                            sampling_rate:float) -> list[dict]:
+    """One clock model per segment of the recording between split times."""
+    synchronizers = []
+    for index, min_time in enumerate(split_times):
+        max_time = split_times[index + 1] if index + 1 < len(split_times) else np.inf
+        in_segment = np.where((probe_barcode_times > min_time) & (probe_barcode_times < max_time))[0]
+        if len(in_segment):
+            total_time_shift, global_rate = get_probe_time_offset(sync_times, sync_barcodes, probe_barcode_times[in_segment],
+                                                                  probe_barcodes[in_segment], start_index, sampling_rate)
+        else:
+            logger.warning('No barcodes between {} and {} s: setting sampling rate to 0'.format(min_time, max_time))
+            total_time_shift, global_rate = 0.0, 0.0
+        synchronizers.append({'total_time_shift': total_time_shift, 'global_probe_sampling_rate': global_rate,
+                              'local_probe_sampling_rate': sampling_rate, 'min_time': min_time, 'max_time': max_time})
+
+    return synchronizers
+
+def apply_synchronizers(samples:np.ndarray, synchronizers:list[dict]) -> np.ndarray:
+    """Map probe sample numbers to master clock times (s), in place, as `ProbeSynchronizer` does."""
+    for synchronizer in synchronizers:
+        local_times = samples / synchronizer['local_probe_sampling_rate']
+        in_range = (local_times >= synchronizer['min_time']) & (local_times < synchronizer['max_time'])
+        if synchronizer['global_probe_sampling_rate'] > 0:
+            samples[in_range] = samples[in_range] / synchronizer['global_probe_sampling_rate'] - synchronizer['total_time_shift']
+        else:
+            samples[in_range] = -1
+
+    return samples
+
+def write_aligned_timestamps(input_path:str, output_path:str, synchronizers:list[dict], offset=0, scale:int=1,
+                             block_size:int=ALIGN_BLOCK_SIZE) -> None:
+    """Align `(samples - offset) * scale` from `input_path` in blocks through memmaps."""
+    timestamps = np.load(input_path, mmap_mode='r')
+    aligned_timestamps = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float64, shape=timestamps.shape)
+    for start in range(0, len(timestamps), block_size):
+        samples = (np.array(timestamps[start:start + block_size]) - offset) * scale
+        aligned_timestamps[start:start + block_size] = apply_synchronizers(samples.astype(np.float64), synchronizers)
+
+    aligned_timestamps.flush()
+    del aligned_timestamps
+
+def get_sync_barcodes(sync_h5_path:Union[str, pathlib.Path], cache_path:Optional[Union[str, pathlib.Path]]=None, 
+                      **barcode_kwargs) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Barcode start times (s) and values from the barcode line of a sync `.h5` file,
+    with the line's edges cached in `cache_path` (see `sync.get_sync_line_edges`).
+    """
+    on_times, off_times = get_sync_line_edges(sync_h5_path, ['barcode'], cache_path)[0]['barcode']
+    return extract_barcodes_from_times(on_times, off_times, **barcode_kwargs)
+
+def align_timestamps_numpy(align_timestamps_input_dictionary:dict) -> dict:
+    """
+    Built-in equivalent of AllenSDK `align_timestamps`, with the same input and
+    output dictionaries. Timestamp files are aligned in blocks through memmaps.
+
+    Also applies lazy sample number adjustments (`barcode_timestamps_offset` and
+    `_scale` for probes, `sample_number_offset` and `_scale` for timestamp files),
+    and reads the sync barcode line from its cached edges (`sync_edges_path`).
+    """
+    sync_times, sync_barcodes = get_sync_barcodes(align_timestamps_input_dictionary['sync_h5_path'], 
+                                                  align_timestamps_input_dictionary.get('sync_edges_path'))
+    probe_output_info = []
+    for probe in align_timestamps_input_dictionary['probes']:
+        channel_states = np.load(probe['barcode_channel_states_path'])
+        timestamps = (np.load(probe['barcode_timestamps_path']) - probe.get('barcode_timestamps_offset', 0)) * probe.get('barcode_timestamps_scale', 1)
+        probe_barcode_times, probe_barcodes = extract_barcodes_from_states(channel_states, timestamps, probe['sampling_rate'])
+        split_times = extract_split_times(channel_states, timestamps, probe['sampling_rate'], probe_barcode_times)
+        synchronizers = get_probe_synchronizers(sync_times, sync_barcodes, probe_barcode_times, probe_barcodes,
+                                                split_times, probe['start_index'], probe['sampling_rate'])
+
+        mapped_files = {}
+        for timestamp_file in probe['mappable_timestamp_files']:
+            write_aligned_timestamps(timestamp_file['input_path'], timestamp_file['output_path'], synchronizers,
+                                     timestamp_file.get('sample_number_offset', 0), timestamp_file.get('sample_number_scale', 1))
+            mapped_files[timestamp_file['name']] = timestamp_file['output_path']
+
+        synchronizer = synchronizers[-1]
+        sampling_rate_scale = synchronizer['global_probe_sampling_rate'] / synchronizer['local_probe_sampling_rate']
+        probe_output_info.append({
+            'total_time_shift': np.array([synchronizer['total_time_shift']]),
+            'global_probe_sampling_rate': np.array([synchronizer['global_probe_sampling_rate']]),
+            'global_probe_lfp_sampling_rate': np.array([probe['lfp_sampling_rate'] * sampling_rate_scale]),
+            'output_paths': mapped_files,
+            'name': probe['name'],
+            'split_times': split_times
+        })
+
+    return {'probe_outputs': probe_output_info}
+
+def check_against_allensdk(align_timestamps_input_dictionary:dict, rtol:float=1e-9) -> None:
+    """
+    Run both alignment engines, writing to a temporary directory, and raise
+    `ValueError` if their outputs differ.
+    """
+    outputs = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for engine_name, engine in ALIGN_TIMESTAMPS_ENGINES.items():
+            input_dictionary = json.loads(json.dumps(align_timestamps_input_dictionary))
+            for probe in input_dictionary['probes']:
+                for timestamp_file in probe['mappable_timestamp_files']:
+                    timestamp_file['output_path'] = pathlib.Path(tmp_dir, '{}_{}_{}.npy'.format(
+                        engine_name, probe['name'], timestamp_file['name'])).as_posix()
+            outputs[engine_name] = engine(input_dictionary)['probe_outputs']
+
+        for allensdk_probe, numpy_probe in zip(outputs['allensdk'], outputs['numpy']):
+            for key in ('total_time_shift', 'global_probe_sampling_rate', 'global_probe_lfp_sampling_rate', 'split_times'):
+                if not np.allclose(np.ravel(allensdk_probe[key]), np.ravel(numpy_probe[key]), rtol=rtol, atol=0):
+                    raise ValueError(f"{allensdk_probe['name']} {key}: AllenSDK {allensdk_probe[key]} != {numpy_probe[key]}")
+            for name, path in allensdk_probe['output_paths'].items():
+                if not np.allclose(np.load(path, mmap_mode='r'), np.load(numpy_probe['output_paths'][name], mmap_mode='r'), 
+                                   rtol=rtol, atol=0):
+                    raise ValueError(f"{allensdk_probe['name']} {name}: aligned timestamps differ")
+
+def get_file_fingerprint(path:Union[str, pathlib.Path]) -> dict:
+    """Size and mtime of a file: its content isn't read, as inputs can be several GB."""
+    stat = pathlib.Path(path).stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def is_fingerprint_current(path:Union[str, pathlib.Path], fingerprint:dict) -> bool:
+    """Whether a file still has the size and mtime of a fingerprint from `get_file_fingerprint`."""
+    try:
+        return get_file_fingerprint(path) == fingerprint
+    except OSError:
+        return False
+
+def get_align_timestamps_input_paths(align_timestamps_input_dictionary:dict) -> list[str]:
+    input_paths = [align_timestamps_input_dictionary['sync_h5_path']]
+    for probe in align_timestamps_input_dictionary['probes']:
+        input_paths.append(probe['barcode_channel_states_path'])
+        input_paths.append(probe['barcode_timestamps_path'])
+        input_paths.extend(timestamp_file['input_path'] for timestamp_file in probe['mappable_timestamp_files'])
+
+    return input_paths
+
+def get_align_timestamps_output_paths(align_timestamps_input_dictionary:dict) -> list[str]:
+    return [timestamp_file['output_path'] for probe in align_timestamps_input_dictionary['probes']
+            for timestamp_file in probe['mappable_timestamp_files']]
+
+def to_json_compatible(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+def read_align_timestamps_cache(cache_path:pathlib.Path, align_timestamps_input_dictionary:dict, engine:str='allensdk') -> Optional[dict]:
+    """Cached output, if the engine, inputs and parameters are unchanged and all outputs exist."""
+    if not cache_path.exists():
+        return None
+    with open(cache_path, 'r') as f:
+        cache = json.load(f)
+
+    if cache.get('engine', 'allensdk') != engine:
+        return None
+    if cache.get('input_dictionary') != json.loads(json.dumps(align_timestamps_input_dictionary, default=to_json_compatible)):
+        return None
+    if not all(pathlib.Path(path).exists() for path in get_align_timestamps_output_paths(align_timestamps_input_dictionary)):
+        return None
+    if not all(is_fingerprint_current(path, cache['input_fingerprints'].get(path, {'size': -1}))
+               for path in get_align_timestamps_input_paths(align_timestamps_input_dictionary)):
+        return None
+
+    return cache['output']
+
+def write_align_timestamps_cache(cache_path:pathlib.Path, align_timestamps_input_dictionary:dict, 
+                                 input_fingerprints:dict, output_dictionary:dict, engine:str='allensdk') -> None:
+    cache = {
+        'engine': engine,
+        'input_dictionary': align_timestamps_input_dictionary,
+        'input_fingerprints': input_fingerprints,
+        'output': output_dictionary
+    }
+    tmp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=2, default=to_json_compatible)
+    os.replace(tmp_path, cache_path)
+
+def align_probe_timestamps(align_timestamps_input_dictionary:dict, processes:Optional[int]=None, engine:str='allensdk') -> dict:
+    """
+    Run an alignment engine (`allensdk` or `numpy`), with each probe aligned in its own
+    worker process if `processes` is more than 1 (or None, for one process per probe).
+    """
+    align = ALIGN_TIMESTAMPS_ENGINES[engine]
+    probes = align_timestamps_input_dictionary['probes']
+    if processes == 1 or len(probes) <= 1:
+        return align(align_timestamps_input_dictionary)
+
+    probe_input_dictionaries = [{**align_timestamps_input_dictionary, 'probes': [probe]} for probe in probes]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes or len(probes)) as executor:
+        probe_outputs = list(executor.map(align, probe_input_dictionaries))
+
+    return {'probe_outputs': [output for probe_output in probe_outputs for output in probe_output['probe_outputs']]}
+
+@profiled('alignment')
+def get_align_timestamps_output_dictionary(session:'np_session.Session', use_cache:bool=True, 
+                                           processes:Optional[int]=1, engine:str='allensdk', 
+                                           lazy_sample_numbers:bool=False) -> dict:
+    """
+    Align probe timestamps to the sync clock, reusing the result saved in
+    `SDK_outputs/align_timestamps_output.json` if none of the inputs (sync file,
+    barcode states and timestamps, spike and LFP timestamps) have changed.
+
+    `engine='numpy'` uses the built-in `align_timestamps_numpy` instead of AllenSDK,
+    and can apply the sample number adjustments on the fly (`lazy_sample_numbers`).
+    """
+    if lazy_sample_numbers and engine != 'numpy':
+        raise ValueError("lazy_sample_numbers requires engine='numpy'")
+
+    align_timestamps_input_dictionary = get_align_timestamps_input_dictionary(session, lazy_sample_numbers)
+    output_paths = get_align_timestamps_output_paths(align_timestamps_input_dictionary)
+    if not output_paths:
+        return ALIGN_TIMESTAMPS_ENGINES[engine](align_timestamps_input_dictionary)
+
+    cache_path = pathlib.Path(output_paths[0]).parent / ALIGN_TIMESTAMPS_OUTPUT_FILENAME
+    if use_cache:
+        output_dictionary = read_align_timestamps_cache(cache_path, align_timestamps_input_dictionary, engine)
+        if output_dictionary is not None:
+            logger.info(f'Using cached timestamp alignment from {cache_path}')
+            return output_dictionary
+
+    input_fingerprints = {path: get_file_fingerprint(path) for path in get_align_timestamps_input_paths(align_timestamps_input_dictionary)}
+    output_dictionary = align_probe_timestamps(align_timestamps_input_dictionary, processes=processes, engine=engine)
+    write_align_timestamps_cache(cache_path, align_timestamps_input_dictionary, input_fingerprints, output_dictionary, engine)
+
+    return json.loads(json.dumps(output_dictionary, default=to_json_compatible))
+
+def align_timestamps_allensdk(align_timestamps_input_dictionary:dict) -> dict:
+    """AllenSDK `align_timestamps`, imported when first run."""
+    from allensdk.brain_observatory.ecephys.align_timestamps.__main__ import align_timestamps
     return align_timestamps(align_timestamps_input_dictionary)
 
+ALIGN_TIMESTAMPS_ENGINES = {
+    'allensdk': align_timestamps_allensdk,
+    'numpy': align_timestamps_numpy,
+}
+
 if __name__ == '__main__':
+    import np_session
     session = np_session.Session('DRpilot_626791_20220817')
     input_dictionary = get_align_timestamps_input_dictionary(session)
-    output_dictionary = align_timestamps(input_dictionary)
\ No newline at end of file
+    output_dictionary = align_timestamps_allensdk(input_dictionary)
\ No newline at end of file
@@ -0,0 +1,262 @@
+import pathlib
+import json
+import os
+import sys
+import time
+import argparse
+import contextlib
+import multiprocessing
+import concurrent.futures
+import np_logging
+from np_probes.align_barcode_timestamps import get_align_timestamps_output_dictionary
+from np_probes.lfp_subsampling import subsample_session_lfp
+from np_probes.session_index import get_session_index
+from np_probes.utils import save_nwb, NWB_BACKENDS, NWB_SUFFIXES, NWB_COMPRESSIONS
+from np_probes.profiling import profile_session
+from np_probes.staging import STAGING_DIR_ENV, STAGING_MAX_BYTES_ENV, prefetch_session_inputs, pin_staged_files
+from typing import Optional, Union, Sequence
+
+logger = np_logging.getLogger(__name__)
+
+def get_checkpoint_path(output_dir:pathlib.Path, session_id:str) -> pathlib.Path:
+    return pathlib.Path(output_dir, f'{session_id}_checkpoint.json')
+
+def read_checkpoint(checkpoint_path:pathlib.Path) -> dict:
+    if not checkpoint_path.exists():
+        return {'stages': {}}
+    with open(checkpoint_path, 'r') as f:
+        return json.load(f)
+
+def write_checkpoint(checkpoint_path:pathlib.Path, checkpoint:dict) -> None:
+    tmp_path = checkpoint_path.with_name(checkpoint_path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, checkpoint_path)
+
+def is_stage_done(checkpoint:dict, stage:str, key:Optional[str]=None) -> bool:
+    """Whether a stage (or one probe of it) finished, and its outputs still exist."""
+    record = checkpoint['stages'].get(stage, {})
+    if key is not None:
+        record = record.get(key, {})
+
+    return bool(record.get('done')) and all(pathlib.Path(path).exists() for path in record.get('outputs', []))
+
+def mark_stage_done(checkpoint_path:pathlib.Path, checkpoint:dict, stage:str, outputs:Sequence[str]=(),
+                    key:Optional[str]=None) -> None:
+    record = {'done': True, 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'outputs': [str(path) for path in outputs]}
+    if key is None:
+        checkpoint['stages'][stage] = record
+    else:
+        checkpoint['stages'].setdefault(stage, {})[key] = record
+    write_checkpoint(checkpoint_path, checkpoint)
+
+def process_session(session_folder:Union[str, pathlib.Path], output_dir:Union[str, pathlib.Path], with_lfp:bool=True,
+                    lfp_processes:Optional[int]=1, lfp_data_io_options:Optional[dict]=None, 
+                    units_data_io_options:Optional[dict[str, dict]]=None, io_lock=None, redo:bool=False,
+                    profile:bool=False, columnar:bool=False, units_query:Optional[str]=None,
+                    waveform_neighborhood:Optional[int]=None, csd_event_line:Optional[str]=None,
+                    backend:str='hdf5', write_jobs:int=1) -> dict:
+    """
+    Run every stage for one session, skipping stages recorded as done in
+    `<output_dir>/<session_id>_checkpoint.json`, and write `<session_id>_probes.nwb`
+    and `<session_id>_probeX_lfp.nwb`.
+
+    np_session, and AllenSDK and pynwb for the NWB stages, are imported when
+    needed rather than with the module, so the CLI and workers start quickly.
+
+    `io_lock` (e.g. a semaphore shared by the batch) is held during LFP
+    subsampling and while each NWB file is written, the steps dominated by
+    reading and writing data.
+    LFP NWBs are written `lfp_processes` probes at a time (see `export_lfp_nwbs`).
+
+    Probes, channels and units are built once for both NWB stages. The probe
+    ids (UUIDs unless `columnar`) are kept in the checkpoint, so LFP NWBs
+    written by a resumed run have the probe ids of the units NWB.
+
+    With `profile`, the time, memory and I/O of each stage run are written to
+    `<session_id>_profile.json` (see `profiling.profile_session`).
+
+    With `columnar`, probes, channels and units are built as DataFrames with
+    integer ids (see `probes_to_nwb.generate_probe_tables`). `units_query`
+    (e.g. `quality == 'good'`) selects the units written to the units NWB, and
+    `waveform_neighborhood` the channels of their mean waveforms around the
+    peak channel (see `probes_to_nwb.add_to_nwb`).
+
+    With `csd_event_line` (a sync line label or number) and LFP, each
+    probe's CSD around the rising edges of that line is written after LFP
+    subsampling and added to its LFP NWB (see `csd.compute_session_csd`).
+
+    With `backend='zarr'`, NWB files are written as NWB-Zarr directories
+    (`.nwb.zarr`), with the streamed datasets of each written by `write_jobs`
+    processes (see `utils.save_nwb`).
+
+    If staging is on (`NP_PROBES_STAGING_DIR`), the inputs of the stages still to
+    run are first copied to the local staging cache, several at once, and every
+    file staged for the session is kept there until it is done.
+    """
+    import np_session
+
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    io_lock = io_lock if io_lock is not None else contextlib.nullcontext()
+
+    session = np_session.Session(session_folder)
+    session_id = str(session.id)
+    checkpoint_path = get_checkpoint_path(output_dir, session_id)
+    checkpoint = {'stages': {}} if redo else read_checkpoint(checkpoint_path)
+    checkpoint['session_folder'] = str(session_folder)
+
+    profile_report = profile_session(session_id, pathlib.Path(output_dir, f'{session_id}_profile.json')) if profile else contextlib.nullcontext()
+    with profile_report, pin_staged_files():
+        lfp_pending = with_lfp and not is_stage_done(checkpoint, 'lfp_subsampling')
+        if lfp_pending or not (is_stage_done(checkpoint, 'alignment') and is_stage_done(checkpoint, 'units_nwb')):
+            prefetch_session_inputs(session, with_lfp=lfp_pending)
+
+        if not is_stage_done(checkpoint, 'alignment'):
+            logger.info(f'{session_id}: aligning timestamps')
+            align_timestamps_output_dictionary = get_align_timestamps_output_dictionary(session, use_cache=not redo)
+            outputs = [path for probe in align_timestamps_output_dictionary['probe_outputs'] for path in probe['output_paths'].values()]
+            mark_stage_done(checkpoint_path, checkpoint, 'alignment', outputs)
+
+        if with_lfp and not is_stage_done(checkpoint, 'lfp_subsampling'):
+            logger.info(f'{session_id}: subsampling LFP')
+            with io_lock:
+                lfp_outputs = subsample_session_lfp(session, processes=1)
+            outputs = [probe[key] for probe in lfp_outputs['probe_outputs']
+                       for key in ('lfp_data_path', 'lfp_timestamps_path', 'lfp_channel_info_path')]
+            mark_stage_done(checkpoint_path, checkpoint, 'lfp_subsampling', outputs)
+
+        if with_lfp and csd_event_line is not None and not is_stage_done(checkpoint, 'csd'):
+            logger.info(f'{session_id}: computing CSD')
+            from np_probes.csd import compute_session_csd
+            with io_lock:
+                csd_outputs = compute_session_csd(session, event_line=csd_event_line, processes=lfp_processes)
+            outputs = [probe['csd_path'] for probe in csd_outputs['probe_outputs'] if probe['csd_path'] is not None]
+            mark_stage_done(checkpoint_path, checkpoint, 'csd', outputs)
+
+        units_nwb_path = pathlib.Path(output_dir, f'{session_id}_probes{NWB_SUFFIXES[backend]}')
+        units_pending = not is_stage_done(checkpoint, 'units_nwb')
+        probe_names = ['probe' + probe for probe in get_session_index(session)['probes']] if with_lfp else []
+        lfp_nwb_pending = [probe for probe in probe_names if not is_stage_done(checkpoint, 'lfp_nwb', probe)]
+        if not (units_pending or lfp_nwb_pending):
+            return checkpoint
+
+        from np_probes.utils import init_nwb
+        from np_probes.probes_to_nwb import (generate_probes_dictionary, generate_probe_tables, get_probes_dictionary_from_tables,
+                                             get_backend_data_io_options, add_probes_to_nwb, add_probe_tables_to_nwb,
+                                             units_spike_data_dir, export_lfp_nwbs)
+        # built once for both NWB stages, so the LFP NWBs get the probe ids of the units NWB
+        if columnar:
+            probe_tables, align_timestamps_output_dictionary = generate_probe_tables(session, units_query)
+            probes_dictionary = get_probes_dictionary_from_tables(probe_tables)
+        else:
+            probes_dictionary, align_timestamps_output_dictionary = generate_probes_dictionary(session, units_query, 
+                                                                                               checkpoint.get('probe_ids'))
+            probe_ids = {probe['name']: probe['id'] for probe in probes_dictionary['probes']}
+            if checkpoint.get('probe_ids') != probe_ids:
+                checkpoint['probe_ids'] = probe_ids
+                write_checkpoint(checkpoint_path, checkpoint)
+
+        if units_pending:
+            logger.info(f'{session_id}: building units NWB')
+            nwb_file = init_nwb(session)
+            data_io_options = get_backend_data_io_options(units_data_io_options, backend)
+            # spike memmaps, if any, are only needed until the file is written
+            with units_spike_data_dir(output_dir) as spike_data_dir:
+                if columnar:
+                    add_probe_tables_to_nwb(session, nwb_file, probe_tables, data_io_options, waveform_neighborhood, spike_data_dir)
+                else:
+                    add_probes_to_nwb(session, nwb_file, probes_dictionary, data_io_options, waveform_neighborhood, spike_data_dir)
+                with io_lock:
+                    save_nwb(nwb_file, units_nwb_path, backend=backend, number_of_jobs=write_jobs)
+            mark_stage_done(checkpoint_path, checkpoint, 'units_nwb', [units_nwb_path])
+
+        if lfp_nwb_pending:
+            logger.info(f"{session_id}: writing LFP NWB for {', '.join(lfp_nwb_pending)}")
+            # each probe is checkpointed as soon as its file is written
+            export_lfp_nwbs(session, probes_dictionary, align_timestamps_output_dictionary['probe_outputs'],
+                            output_dir=output_dir, processes=lfp_processes, 
+                            data_io_options=lfp_data_io_options, probe_names=lfp_nwb_pending,
+                            backend=backend, write_jobs=write_jobs, io_lock=io_lock,
+                            on_written=lambda probe, stats: mark_stage_done(checkpoint_path, checkpoint, 'lfp_nwb', [stats['path']], key=probe))
+
+    return checkpoint
+
+def run_session(session_folder:Union[str, pathlib.Path], output_dir:Union[str, pathlib.Path], **kwargs) -> dict:
+    """`process_session`, logging and returning any error instead of raising it."""
+    try:
+        return {'session': str(session_folder), 'status': 'done', 'checkpoint': process_session(session_folder, output_dir, **kwargs)}
+    except Exception as e:
+        logger.exception(f'Failed to process {session_folder}')
+        return {'session': str(session_folder), 'status': 'failed', 'error': repr(e)}
+
+def run_batch(sessions:Sequence[Union[str, pathlib.Path]], output_dir:Union[str, pathlib.Path], processes:Optional[int]=1,
+              max_concurrent_io:Optional[int]=None, **kwargs) -> list[dict]:
+    """
+    Process sessions (ids or folders) in up to `processes` worker processes,
+    with at most `max_concurrent_io` sessions subsampling LFP or writing NWB at
+    once. A failed session does not stop the batch, and re-running the batch
+    resumes each session from its checkpoint.
+    """
+    if processes == 1:
+        return [run_session(session, output_dir, **kwargs) for session in sessions]
+
+    with multiprocessing.Manager() as manager:
+        io_lock = manager.BoundedSemaphore(max_concurrent_io) if max_concurrent_io else None
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(run_session, session, output_dir, io_lock=io_lock, **kwargs) for session in sessions]
+            return [future.result() for future in futures]
+
+def main(argv:Optional[Sequence[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description='Build probe NWB files for a batch of sessions, resuming from checkpoints')
+    parser.add_argument('sessions', nargs='*', help='session ids or folders')
+    parser.add_argument('--sessions-file', type=pathlib.Path, help='file with one session id or folder per line')
+    parser.add_argument('--output-dir', type=pathlib.Path, required=True)
+    parser.add_argument('--processes', type=int, default=1, help='sessions processed in parallel')
+    parser.add_argument('--max-concurrent-io', type=int, default=None, help='sessions subsampling LFP or writing NWB at once')
+    parser.add_argument('--no-lfp', action='store_true', help='skip LFP subsampling and LFP NWB files')
+    parser.add_argument('--lfp-processes', type=int, default=1, help='LFP NWB files written in parallel per session')
+    parser.add_argument('--compression', choices=sorted(set().union(*NWB_COMPRESSIONS.values())), default=None, 
+                        help='LFP dataset compression (lzf for hdf5 only, zstd for zarr only)')
+    parser.add_argument('--backend', choices=NWB_BACKENDS, default='hdf5', help='write NWB files as HDF5 or NWB-Zarr directories')
+    parser.add_argument('--write-jobs', type=int, default=1, help='processes writing the chunks of each NWB-Zarr file')
+    parser.add_argument('--redo', action='store_true', help='ignore checkpoints and cached alignment')
+    parser.add_argument('--profile', action='store_true', help='write <session_id>_profile.json with the time, memory and I/O of each stage')
+    parser.add_argument('--columnar', action='store_true', help='build probes, channels and units as DataFrames with integer ids')
+    parser.add_argument('--units-query', default=None, help="units to write, e.g. \"quality == 'good' and isi_violations < 0.5\"")
+    parser.add_argument('--waveform-neighborhood', type=int, default=None, 
+                        help='write mean waveforms on the peak channel and this many channels either side only')
+    parser.add_argument('--csd-event-line', default=None, help='sync line whose rising edges the CSD is averaged around')
+    parser.add_argument('--staging-dir', type=pathlib.Path, default=None, help='local directory to cache input files from network shares in')
+    parser.add_argument('--staging-max-gb', type=float, default=None, help='size of the staging cache, least recently used files are evicted')
+    args = parser.parse_args(argv)
+
+    sessions = list(args.sessions)
+    if args.sessions_file is not None:
+        sessions += [line.strip() for line in args.sessions_file.read_text().splitlines() if line.strip()]
+    if not sessions:
+        parser.error('no sessions given')
+    if args.compression is not None and args.compression not in NWB_COMPRESSIONS[args.backend]:
+        parser.error(f"--compression {args.compression} is not supported with --backend {args.backend}: "
+                     f"expected one of {', '.join(NWB_COMPRESSIONS[args.backend])}")
+    # set in the environment so worker processes stage too
+    if args.staging_dir is not None:
+        os.environ[STAGING_DIR_ENV] = str(args.staging_dir)
+    if args.staging_max_gb is not None:
+        os.environ[STAGING_MAX_BYTES_ENV] = str(int(args.staging_max_gb * 1024**3))
+
+    results = run_batch(sessions, args.output_dir, processes=args.processes, max_concurrent_io=args.max_concurrent_io,
+                        with_lfp=not args.no_lfp, lfp_processes=args.lfp_processes, redo=args.redo, profile=args.profile, columnar=args.columnar, units_query=args.units_query,
+                        waveform_neighborhood=args.waveform_neighborhood, csd_event_line=args.csd_event_line,
+                        backend=args.backend, write_jobs=args.write_jobs,
+                        lfp_data_io_options={'compression': args.compression} if args.compression else None)
+
+    failed = [result for result in results if result['status'] == 'failed']
+    for result in failed:
+        logger.error(f"{result['session']}: {result['error']}")
+    logger.info(f'{len(results) - len(failed)} of {len(results)} sessions done')
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
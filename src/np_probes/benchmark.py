@@ -0,0 +1,496 @@
+import os
+import sys
+import json
+import time
+import pathlib
+import argparse
+import datetime
+import tempfile
+import subprocess
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import np_logging
+from np_probes.profiling import profile_session, profile_stage, difference
+from np_probes.session_index import get_session_index
+from np_probes.align_barcode_timestamps import get_align_timestamps_output_dictionary
+from np_probes.lfp_subsampling import subsample_session_lfp
+from np_probes.csd import compute_session_csd
+from np_probes.utils import init_nwb, save_nwb
+from typing import TYPE_CHECKING, Optional, Union, Sequence
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = np_logging.getLogger(__name__)
+
+AP_SAMPLING_RATE = 30000.0
+LFP_SAMPLING_RATE = 2500.0
+SYNC_SAMPLE_FREQUENCY = 100000.0
+# OpenEphys writes all 384 channels of the LFP band, whatever is sorted
+LFP_TOTAL_CHANNELS = 384
+# shorter than the rig's 30 s so short sessions still have a few barcodes to align
+BARCODE_INTERVAL = 15.0
+WAVEFORM_SAMPLES = 82
+CCF_SHAPE = (132, 80, 114)
+CCF_STRUCTURES = {0: None, 382: 'CA1', 632: 'DG-sg', 385: 'VISp', 313: 'MB', 549: 'TH'}
+WRITE_BLOCK_SAMPLES = 250_000
+HEAVY_DEPENDENCIES = ('allensdk', 'pynwb', 'hdmf', 'h5py', 'pandas', 'scipy', 'SimpleITK', 'np_session')
+# module -> heavy dependencies it may load when imported; the rest load when a stage needs them
+IMPORT_ALLOWED_DEPENDENCIES = {
+    'np_probes.profiling': (),
+    'np_probes.staging': (),
+    'np_probes.sync': (),
+    'np_probes.csd': (),
+    'np_probes.utils': (),
+    'np_probes.session_index': (),
+    'np_probes.align_barcode_timestamps': (),
+    'np_probes.lfp_subsampling_json': (),
+    'np_probes.lfp_subsampling': (),
+    'np_probes.batch': (),
+    'np_probes.benchmark': (),
+    'np_probes.probe_channel_units': ('pandas',),
+    'np_probes.data_io': ('pynwb', 'hdmf', 'h5py', 'pandas', 'scipy'),
+    'np_probes.probes_to_nwb': ('pynwb', 'hdmf', 'h5py', 'pandas', 'scipy', 'np_session'),
+}
+IMPORT_TIMER = '''
+import sys, json, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start, 'modules': sorted(set(name.split('.')[0] for name in sys.modules))}}))
+'''
+
+class SyntheticSession:
+    """
+    Stands in for `np_session.Session` with the attributes the pipeline uses,
+    for a session made by `make_synthetic_session`.
+    """
+    def __init__(self, root:pathlib.Path, session_id:str, mouse:str, probes:Sequence[str], n_channels:int,
+                 start:datetime.datetime):
+        self.root = root
+        self.id = session_id
+        self.mouse = mouse
+        self.start = start
+        self.n_channels = n_channels
+        self.npexp_path = pathlib.Path(root, session_id)
+        self.storage_dirs = [root, root]
+        self.datajoint_path = pathlib.Path(root, 'datajoint', session_id)
+        self.tissuecyte_path = pathlib.Path(root, 'tissuecyte')
+        self.probe_letter_to_metrics_csv_path = {
+            probe: pathlib.Path(self.datajoint_path, f'{session_id}_probe{probe}_sorted', 'continuous', 'Neuropix-PXI-100.0', 'metrics.csv')
+            for probe in probes
+        }
+        self.metrics_csv = list(self.probe_letter_to_metrics_csv_path.values())
+
+    def __repr__(self) -> str:
+        return f'SyntheticSession({self.npexp_path})'
+
+def get_barcodes(duration:float, rng:np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    """Start times (s, on the sync clock) and 32-bit values of barcodes sent every `BARCODE_INTERVAL`."""
+    barcode_times = np.arange(2.0, duration - 2.0, BARCODE_INTERVAL)
+    if len(barcode_times) < 3:
+        # the first barcode is never used, and at least two are needed to fit the probe clock
+        raise ValueError(f'Synthetic sessions must be at least {2 * BARCODE_INTERVAL + 5} s long')
+    return barcode_times, rng.integers(0, 2**32, len(barcode_times))
+
+def get_barcode_edges(barcode_times:np.ndarray, barcodes:np.ndarray, bar_duration:float=0.03) -> tuple[np.ndarray, np.ndarray]:
+    """Rising and falling edge times of barcodes: a 10 ms start pulse, then 32 bits LSB first."""
+    on_times, off_times = [], []
+    for barcode_time, barcode in zip(barcode_times, barcodes):
+        on_times.append(barcode_time)
+        off_times.append(barcode_time + 0.01)
+        previous_bit = 0
+        for bit_index in range(32):
+            bit = (int(barcode) >> bit_index) & 1
+            bit_time = barcode_time + 0.04 + bit_index * bar_duration
+            if bit and not previous_bit:
+                on_times.append(bit_time)
+            if previous_bit and not bit:
+                off_times.append(bit_time)
+            previous_bit = bit
+        if previous_bit:
+            off_times.append(barcode_time + 0.04 + 32 * bar_duration)
+
+    return np.array(on_times), np.array(off_times)
+
+def write_sync_file(sync_path:pathlib.Path, on_times:np.ndarray, off_times:np.ndarray, barcode_line:int=3) -> None:
+    """Sync `.h5` with only the barcode line changing, in the layout read by `get_sync_barcodes` and AllenSDK."""
+    import h5py
+
+    edges = np.concatenate([np.c_[np.round(on_times * SYNC_SAMPLE_FREQUENCY), np.ones(len(on_times))],
+                            np.c_[np.round(off_times * SYNC_SAMPLE_FREQUENCY), np.zeros(len(off_times))]])
+    edges = edges[np.argsort(edges[:, 0], kind='stable')]
+
+    data = np.zeros((len(edges) + 1, 2), dtype=np.uint32)
+    data[1:, 0] = edges[:, 0]
+    data[1:, 1] = edges[:, 1].astype(np.uint32) << barcode_line
+    line_labels = [f'line{line}' for line in range(barcode_line)] + ['barcode_ephys']
+    meta_data = {'line_labels': line_labels, 'ni_daq': {'counter_output_freq': SYNC_SAMPLE_FREQUENCY, 'counter_bits': 32}}
+
+    with h5py.File(sync_path, 'w') as f:
+        f['data'] = data
+        f['meta'] = str(meta_data)
+
+def write_open_ephys_probe(recording_path:pathlib.Path, probe:str, on_samples:np.ndarray, off_samples:np.ndarray,
+                           first_lfp_sample:int, n_lfp_samples:int, rng:np.random.Generator) -> None:
+    """Barcode `states.npy`, and LFP `continuous.dat` and `sample_numbers.npy` of one probe."""
+    ap_path = pathlib.Path(recording_path, 'continuous', f'Neuropix-PXI-100.Probe{probe}-AP')
+    ap_path.mkdir(parents=True, exist_ok=True)
+
+    states_path = pathlib.Path(recording_path, 'events', f'Neuropix-PXI-100.Probe{probe}-AP', 'TTL')
+    states_path.mkdir(parents=True, exist_ok=True)
+    order = np.argsort(np.concatenate([on_samples, off_samples]), kind='stable')
+    np.save(states_path / 'states.npy', np.concatenate([np.ones(len(on_samples)), -np.ones(len(off_samples))]).astype(np.int16)[order])
+
+    lfp_path = pathlib.Path(recording_path, 'continuous', f'Neuropix-PXI-100.Probe{probe}-LFP')
+    lfp_path.mkdir(parents=True, exist_ok=True)
+    np.save(lfp_path / 'sample_numbers.npy', np.arange(first_lfp_sample, first_lfp_sample + n_lfp_samples, dtype=np.int64))
+    with open(lfp_path / 'continuous.dat', 'wb') as f:
+        for start in range(0, n_lfp_samples, WRITE_BLOCK_SAMPLES):
+            n_samples = min(WRITE_BLOCK_SAMPLES, n_lfp_samples - start)
+            f.write(rng.integers(-200, 200, (n_samples, LFP_TOTAL_CHANNELS), dtype=np.int16).tobytes())
+
+def get_metrics_table(n_units:int, n_channels:int, rng:np.random.Generator) -> 'pd.DataFrame':
+    """`metrics.csv` columns read by `get_units_table`, with plausible values."""
+    import pandas as pd
+
+    return pd.DataFrame({
+        'cluster_id': np.arange(n_units),
+        'peak_channel': rng.integers(0, n_channels, n_units),
+        'quality': np.where(rng.random(n_units) < 0.8, 'good', 'noise'),
+        'snr': rng.uniform(1, 10, n_units),
+        'firing_rate': rng.uniform(0.1, 20, n_units),
+        'isi_viol': rng.uniform(0, 1, n_units),
+        'presence_ratio': rng.uniform(0.5, 1, n_units),
+        'amplitude_cutoff': rng.uniform(0, 0.5, n_units),
+        'isolation_distance': rng.uniform(10, 100, n_units),
+        'l_ratio': rng.uniform(0, 0.5, n_units),
+        'd_prime': rng.uniform(1, 10, n_units),
+        'nn_hit_rate': rng.uniform(0, 1, n_units),
+        'nn_miss_rate': rng.uniform(0, 0.1, n_units),
+        'silhouette_score': rng.uniform(-1, 1, n_units),
+        'max_drift': rng.uniform(0, 50, n_units),
+        'cumulative_drift': rng.uniform(0, 200, n_units),
+        'duration': rng.uniform(0.1, 1, n_units),
+        'halfwidth': rng.uniform(0.1, 0.5, n_units),
+        'PT_ratio': rng.uniform(0.1, 1, n_units),
+        'repolarization_slope': rng.uniform(0, 1, n_units),
+        'recovery_slope': rng.uniform(-0.5, 0, n_units),
+        'amplitude': rng.uniform(50, 300, n_units),
+        'spread': rng.uniform(20, 200, n_units),
+        'velocity_above': rng.uniform(-1, 1, n_units),
+        'velocity_below': rng.uniform(-1, 1, n_units),
+    })
+
+def write_kilosort_probe(sorted_path:pathlib.Path, on_samples:np.ndarray, off_samples:np.ndarray, n_ap_samples:int,
+                         n_units:int, n_channels:int, firing_rate:float, rng:np.random.Generator) -> None:
+    """Kilosort and ecephys outputs of one probe, plus the barcode `event_timestamps.npy` of the sorted data."""
+    ap_path = pathlib.Path(sorted_path, 'continuous', 'Neuropix-PXI-100.0')
+    ap_path.mkdir(parents=True, exist_ok=True)
+
+    n_spikes = int(n_units * firing_rate * n_ap_samples / AP_SAMPLING_RATE)
+    spike_times = np.sort(rng.integers(0, n_ap_samples, n_spikes)).astype(np.uint64)
+    spike_clusters = rng.integers(0, n_units, n_spikes).astype(np.int32)
+    np.save(ap_path / 'spike_times.npy', spike_times.reshape(-1, 1))
+    np.save(ap_path / 'spike_clusters.npy', spike_clusters)
+    np.save(ap_path / 'spike_templates.npy', spike_clusters.astype(np.uint32).reshape(-1, 1))
+    np.save(ap_path / 'amplitudes.npy', rng.uniform(5, 50, (n_spikes, 1)))
+    np.save(ap_path / 'templates.npy', rng.normal(size=(n_units, WAVEFORM_SAMPLES, n_channels)).astype(np.float32))
+    np.save(ap_path / 'whitening_mat_inv.npy', np.eye(n_channels) + rng.normal(scale=0.01, size=(n_channels, n_channels)))
+    np.save(ap_path / 'mean_waveforms.npy', rng.normal(size=(n_units, n_channels, WAVEFORM_SAMPLES)).astype(np.float32))
+    get_metrics_table(n_units, n_channels, rng).to_csv(ap_path / 'metrics.csv', index=False)
+
+    events_path = pathlib.Path(sorted_path, 'events', 'Neuropix-PXI-100.0', 'TTL_1')
+    events_path.mkdir(parents=True, exist_ok=True)
+    np.save(events_path / 'event_timestamps.npy', np.sort(np.concatenate([on_samples, off_samples]), kind='stable'))
+
+def write_ccf(tissuecyte_path:pathlib.Path, mouse:str, probes:Sequence[str], day:str, n_channels:int,
+              rng:np.random.Generator) -> None:
+    """A small annotation volume (`ccf_ano.mhd`) and warped channel coordinates for each probe."""
+    import pandas as pd
+    import SimpleITK as sitk
+
+    annotation_path = pathlib.Path(tissuecyte_path, 'field_reference')
+    annotation_path.mkdir(parents=True, exist_ok=True)
+    structure_ids = np.array(list(CCF_STRUCTURES), dtype=np.uint32)
+    # horizontal layers of structures along the dorsal-ventral axis
+    layers = structure_ids[np.arange(CCF_SHAPE[1]) * len(structure_ids) // CCF_SHAPE[1]]
+    annotation = np.broadcast_to(layers[None, :, None], CCF_SHAPE).copy()
+    sitk.WriteImage(sitk.GetImageFromArray(annotation), str(annotation_path / 'ccf_ano.mhd'))
+
+    pathlib.Path(tissuecyte_path, mouse).mkdir(parents=True, exist_ok=True)
+    for probe in probes:
+        channels = np.arange(n_channels)
+        ap = np.full(n_channels, rng.integers(10, CCF_SHAPE[0] - 10))
+        dv = np.round(np.linspace(CCF_SHAPE[1] - 1, 0, n_channels)).astype(int)
+        ml = np.full(n_channels, rng.integers(10, CCF_SHAPE[2] - 10))
+        regions = [CCF_STRUCTURES[structure_id] for structure_id in annotation[ap, dv, ml]]
+        pd.DataFrame({'channel': channels, 'AP': ap, 'DV': dv, 'ML': ml, 'region': regions}).to_csv(
+            pathlib.Path(tissuecyte_path, mouse, f'Probe_{probe}{day}_channels_{mouse}_warped.csv'), index=False)
+
+def make_synthetic_session(root:Union[str, pathlib.Path], n_probes:int=2, duration:float=60.0, n_units:int=100,
+                           n_channels:int=384, firing_rate:float=5.0, seed:int=0) -> SyntheticSession:
+    """
+    Write a session under `root` with the layout of a DR pilot session: OpenEphys
+    recording (barcode states, LFP), sorted data on "datajoint" (Kilosort outputs,
+    `metrics.csv`, barcode event timestamps), a sync `.h5` and CCF alignments.
+
+    Each probe's clock has its own offset and drift from the sync clock, so the
+    barcode alignment has something to correct. The AP band `continuous.dat`
+    isn't written, as nothing in the pipeline reads it.
+    """
+    root = pathlib.Path(root)
+    rng = np.random.default_rng(seed)
+    mouse = '000000'
+    probes = 'ABCDEF'[:n_probes]
+    session = SyntheticSession(root, f'DRpilot_{mouse}_20230101', mouse, probes, n_channels,
+                               datetime.datetime(2023, 1, 1, 12, tzinfo=datetime.timezone.utc))
+    logger.info(f'Writing synthetic session {session.id} to {root}: {n_probes} probes, {duration} s, '
+                f'{n_units} units, {n_channels} channels')
+
+    recording_path = pathlib.Path(session.npexp_path, f'{session.id}_probe{probes}', 'Record Node 102', 'experiment1', 'recording1')
+    recording_path.mkdir(parents=True, exist_ok=True)
+    barcode_times, barcodes = get_barcodes(duration, rng)
+    on_times, off_times = get_barcode_edges(barcode_times, barcodes)
+    write_sync_file(pathlib.Path(session.npexp_path, f'{session.id}.h5'), on_times, off_times)
+
+    for probe in probes:
+        time_shift = rng.uniform(0, 5)
+        sampling_rate = AP_SAMPLING_RATE * (1 + rng.uniform(-2e-5, 2e-5))
+        on_samples = np.round((on_times + time_shift) * sampling_rate).astype(np.int64)
+        off_samples = np.round((off_times + time_shift) * sampling_rate).astype(np.int64)
+        n_ap_samples = int((duration + time_shift) * sampling_rate)
+
+        n_lfp_samples = int(n_ap_samples * LFP_SAMPLING_RATE / AP_SAMPLING_RATE)
+        write_open_ephys_probe(recording_path, probe, on_samples, off_samples, int(rng.integers(0, 10**6)), n_lfp_samples, rng)
+        write_kilosort_probe(pathlib.Path(session.datajoint_path, f'{session.id}_probe{probe}_sorted'), on_samples, off_samples,
+                             n_ap_samples, n_units, n_channels, firing_rate, rng)
+
+    write_ccf(session.tissuecyte_path, mouse, probes, '1', n_channels, rng)
+
+    return session
+
+def run_session_index(session:SyntheticSession) -> None:
+    get_session_index(session, use_cache=False)
+
+def run_alignment(session:SyntheticSession, engine:str='allensdk') -> None:
+    get_align_timestamps_output_dictionary(session, use_cache=False, engine=engine)
+
+def run_lfp_subsampling(session:SyntheticSession) -> None:
+    subsample_session_lfp(session, processes=1, total_channels=LFP_TOTAL_CHANNELS)
+
+def run_csd(session:SyntheticSession, event_line:str='barcode') -> None:
+    compute_session_csd(session, event_line=event_line, processes=1)
+
+def run_probes_dictionary(session:SyntheticSession) -> None:
+    from np_probes.probes_to_nwb import generate_probes_dictionary
+
+    generate_probes_dictionary(session)
+
+def run_probe_tables(session:SyntheticSession) -> None:
+    from np_probes.probes_to_nwb import generate_probe_tables
+
+    generate_probe_tables(session)
+
+def run_units_nwb(session:SyntheticSession, units_data_io_options:Optional[dict]=None) -> None:
+    from np_probes.probes_to_nwb import generate_probes_dictionary, add_probes_to_nwb, units_spike_data_dir
+
+    probes_dictionary, _ = generate_probes_dictionary(session)
+    nwb_file = init_nwb(session)
+    with units_spike_data_dir(pathlib.Path(session.root, 'nwb')) as spike_data_dir:
+        add_probes_to_nwb(session, nwb_file, probes_dictionary, units_data_io_options, spike_data_dir=spike_data_dir)
+        save_nwb(nwb_file, pathlib.Path(session.root, 'nwb', f'{session.id}_probes.nwb'))
+
+def run_units_nwb_columnar(session:SyntheticSession, units_data_io_options:Optional[dict]=None,
+                           waveform_neighborhood:Optional[int]=None) -> None:
+    from np_probes.probes_to_nwb import generate_probe_tables, add_probe_tables_to_nwb, units_spike_data_dir
+
+    probe_tables, _ = generate_probe_tables(session)
+    nwb_file = init_nwb(session)
+    with units_spike_data_dir(pathlib.Path(session.root, 'nwb')) as spike_data_dir:
+        add_probe_tables_to_nwb(session, nwb_file, probe_tables, units_data_io_options, waveform_neighborhood, spike_data_dir)
+        save_nwb(nwb_file, pathlib.Path(session.root, 'nwb', f'{session.id}_probes_columnar.nwb'))
+
+def run_lfp_nwb(session:SyntheticSession, lfp_data_io_options:Optional[dict]=None, backend:str='hdf5', write_jobs:int=1) -> None:
+    from np_probes.probes_to_nwb import generate_probes_dictionary, export_lfp_nwbs
+
+    probes_dictionary, align_timestamps_output_dictionary = generate_probes_dictionary(session)
+    export_lfp_nwbs(session, probes_dictionary, align_timestamps_output_dictionary['probe_outputs'],
+                    output_dir=pathlib.Path(session.root, 'nwb'), processes=1, data_io_options=lfp_data_io_options,
+                    backend=backend, write_jobs=write_jobs)
+
+BENCHMARK_STAGES = {
+    'session_index': run_session_index,
+    'alignment': run_alignment,
+    'lfp_subsampling': run_lfp_subsampling,
+    'csd': run_csd,
+    'probes_dictionary': run_probes_dictionary,
+    'probe_tables': run_probe_tables,
+    'units_nwb': run_units_nwb,
+    'units_nwb_columnar': run_units_nwb_columnar,
+    'lfp_nwb': run_lfp_nwb,
+}
+
+def run_stage(stage:str, session:SyntheticSession, label:Optional[str]=None, **kwargs) -> dict:
+    """
+    Run one stage with profiling on, returning its wall and CPU time, peak RSS
+    while it ran (and increase over the RSS when it started) and the records
+    of the stages nested in it.
+    """
+    os.environ['NP_PROBES_TISSUECYTE_PATH'] = str(session.tissuecyte_path)
+    pathlib.Path(session.root, 'nwb').mkdir(exist_ok=True)
+    label = label if label is not None else stage
+
+    with profile_session(str(session.id)) as records:
+        with profile_stage(label):
+            BENCHMARK_STAGES[stage](session, **kwargs)
+
+    summary = [record for record in records if record['stage'] == label][-1]
+    return {
+        'stage': label,
+        'wall_s': summary['wall_s'],
+        'cpu_s': summary['cpu_s'],
+        'peak_rss_bytes': summary['peak_rss_bytes'],
+        'peak_rss_increase_bytes': difference(summary['peak_rss_bytes'], summary['start_rss_bytes']),
+        'process_peak_rss_bytes': summary['process_peak_rss_bytes'],
+        'read_bytes': summary['read_bytes'],
+        'write_bytes': summary['write_bytes'],
+        'records': [record for record in records if record['stage'] not in (label, 'session')],
+    }
+
+def set_environment(environment:dict[str, str]) -> None:
+    os.environ.update(environment)
+
+def run_stage_in_process(stage:str, session:SyntheticSession, **kwargs) -> dict:
+    """`run_stage` in a new process, so its peak RSS is its own and no cache is warm."""
+    context = multiprocessing.get_context('spawn')
+    environment = {'NP_PROBES_CACHE_DIR': str(pathlib.Path(session.root, 'cache'))}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context,
+                                                initializer=set_environment, initargs=(environment,)) as executor:
+        return executor.submit(run_stage, stage, session, **kwargs).result()
+
+def run_benchmark(session:SyntheticSession, engines:Sequence[str]=('numpy', 'allensdk'), isolate:bool=True,
+                  units_data_io_options:Optional[dict]=None, lfp_data_io_options:Optional[dict]=None) -> list[dict]:
+    """
+    Run every stage of the pipeline on a synthetic session, in order, with the
+    alignment run once per engine. With `isolate`, each stage runs in its own process.
+    """
+    run = run_stage_in_process if isolate else run_stage
+    results = [run('session_index', session)]
+    for engine in engines:
+        results.append(run('alignment', session, label=f'alignment[{engine}]', engine=engine))
+    results.append(run('lfp_subsampling', session))
+    results.append(run('csd', session))
+    results.append(run('probes_dictionary', session))
+    results.append(run('probe_tables', session))
+    results.append(run('units_nwb', session, units_data_io_options=units_data_io_options))
+    results.append(run('units_nwb_columnar', session, units_data_io_options=units_data_io_options))
+    results.append(run('units_nwb_columnar', session, label='units_nwb_columnar[peak_waveforms]',
+                       units_data_io_options=units_data_io_options, waveform_neighborhood=0))
+    results.append(run('lfp_nwb', session, lfp_data_io_options=lfp_data_io_options))
+
+    for result in results:
+        logger.info(f"{result['stage']}: {result['wall_s']}s wall, {result['cpu_s']}s cpu, "
+                    f"peak RSS +{(result['peak_rss_increase_bytes'] or 0) / 2**20:.0f} MiB")
+
+    return results
+
+def time_import(module:str) -> dict:
+    """Seconds to import `module` in a new interpreter, and the top-level packages it loads."""
+    output = subprocess.run([sys.executable, '-c', IMPORT_TIMER.format(module=module)], capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def run_import_benchmark(modules:dict[str, Sequence[str]]=IMPORT_ALLOWED_DEPENDENCIES, repeat:int=3) -> list[dict]:
+    """
+    Best of `repeat` import times of each module, with the heavy dependencies
+    it loads and those it isn't expected to (`unexpected_dependencies`).
+    """
+    results = []
+    for module, allowed in modules.items():
+        timings = [time_import(module) for _ in range(repeat)]
+        dependencies = [name for name in HEAVY_DEPENDENCIES if name in timings[0]['modules']]
+        results.append({
+            'stage': f'import {module}',
+            'wall_s': round(min(timing['seconds'] for timing in timings), 3),
+            'peak_rss_increase_bytes': None,
+            'heavy_dependencies': dependencies,
+            'unexpected_dependencies': [name for name in dependencies if name not in allowed],
+        })
+        logger.info(f"import {module}: {results[-1]['wall_s']}s, loads {', '.join(dependencies) or 'no heavy dependencies'}")
+
+    return results
+
+def compare_to_baseline(results:list[dict], baseline:list[dict], tolerance:float=1.2, min_seconds:float=0.5) -> list[str]:
+    """Stages slower or using more memory than `tolerance` times the baseline (ignoring stages under `min_seconds`)."""
+    baseline_by_stage = {result['stage']: result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline_by_stage.get(result['stage'])
+        if previous is None:
+            continue
+        if result['wall_s'] > max(previous['wall_s'], min_seconds) * tolerance:
+            regressions.append(f"{result['stage']}: {result['wall_s']}s wall, was {previous['wall_s']}s")
+        if (result['peak_rss_increase_bytes'] or 0) > (previous['peak_rss_increase_bytes'] or 0) * tolerance + 2**20:
+            regressions.append(f"{result['stage']}: peak RSS +{result['peak_rss_increase_bytes']}, was +{previous['peak_rss_increase_bytes']}")
+
+    return regressions
+
+def main(argv:Optional[Sequence[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description='Time each stage of the pipeline on a synthetic session')
+    parser.add_argument('--probes', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds')
+    parser.add_argument('--units', type=int, default=100, help='units per probe')
+    parser.add_argument('--channels', type=int, default=384, help='sorted channels per probe')
+    parser.add_argument('--firing-rate', type=float, default=5.0, help='mean spikes per second per unit')
+    parser.add_argument('--engines', nargs='+', default=['numpy', 'allensdk'], help='alignment engines to compare, in order')
+    parser.add_argument('--no-isolate', action='store_true', help='run every stage in this process')
+    parser.add_argument('--root', type=pathlib.Path, default=None, help='where to write the session (kept); a temporary directory by default')
+    parser.add_argument('--output', type=pathlib.Path, default=None, help='write the results as JSON')
+    parser.add_argument('--baseline', type=pathlib.Path, default=None, help='results JSON to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='slowdown (or memory increase) counted as a regression')
+    parser.add_argument('--imports', action='store_true', help='time importing each module instead, and check what it loads')
+    args = parser.parse_args(argv)
+
+    if args.imports:
+        return check_imports(args.output, args.baseline, args.tolerance)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = args.root if args.root is not None else pathlib.Path(tmp_dir)
+        session = make_synthetic_session(root, args.probes, args.duration, args.units, args.channels, args.firing_rate)
+        start = time.perf_counter()
+        results = run_benchmark(session, args.engines, isolate=not args.no_isolate)
+        logger.info(f'Benchmark took {time.perf_counter() - start:.1f}s')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'parameters': {key: value for key, value in vars(args).items() if key in ('probes', 'duration', 'units', 'channels', 'firing_rate')},
+                       'results': results}, f, indent=2)
+
+    if args.baseline is None:
+        return 0
+
+    with open(args.baseline, 'r') as f:
+        regressions = compare_to_baseline(results, json.load(f)['results'], args.tolerance)
+    for regression in regressions:
+        logger.warning(f'Regression in {regression}')
+
+    return 1 if regressions else 0
+
+def check_imports(output:Optional[pathlib.Path]=None, baseline:Optional[pathlib.Path]=None, tolerance:float=1.2) -> int:
+    results = run_import_benchmark()
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({'results': results}, f, indent=2)
+
+    regressions = [f"{result['stage']}: loads {', '.join(result['unexpected_dependencies'])}" 
+                   for result in results if result['unexpected_dependencies']]
+    if baseline is not None:
+        with open(baseline, 'r') as f:
+            regressions += compare_to_baseline(results, json.load(f)['results'], tolerance, min_seconds=0.1)
+    for regression in regressions:
+        logger.warning(f'Regression in {regression}')
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+import os
+import uuid
+import pathlib
+import numpy as np
+import np_logging
+import concurrent.futures
+from np_probes.session_index import get_session_index
+from np_probes.profiling import profiled
+from typing import TYPE_CHECKING, Optional, Union, Sequence
+
+if TYPE_CHECKING:
+    import np_session
+
+logger = np_logging.getLogger(__name__)
+
+# defaults of the AllenSDK `current_source_density` module, where it has them
+CSD_PARAMETERS = {
+    'pre_stimulus_time': 0.1,
+    'post_stimulus_time': 0.25,
+    'filter_cuts': (5.0, 150.0),
+    'filter_order': 5,
+    'noisy_channel_threshold': 1500.0,
+    # as `LFP_AMPLITUDE_SCALE_FACTOR`
+    'volts_per_bit': 0.195e-6,
+    # 3-point Hamming window across neighbouring channels
+    'spatial_kernel': (0.23, 0.54, 0.23),
+}
+# x positions (um) of Neuropixels sites, by channel number % 4, as in AllenSDK `make_actual_channel_locations`
+SITE_X_POSITIONS = np.array([16, 48, 0, 32])
+SITE_Y_SPACING = 20
+
+def get_csd_path(session:'np_session.Session', current_probe:str) -> pathlib.Path:
+    return pathlib.Path(get_session_index(session)['sdk_outputs_path'], '{}_csd.h5'.format(current_probe))
+
+def get_channel_locations(channels:np.ndarray) -> np.ndarray:
+    """(x, y) positions (um) of Neuropixels channel numbers."""
+    return np.column_stack([SITE_X_POSITIONS[channels % 4], channels // 2 * SITE_Y_SPACING])
+
+def get_event_windows(timestamps:np.ndarray, event_times:np.ndarray, n_pre:int, n_post:int) -> np.ndarray:
+    """First sample of the window around each event, for events whose window is within the recording."""
+    starts = np.searchsorted(timestamps, np.sort(np.asarray(event_times, dtype=np.float64))) - n_pre
+    return starts[(starts >= 0) & (starts + n_pre + n_post <= len(timestamps))]
+
+def accumulate_event_windows(lfp:np.ndarray, starts:np.ndarray, window:int, block_samples:int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sum over events of the (samples x channels) LFP window from each of `starts`,
+    and of each window's standard deviation over time per channel, read from
+    `lfp` one block of `block_samples` (plus a window) at a time.
+
+    Windows are gathered `block_samples // window` events at a time, so memory
+    is bounded by `block_samples` however many events fall in a block.
+    """
+    window_sum = np.zeros((window, lfp.shape[1]), dtype=np.float64)
+    std_sum = np.zeros(lfp.shape[1], dtype=np.float64)
+    batch_events = max(1, block_samples // window)
+    blocks = starts // block_samples
+    for block in np.unique(blocks):
+        block_starts = starts[blocks == block]
+        read_start = block_starts[0]
+        data = np.asarray(lfp[read_start:block_starts[-1] + window], dtype=np.float32)
+        for batch_start in range(0, len(block_starts), batch_events):
+            # events x samples x channels
+            windows = data[(block_starts[batch_start:batch_start + batch_events] - read_start)[:, None] + np.arange(window)]
+            window_sum += windows.sum(axis=0, dtype=np.float64)
+            std_sum += windows.std(axis=1).sum(axis=0, dtype=np.float64)
+
+    return window_sum, std_sum
+
+def get_interpolation_matrix(positions:np.ndarray, clean:np.ndarray) -> np.ndarray:
+    """(channels x clean channels) weights interpolating every channel linearly from the clean channels by position."""
+    return np.column_stack([np.interp(positions, positions[clean], column) for column in np.eye(clean.sum())])
+
+def get_second_spatial_derivative(lfp:np.ndarray, spacing:float, kernel:Sequence[float]=()) -> np.ndarray:
+    """
+    Second spatial derivative of (channels x samples) LFP along the probe, as in
+    AllenSDK `compute_csd`, after smoothing across channels with `kernel`.
+    """
+    if len(kernel) > 1:
+        padded = np.pad(lfp, ((len(kernel) // 2, (len(kernel) - 1) // 2), (0, 0)), mode='edge')
+        lfp = sum(weight * padded[offset:offset + len(lfp)] for offset, weight in enumerate(kernel))
+
+    padded = np.pad(lfp, ((1, 1), (0, 0)), mode='edge')
+    return (padded[2:] - 2 * padded[1:-1] + padded[:-2]) / spacing ** 2
+
+def write_csd(path:Union[str, pathlib.Path], csd:np.ndarray, relative_times:np.ndarray, channels:np.ndarray,
+              csd_locations:np.ndarray, event_name:str, num_trials:int) -> None:
+    """CSD `.h5` in the layout of the AllenSDK `current_source_density` module, read by `CurrentSourceDensity.from_json`."""
+    import h5py
+
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        with h5py.File(tmp_path, 'w') as f:
+            f.create_dataset('current_source_density', data=csd)
+            f.create_dataset('timestamps', data=relative_times)
+            f.create_dataset('channels', data=channels)
+            f.create_dataset('csd_locations', data=csd_locations)
+            f.attrs['stimulus_name'] = event_name
+            f.attrs['num_trials'] = num_trials
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+def compute_probe_csd(probe:dict, event_times:np.ndarray, event_name:str='events', block_samples:int=125_000,
+                      **parameters) -> dict:
+    """
+    Event-locked current source density of one probe's subsampled LFP, written
+    to `probe['csd_output_path']`.
+
+    `probeX_lfp.dat` is memory-mapped and the windows around `event_times` (s,
+    on the sync clock) are summed one block of `block_samples` at a time, so
+    memory is bounded by the block size. The average is band-pass filtered,
+    reference and noisy channels are replaced by interpolation from their
+    neighbours, and the CSD is the second spatial derivative after smoothing
+    across channels.
+
+    Unlike AllenSDK, which interpolates each trial onto exact times and a
+    virtual column of sites, windows start at the first sample after each event
+    and the CSD is on the recorded channels.
+    """
+    from scipy.signal import butter, filtfilt
+
+    parameters = {**CSD_PARAMETERS, **parameters}
+    channels = np.load(probe['lfp_channel_info_path'], allow_pickle=False)
+    timestamps = np.load(probe['lfp_timestamps_path'], mmap_mode='r')
+    lfp = np.memmap(probe['lfp_data_path'], dtype=np.int16, mode='r').reshape(-1, len(channels))
+    sampling_rate = probe['sampling_rate']
+
+    n_pre = int(round(parameters['pre_stimulus_time'] * sampling_rate))
+    n_post = int(round(parameters['post_stimulus_time'] * sampling_rate))
+    starts = get_event_windows(timestamps, event_times, n_pre, n_post)
+    output = {'name': probe['name'], 'csd_path': None, 'clean_channels': [], 'num_trials': len(starts)}
+    if len(starts) == 0:
+        logger.warning(f"No {event_name} within the LFP of {probe['name']}: skipping CSD")
+        return output
+
+    logger.info(f"Computing CSD for {probe['name']} from {len(starts)} {event_name}")
+    window_sum, std_sum = accumulate_event_windows(lfp, starts, n_pre + n_post, block_samples)
+    # channels x samples
+    mean_lfp = (window_sum / len(starts)).T
+    clean = ((std_sum / len(starts)) <= parameters['noisy_channel_threshold']) & ~np.isin(channels, probe.get('reference_channels', []))
+    output['clean_channels'] = channels[clean].tolist()
+    if clean.sum() < 2:
+        logger.warning(f"{clean.sum()} clean channels on {probe['name']}: skipping CSD")
+        return output
+
+    b, a = butter(parameters['filter_order'], np.array(parameters['filter_cuts']) / (sampling_rate / 2), 'bandpass')
+    filtered_lfp = filtfilt(b, a, mean_lfp[clean], axis=1) * parameters['volts_per_bit']
+
+    locations = get_channel_locations(channels)
+    positions = locations[:, 1].astype(np.float64)
+    interpolated_lfp = get_interpolation_matrix(positions, clean) @ filtered_lfp
+    # mm, as in AllenSDK
+    spacing = np.mean(np.diff(positions)) / 1000
+    csd = get_second_spatial_derivative(interpolated_lfp, spacing, parameters['spatial_kernel'])
+
+    write_csd(probe['csd_output_path'], csd, np.arange(-n_pre, n_post) / sampling_rate, channels, locations,
+              event_name, len(starts))
+    output['csd_path'] = probe['csd_output_path']
+    return output
+
+def compute_csd(csd_dict:dict, event_times:np.ndarray, processes:Optional[int]=None, **kwargs) -> dict:
+    """
+    Run `compute_probe_csd` for each probe in `csd_dict['probes']`, in up to
+    `processes` worker processes (one per probe by default).
+    """
+    probes = csd_dict['probes']
+    if processes == 1 or len(probes) <= 1:
+        return {'probe_outputs': [compute_probe_csd(probe, event_times, **kwargs) for probe in probes]}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes or len(probes)) as executor:
+        futures = [executor.submit(compute_probe_csd, probe, event_times, **kwargs) for probe in probes]
+        return {'probe_outputs': [future.result() for future in futures]}
+
+def get_csd_input_dictionary(session:'np_session.Session', temporal_subsampling_factor:int=2,
+                             reference_channels:Sequence[int]=(191,)) -> dict:
+    """Subsampled LFP files (see `lfp_subsampling`) and CSD output path of each probe."""
+    from np_probes.align_barcode_timestamps import get_align_timestamps_output_dictionary
+
+    sdk_outputs_path = get_session_index(session)['sdk_outputs_path']
+    probes = []
+    for probe_information in get_align_timestamps_output_dictionary(session)['probe_outputs']:
+        name = probe_information['name']
+        probes.append({
+            'name': name,
+            'sampling_rate': probe_information['global_probe_lfp_sampling_rate'][0] / temporal_subsampling_factor,
+            'lfp_data_path': pathlib.Path(sdk_outputs_path, '{}_lfp.dat'.format(name)).as_posix(),
+            'lfp_timestamps_path': pathlib.Path(sdk_outputs_path, '{}_lfp_timestamps.npy'.format(name)).as_posix(),
+            'lfp_channel_info_path': pathlib.Path(sdk_outputs_path, '{}_lfp_channels.npy'.format(name)).as_posix(),
+            'csd_output_path': get_csd_path(session, name).as_posix(),
+            'reference_channels': list(reference_channels)
+        })
+
+    return {'probes': probes}
+
+@profiled('csd')
+def compute_session_csd(session:'np_session.Session', event_times:Optional[np.ndarray]=None,
+                        event_line:Optional[Union[int, str]]=None, processes:Optional[int]=None, **kwargs) -> dict:
+    """
+    Write `probeX_csd.h5` to `SDK_outputs` for every probe in the session, around
+    `event_times` (s, on the sync clock) or the rising edges of sync `event_line`
+    (see `sync.get_session_sync_line_edges`). Requires the subsampled LFP.
+    Probes whose CSD is written get it as `csd_path` in the probes dictionary.
+    """
+    if (event_times is None) == (event_line is None):
+        raise ValueError('Give one of event_times or event_line')
+    if event_line is not None:
+        from np_probes.sync import get_session_sync_line_edges
+        event_times = get_session_sync_line_edges(session, [event_line])[event_line][0]
+        kwargs.setdefault('event_name', str(event_line))
+
+    return compute_csd(get_csd_input_dictionary(session), event_times, processes=processes, **kwargs)
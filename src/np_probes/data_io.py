@@ -0,0 +1,160 @@
+import numpy as np
+import np_logging
+from hdmf.data_utils import GenericDataChunkIterator
+from pynwb import H5DataIO
+from np_probes.utils import NWB_BACKENDS, NWB_COMPRESSIONS, import_hdmf_zarr
+from typing import Optional, Union
+
+logger = np_logging.getLogger(__name__)
+
+
+class ArrayChunkIterator(GenericDataChunkIterator):
+    """
+    Iterate over an array-like (e.g. `np.memmap`) one buffer at a time, so
+    at most one buffer is held in memory while the dataset is written.
+
+    If `scale` is given, each buffer is cast to `dtype` and multiplied by it.
+
+    Memmaps are pickled as their file, not their data, so buffers can be
+    written by several processes (`save_nwb(..., backend='zarr', number_of_jobs=...)`).
+    """
+
+    def __init__(self, array, scale: Optional[float] = None, dtype=None, **kwargs):
+        self._array = array
+        self._scale = scale
+        self._output_dtype = np.dtype(dtype) if dtype is not None else np.dtype(array.dtype)
+        self._kwargs = kwargs
+        super().__init__(**kwargs)
+
+    def _to_dict(self) -> dict:
+        array = self._array
+        if isinstance(array, np.memmap) and array.filename is not None:
+            array = {'filename': array.filename, 'dtype': array.dtype.str, 'offset': array.offset, 'shape': array.shape,
+                     'order': 'F' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C'}
+        return {'array': array, 'scale': self._scale, 'dtype': self._output_dtype.str, **self._kwargs}
+
+    @classmethod
+    def _from_dict(cls, dictionary: dict) -> 'ArrayChunkIterator':
+        dictionary = dict(dictionary)
+        array = dictionary.pop('array')
+        if isinstance(array, dict):
+            array = np.memmap(array['filename'], dtype=array['dtype'], mode='r', offset=array['offset'], 
+                              shape=tuple(array['shape']), order=array['order'])
+        return cls(array, **dictionary)
+
+    def __reduce__(self):
+        return self._from_dict, (self._to_dict(),)
+
+    def _get_data(self, selection: tuple[slice, ...]) -> np.ndarray:
+        data = np.asarray(self._array[selection]).astype(self._output_dtype, copy=False)
+        if self._scale is not None:
+            data = data * self._output_dtype.type(self._scale)
+        return data
+
+    def _get_maxshape(self) -> tuple[int, ...]:
+        return self._array.shape
+
+    def _get_dtype(self) -> np.dtype:
+        return self._output_dtype
+
+
+def get_chunk_shape(shape: tuple[int, ...], itemsize: int, chunk_mb: float = 1.0) -> tuple[int, ...]:
+    """Chunks spanning all trailing dimensions, with as many rows as fit in `chunk_mb`."""
+    row_bytes = itemsize * int(np.prod(shape[1:], dtype=int))
+    rows = max(1, int(chunk_mb * 1e6 // row_bytes))
+    return (min(rows, shape[0]), *shape[1:])
+
+
+def get_buffer_shape(shape: tuple[int, ...], chunk_shape: tuple[int, ...], itemsize: int, buffer_gb: float) -> tuple[int, ...]:
+    """Buffers spanning all trailing dimensions, a whole number of chunks long."""
+    row_bytes = itemsize * int(np.prod(shape[1:], dtype=int))
+    chunks_per_buffer = max(1, int(buffer_gb * 1e9 // (row_bytes * chunk_shape[0])))
+    return (min(chunks_per_buffer * chunk_shape[0], shape[0]), *shape[1:])
+
+
+def get_compression_options(compression: Optional[str] = None, compression_opts=None) -> dict:
+    """
+    Keyword arguments for `H5DataIO` for `gzip`, `lzf` or `blosc` compression.
+
+    `blosc` requires `hdf5plugin`; gzip is used instead if it isn't installed.
+    """
+    if compression is None:
+        return {}
+    if compression in ('gzip', 'lzf'):
+        return {'compression': compression, 'compression_opts': compression_opts}
+    if compression == 'blosc':
+        try:
+            import hdf5plugin
+        except ImportError:
+            logger.warning('hdf5plugin is not installed: using gzip compression instead of blosc')
+            return {'compression': 'gzip'}
+        return {**hdf5plugin.Blosc(**(compression_opts or {})), 'allow_plugin_filters': True}
+    raise ValueError(f'Unknown compression {compression!r}: expected one of {", ".join(NWB_COMPRESSIONS["hdf5"])}')
+
+
+def get_zarr_compressor(compression: Optional[str] = None, compression_opts=None):
+    """`numcodecs` compressor for `ZarrDataIO` for `gzip`, `blosc` or `zstd` compression (False for none)."""
+    import numcodecs
+
+    if compression is None:
+        return False
+    if compression == 'gzip':
+        return numcodecs.GZip(level=compression_opts if compression_opts is not None else 4)
+    if compression == 'blosc':
+        return numcodecs.Blosc(**(compression_opts or {}))
+    if compression == 'zstd':
+        return numcodecs.Zstd(level=compression_opts if compression_opts is not None else 1)
+    raise ValueError(f'Unknown zarr compression {compression!r}: expected one of {", ".join(NWB_COMPRESSIONS["zarr"])}')
+
+
+def get_empty_data_io(array, dtype=None, backend: str = 'hdf5', compression: Optional[str] = None, compression_opts=None):
+    """
+    `get_data_io` for an array with no rows (e.g. the spikes of an empty units
+    table): nothing to stream, so the empty array is wrapped as it is, in
+    one-row chunks so rows can still be appended (see `utils.extend_table`).
+    """
+    data = np.empty(array.shape, dtype=dtype if dtype is not None else array.dtype)
+    chunk_shape = tuple(max(1, size) for size in (1, *array.shape[1:]))
+    if backend == 'zarr':
+        return import_hdmf_zarr().ZarrDataIO(data, chunks=chunk_shape, compressor=get_zarr_compressor(compression, compression_opts))
+    return H5DataIO(data, chunks=chunk_shape, maxshape=(None, *array.shape[1:]),
+                    **get_compression_options(compression, compression_opts))
+
+
+def get_data_io(
+    array,
+    chunk_shape: Optional[tuple[int, ...]] = None,
+    buffer_gb: float = 0.1,
+    compression: Optional[str] = None,
+    compression_opts: Optional[Union[int, dict]] = None,
+    scale: Optional[float] = None,
+    dtype=None,
+    backend: str = 'hdf5',
+):
+    """
+    Wrap `array` for streaming, chunked (and optionally compressed) writing.
+
+    Peak memory while writing is bounded by `buffer_gb`, regardless of the
+    size of `array`. Only the leading dimensions of `chunk_shape` are used if
+    it has more than `array`, and missing trailing dimensions span the array.
+
+    With `backend='zarr'`, returns a `ZarrDataIO` (for `save_nwb(..., backend='zarr')`),
+    with `compression` one of `gzip`, `blosc` or `zstd` (see `get_zarr_compressor`).
+    """
+    if backend not in NWB_BACKENDS:
+        raise ValueError(f'Unknown backend {backend!r}: expected one of {", ".join(NWB_BACKENDS)}')
+    if array.shape[0] == 0:
+        return get_empty_data_io(array, dtype, backend, compression, compression_opts)
+    itemsize = np.dtype(dtype if dtype is not None else array.dtype).itemsize
+    if chunk_shape is None:
+        chunk_shape = get_chunk_shape(array.shape, itemsize)
+    chunk_shape = tuple(chunk_shape[:array.ndim]) + tuple(array.shape[len(chunk_shape):])
+    chunk_shape = tuple(min(c, s) for c, s in zip(chunk_shape, array.shape))
+    buffer_shape = get_buffer_shape(array.shape, chunk_shape, itemsize, buffer_gb)
+
+    iterator = ArrayChunkIterator(array, scale=scale, dtype=dtype, chunk_shape=chunk_shape, buffer_shape=buffer_shape)
+    if backend == 'zarr':
+        return import_hdmf_zarr().ZarrDataIO(iterator, chunks=chunk_shape, compressor=get_zarr_compressor(compression, compression_opts))
+    # no row limit, so rows can be appended in place later (see `utils.extend_table`)
+    return H5DataIO(iterator, chunks=chunk_shape, maxshape=(None, *array.shape[1:]),
+                    **get_compression_options(compression, compression_opts))
@@ -0,0 +1,148 @@
+import pathlib
+import numpy as np
+import np_logging
+import concurrent.futures
+from typing import TYPE_CHECKING, Optional
+from np_probes.lfp_subsampling_json import get_lfp_subsampling_input_dictionary
+from np_probes.profiling import profiled
+
+if TYPE_CHECKING:
+    import np_session
+
+logger = np_logging.getLogger(__name__)
+
+# defaults of the AllenSDK `lfp_subsampling` module
+LFP_SUBSAMPLING_PARAMETERS = {
+    'temporal_subsampling_factor': 2,
+    'channel_stride': 4,
+    'surface_padding': 40,
+    'start_channel_offset': 2,
+    'cutoff_frequency': 0.1,
+    'filter_order': 1,
+    'remove_reference_channels': False,
+    'remove_channels_out_of_brain': False,
+}
+
+def select_channels(total_channels:int, surface_channel:int, surface_padding:int, start_channel_offset:int,
+                    channel_stride:int, reference_channels:np.ndarray, remove_reference_channels:bool) -> np.ndarray:
+    """Probe channel numbers to keep after spatial subsampling."""
+    max_channel = min(total_channels, surface_channel + surface_padding)
+    channels = np.arange(total_channels)[start_channel_offset:max_channel:channel_stride]
+    if remove_reference_channels:
+        channels = channels[np.isin(channels, reference_channels, invert=True)]
+
+    return channels
+
+def get_out_of_brain_channels(channels:np.ndarray, surface_channel:int, channel_max:int=384, channel_limit:int=380,
+                              max_out_of_brain_channels:int=50) -> np.ndarray:
+    """Indices into `channels` of the channels used as the noise reference."""
+    surface_channel = channel_limit if surface_channel >= channel_max else surface_channel
+    return np.where(channels > surface_channel)[0][:max_out_of_brain_channels]
+
+def subsample_block(lfp_raw:np.ndarray, subsampling_factor:int, sampling_rate:float, cutoff_frequency:float,
+                    filter_order:int, reference_index:np.ndarray) -> np.ndarray:
+    """
+    Decimate, high-pass filter and re-reference a (samples x channels) block,
+    truncating to int16 after each step as the AllenSDK module does.
+    """
+    from scipy.signal import decimate, butter, filtfilt
+
+    lfp = decimate(lfp_raw.astype(np.float64), subsampling_factor, ftype='iir', zero_phase=True, axis=0).astype(np.int16)
+
+    b, a = butter(filter_order, cutoff_frequency / (sampling_rate / subsampling_factor / 2), btype='high')
+    lfp = filtfilt(b, a, lfp, axis=0).astype(np.int16)
+
+    if len(reference_index) > 0:
+        lfp = (lfp - np.median(lfp[:, reference_index], axis=1, keepdims=True)).astype(np.int16)
+
+    return lfp
+
+def subsample_probe_lfp(probe:dict, total_channels:int=384, block_samples:int=125_000, pad_samples:int=25_000,
+                        **parameters) -> dict:
+    """
+    Temporally and spatially subsample one probe's `continuous.dat` in a single
+    pass, writing `probeX_lfp.dat`, `probeX_lfp_timestamps.npy` and
+    `probeX_lfp_channels.npy`.
+
+    `probe` has the fields of a probe in `lfp_subsampling_input.json`. The input
+    is memory-mapped and processed in blocks of `block_samples`, each filtered
+    with `pad_samples` of context on either side, so memory is bounded by the
+    block size. With the context, results differ from filtering the whole file
+    at once by at most a few bits.
+    """
+    parameters = {**LFP_SUBSAMPLING_PARAMETERS, **parameters}
+    factor = int(parameters['temporal_subsampling_factor'])
+    surface_channel = int(probe['surface_channel'])
+    block_samples = max(factor, block_samples // factor * factor)
+    pad_samples = pad_samples // factor * factor
+
+    timestamps = np.load(probe['lfp_timestamps_input_path'], mmap_mode='r')
+    lfp_raw = np.memmap(probe['lfp_input_file_path'], dtype=np.int16, mode='r')
+    if lfp_raw.size != timestamps.size * total_channels:
+        raise IOError('Expected {} samples x {} channels in {}, found {} values'.format(
+            timestamps.size, total_channels, probe['lfp_input_file_path'], lfp_raw.size))
+    lfp_raw = lfp_raw.reshape(-1, total_channels)
+
+    channels = select_channels(total_channels, surface_channel, parameters['surface_padding'], parameters['start_channel_offset'],
+                               parameters['channel_stride'], np.asarray(probe.get('reference_channels', [])),
+                               parameters['remove_reference_channels'])
+    reference_index = get_out_of_brain_channels(channels, surface_channel)
+    keep = channels < surface_channel + 10 if parameters['remove_channels_out_of_brain'] else np.ones(len(channels), dtype=bool)
+
+    n_samples = timestamps.size
+    timestamps_subsampled = np.lib.format.open_memmap(probe['lfp_timestamps_path'], mode='w+', dtype=timestamps.dtype,
+                                                      shape=(len(range(0, n_samples, factor)),))
+
+    logger.info(f"Subsampling LFP for {probe['name']}: {n_samples} samples in blocks of {block_samples}")
+    with open(probe['lfp_data_path'], 'wb') as f:
+        for start in range(0, n_samples, block_samples):
+            stop = min(start + block_samples, n_samples)
+            padded_start = max(0, start - pad_samples)
+            padded_stop = min(n_samples, stop + pad_samples)
+
+            lfp = subsample_block(lfp_raw[padded_start:padded_stop, channels], factor, probe['lfp_sampling_rate'],
+                                  parameters['cutoff_frequency'], parameters['filter_order'], reference_index)
+            first = (start - padded_start) // factor
+            n_out = len(range(start, stop, factor))
+            f.write(np.ascontiguousarray(lfp[first:first + n_out, keep]).tobytes())
+            timestamps_subsampled[start // factor:start // factor + n_out] = timestamps[start:stop:factor]
+
+    timestamps_subsampled.flush()
+    del timestamps_subsampled
+    np.save(probe['lfp_channel_info_path'], channels[keep])
+
+    return {
+        'name': probe['name'],
+        'lfp_data_path': probe['lfp_data_path'],
+        'lfp_timestamps_path': probe['lfp_timestamps_path'],
+        'lfp_channel_info_path': probe['lfp_channel_info_path']
+    }
+
+def subsample_lfp(lfp_dict:dict, processes:Optional[int]=None, **kwargs) -> dict:
+    """
+    Run `subsample_probe_lfp` for each probe in an `lfp_subsampling_input.json`
+    dictionary, in up to `processes` worker processes (one per probe by default).
+    """
+    parameters = {**lfp_dict.get('lfp_subsampling', {}), **kwargs}
+    probes = lfp_dict['probes']
+    if processes == 1 or len(probes) <= 1:
+        return {'probe_outputs': [subsample_probe_lfp(probe, **parameters) for probe in probes]}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes or len(probes)) as executor:
+        futures = [executor.submit(subsample_probe_lfp, probe, **parameters) for probe in probes]
+        return {'probe_outputs': [future.result() for future in futures]}
+
+@profiled('lfp_subsampling')
+def subsample_session_lfp(session:'np_session.Session', processes:Optional[int]=None, temporal_subsampling_factor:int=2,
+                          surface_channel:int=384, reference_channels=(191,), **kwargs) -> dict:
+    """
+    Write subsampled LFP for every probe in the session to `SDK_outputs`.
+    Requires the aligned LFP timestamps (`lfp_times_X_aligned.npy`).
+    """
+    lfp_dict = get_lfp_subsampling_input_dictionary(session, temporal_subsampling_factor, surface_channel, reference_channels)
+    return subsample_lfp(lfp_dict, processes=processes, **kwargs)
+
+if __name__ == '__main__':
+    import np_session
+    session = np_session.Session('DRpilot_626791_20220817')
+    subsample_session_lfp(session)
@@ -1,57 +1,68 @@
-import np_session
 import pathlib
 import re
-from np_probes.utils import get_probe_metrics_path
+from np_probes.session_index import get_session_index, get_probe_path
 import json
 import itertools
-from np_probes.align_barcode_timestamps import get_align_timestamps_output_dictionary
-from typing import Union
+from typing import TYPE_CHECKING, Union, Sequence
 
-def create_lfp_json(session: np_session.Session) -> Union[dict, None]:
-    if len(list(session.npexp_path.glob('*.h5'))) == 0:
-        return None
-    
-    #get_align_timestamps_output_dictionary(session)
+if TYPE_CHECKING:
+    import np_session
+
+LFP_PATH_KEYS = ('lfp_input_file_path', 'lfp_timestamps_input_path', 'lfp_data_path', 'lfp_timestamps_path', 'lfp_channel_info_path')
 
+def get_lfp_subsampling_input_dictionary(session: 'np_session.Session', temporal_subsampling_factor:int=2, 
+                                         surface_channel:int=384, reference_channels:Sequence[int]=(191,),
+                                         staged:bool=True) -> dict:
+    """With `staged`, `continuous.dat` is read from its local copy if staging is on."""
     lfp_dict:dict = {
         'lfp_subsampling':
-            {'temporal_subsampling_factor': 2}, 
+            {'temporal_subsampling_factor': temporal_subsampling_factor}, 
         'probes': []}
-    probe_metrics_path = get_probe_metrics_path(session)
-
-    if 'Data2' in str(session.npexp_path):
-        npexp_path = session.storage_dirs[1] / session.id
-    else:
-        npexp_path = session.npexp_path
-
-    if not pathlib.Path(npexp_path, 'SDK_outputs').exists():
-        pathlib.Path(npexp_path, 'SDK_outputs').mkdir()
+    session_index = get_session_index(session)
+    npexp_path = session_index['npexp_path']
     
-    for probe in probe_metrics_path:
-        spike_path = probe_metrics_path[probe].parent
-        lfp_path = spike_path.parent
-        lfp_path = list(npexp_path.glob('*/*/*/*/continuous/*{}-AP'.format(probe)))[0].parent
-
+    for probe in session_index['probes']:
         probe_dict = {
             "name": 'probe{}'.format(probe),
             "lfp_sampling_rate": 2500.0,
-            "lfp_input_file_path": list(lfp_path.glob('*{}-LFP/continuous.dat'.format(probe)))[0].as_posix()[1:],
-            "lfp_timestamps_input_path": pathlib.Path(npexp_path, 'SDK_outputs', 'lfp_times_{}_aligned.npy'.format(probe)).as_posix()[1:],
-            "lfp_data_path": pathlib.Path(npexp_path, 'SDK_outputs', 'probe{}_lfp.dat'.format(probe)).as_posix()[1:],
-            "lfp_timestamps_path": pathlib.Path(npexp_path, 'SDK_outputs', 'probe{}_lfp_timestamps.npy'.format(probe)).as_posix()[1:],
-            "lfp_channel_info_path": pathlib.Path(npexp_path, 'SDK_outputs', 'probe{}_lfp_channels.npy'.format(probe)).as_posix()[1:],
-            "surface_channel": 384.0,
-            "reference_channels": [
-                191
-            ] 
+            "lfp_input_file_path": get_probe_path(session, probe, 'lfp_continuous_path', staged=staged).as_posix(),
+            "lfp_timestamps_input_path": pathlib.Path(npexp_path, 'SDK_outputs', 'lfp_times_{}_aligned.npy'.format(probe)).as_posix(),
+            "lfp_data_path": pathlib.Path(npexp_path, 'SDK_outputs', 'probe{}_lfp.dat'.format(probe)).as_posix(),
+            "lfp_timestamps_path": pathlib.Path(npexp_path, 'SDK_outputs', 'probe{}_lfp_timestamps.npy'.format(probe)).as_posix(),
+            "lfp_channel_info_path": pathlib.Path(npexp_path, 'SDK_outputs', 'probe{}_lfp_channels.npy'.format(probe)).as_posix(),
+            "surface_channel": float(surface_channel),
+            "reference_channels": list(reference_channels)
         }
 
         lfp_dict['probes'].append(probe_dict)
 
-    with open(pathlib.Path(npexp_path, 'SDK_outputs', 'lfp_subsampling_input.json'), 'w') as f:
+    return lfp_dict
+
+def create_lfp_json(session: 'np_session.Session', temporal_subsampling_factor:int=2, 
+                    surface_channel:int=384, reference_channels:Sequence[int]=(191,)) -> Union[dict, None]:
+    """
+    Write `lfp_subsampling_input.json` for the AllenSDK `lfp_subsampling` module.
+
+    The leading `/` of `//allen/...` paths is removed for the module, which runs
+    with `/allen` mounted. `lfp_subsampling.subsample_session_lfp` does the same
+    work in-package, without the json.
+    """
+    if get_session_index(session)['sync_path'] is None:
+        return None
+    
+    #get_align_timestamps_output_dictionary(session)
+
+    lfp_dict = get_lfp_subsampling_input_dictionary(session, temporal_subsampling_factor, surface_channel, reference_channels,
+                                                    staged=False)
+    for probe_dict in lfp_dict['probes']:
+        for key in LFP_PATH_KEYS:
+            probe_dict[key] = probe_dict[key][1:]
+
+    with open(pathlib.Path(get_session_index(session)['sdk_outputs_path'], 'lfp_subsampling_input.json'), 'w') as f:
         json.dump(lfp_dict, f, indent=2)
 
     return lfp_dict
 
 if __name__ == '__main__':
+    import np_session
     session = np_session.Session()
\ No newline at end of file
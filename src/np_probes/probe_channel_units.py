@@ -1,11 +1,58 @@
-import np_session
 import pathlib
 import json
 import pandas as pd
-import SimpleITK as sitk
 import numpy as np
-from np_probes.utils import get_probe_metrics_path
+from np_probes.session_index import get_session_index, get_probe_path
+from np_probes.staging import stage_file
 import uuid
+import os
+import hashlib
+import tempfile
+import threading
+import np_logging
+from typing import TYPE_CHECKING, Union, Optional
+
+if TYPE_CHECKING:
+    import np_session
+
+logger = np_logging.getLogger(__name__)
+
+TISSUECYTE_PATH = pathlib.Path('//allen/programs/mindscope/workgroups/np-behavior/tissuecyte')
+CCF_ANNOTATION_PATH = pathlib.Path(TISSUECYTE_PATH, 'field_reference', 'ccf_ano.mhd')
+ANNOTATION_CACHE_DIR = pathlib.Path(os.environ.get('NP_PROBES_CACHE_DIR', pathlib.Path(tempfile.gettempdir(), 'np_probes')))
+
+_annotation_volumes: dict[str, np.ndarray] = {}
+_annotation_volumes_lock = threading.Lock()
+
+NP1_HORIZONTAL_POSITIONS = np.array([43, 11, 59, 27])
+
+# metrics.csv column -> unit field
+UNIT_METRICS_COLUMNS = {
+    'cluster_id': 'cluster_id',
+    'quality': 'quality',
+    'snr': 'snr',
+    'firing_rate': 'firing_rate',
+    'isi_viol': 'isi_violations',
+    'presence_ratio': 'presence_ratio',
+    'amplitude_cutoff': 'amplitude_cutoff',
+    'isolation_distance': 'isolation_distance',
+    'l_ratio': 'l_ratio',
+    'd_prime': 'd_prime',
+    'nn_hit_rate': 'nn_hit_rate',
+    'nn_miss_rate': 'nn_miss_rate',
+    'silhouette_score': 'silhouette_score',
+    'max_drift': 'max_drift',
+    'cumulative_drift': 'cumulative_drift',
+    'duration': 'waveform_duration',
+    'halfwidth': 'waveform_halfwidth',
+    'PT_ratio': 'PT_ratio',
+    'repolarization_slope': 'repolarization_slope',
+    'recovery_slope': 'recovery_slope',
+    'amplitude': 'amplitude',
+    'spread': 'spread',
+    'velocity_above': 'velocity_above',
+    'velocity_below': 'velocity_below',
+}
 
 def clean_region(region:str) -> str:
     if pd.isna(region):
@@ -13,178 +60,209 @@ def clean_region(region:str) -> str:
     else:
         return region
 
-def get_annotation_volume() -> np.ndarray:
-    ccf_annotation_array = sitk.GetArrayFromImage(sitk.ReadImage(pathlib.Path('//allen/programs/mindscope/workgroups/np-behavior/tissuecyte/', 
-                                                                              'field_reference', 'ccf_ano.mhd')))
+def get_annotation_source_files(annotation_path:pathlib.Path) -> list[pathlib.Path]:
+    """The `.mhd` header plus the raw data file it points to."""
+    source_files = [annotation_path]
+    for line in annotation_path.read_text().splitlines():
+        key, _, value = line.partition('=')
+        if key.strip() == 'ElementDataFile' and value.strip() != 'LOCAL':
+            source_files.append(annotation_path.parent / value.strip())
 
-    return ccf_annotation_array
+    return source_files
 
-def get_day(session:np_session.Session) -> str:
-    if 'Data2' in str(session.npexp_path):
-        npexp_path = session.storage_dirs[1] / session.id
-    else:
-        npexp_path = session.npexp_path
+def get_annotation_signature(annotation_path:pathlib.Path) -> dict:
+    return {
+        path.name: {'mtime': path.stat().st_mtime, 'size': path.stat().st_size}
+        for path in get_annotation_source_files(annotation_path)
+    }
+
+def get_local_annotation_volume(annotation_path:pathlib.Path, cache_dir:pathlib.Path) -> np.ndarray:
+    """
+    Memory-map a local `.npy` copy of the annotation volume, rebuilding it
+    from the source if the mtime or size of the source files has changed.
+
+    The copy is named after the source path and a hash of its signature, so
+    the volume and the signature it was built from are one file, replaced at once.
+    """
+    cache_prefix = 'ccf_ano_{}'.format(hashlib.sha1(annotation_path.as_posix().encode()).hexdigest()[:12])
+    signature = json.dumps(get_annotation_signature(annotation_path), sort_keys=True)
+    npy_path = pathlib.Path(cache_dir, '{}_{}.npy'.format(cache_prefix, hashlib.sha1(signature.encode()).hexdigest()[:12]))
+
+    if npy_path.exists():
+        return np.load(npy_path, mmap_mode='r')
+
+    import SimpleITK as sitk
 
-    session_directory = npexp_path.parent
-    sessions_mouse = sorted(list(session_directory.glob('DRpilot*{}*'.format(session.mouse))))
-    day = [i + 1 for i in range(len(sessions_mouse)) if str(session.id) in str(sessions_mouse[i])][0]
-    return str(day)
+    logger.info(f'Caching CCF annotation volume {annotation_path} to {npy_path}')
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    ccf_annotation_array = sitk.GetArrayFromImage(sitk.ReadImage(str(annotation_path)))
 
-def get_channels_info_for_probe(current_probe:str, probe_id:int, session:np_session.Session, id_json_dict:dict[str, list]) -> list:
-    channels = []
+    # write to a temporary file and rename so concurrent workers never see a partial copy
+    tmp_path = npy_path.with_name('{}.{}.tmp'.format(npy_path.name, uuid.uuid4().hex))
+    with open(tmp_path, 'wb') as f:
+        np.save(f, ccf_annotation_array)
+    os.replace(tmp_path, npy_path)
+    del ccf_annotation_array
 
+    # copies of earlier versions of the source (processes still mapping them keep their pages)
+    for stale_path in cache_dir.glob(cache_prefix + '*'):
+        if stale_path != npy_path and not stale_path.name.endswith('.tmp'):
+            stale_path.unlink(missing_ok=True)
+
+    return np.load(npy_path, mmap_mode='r')
+
+def get_annotation_volume(annotation_path:Union[str, pathlib.Path]=CCF_ANNOTATION_PATH,
+                          cache_dir:Union[str, pathlib.Path]=ANNOTATION_CACHE_DIR) -> np.ndarray:
     """
-    if len(id_json_dict['channel_ids']) > 0:
-        channel_id = id_json_dict['channel_ids'][-1] + 1
-    else:
-        channel_id = probe_id
+    CCF annotation volume (AP, DV, ML), read-only and memory-mapped.
+
+    The volume is loaded once per process; worker processes share the pages
+    of the local `.npy` copy through the OS cache.
+    """
+    annotation_path = pathlib.Path(annotation_path)
+    with _annotation_volumes_lock:
+        if annotation_path.as_posix() not in _annotation_volumes:
+            _annotation_volumes[annotation_path.as_posix()] = get_local_annotation_volume(annotation_path, pathlib.Path(cache_dir))
+
+        return _annotation_volumes[annotation_path.as_posix()]
+
+def get_tissuecyte_path() -> pathlib.Path:
+    """Directory with the warped channel coordinates, `NP_PROBES_TISSUECYTE_PATH` if set."""
+    return pathlib.Path(os.environ.get('NP_PROBES_TISSUECYTE_PATH', TISSUECYTE_PATH))
+
+def get_day(session:'np_session.Session') -> str:
+    return get_session_index(session)['day']
+
+def get_np1_channel_positions(n_channels:int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Horizontal and vertical positions (um) of Neuropixels 1.0 sites,
+    which are laid out in a checkerboard of two sites per 20 um row.
+    """
+    index = np.arange(n_channels)
+    horizontal_position = NP1_HORIZONTAL_POSITIONS[index % len(NP1_HORIZONTAL_POSITIONS)]
+    vertical_position = 20 + 20 * (index // 2)
+
+    return horizontal_position, vertical_position
+
+def get_channels_table_for_probe(current_probe:str, probe_id:int, session:'np_session.Session', 
+                                 annotation_path:Optional[Union[str, pathlib.Path]]=None,
+                                 first_id:Optional[int]=None) -> pd.DataFrame:
+    """
+    One row per channel, with the same fields as `get_channels_info_for_probe`.
+
+    The annotation volume is `field_reference/ccf_ano.mhd` in the tissuecyte
+    directory unless `annotation_path` is given. See `get_channels_table` for `first_id`.
     """
     # get channel dataframe
     mouse_id = str(session.mouse)
     probe = current_probe[-1]
     day = get_day(session)
+    tissuecyte_path = get_tissuecyte_path()
 
-    ccf_alignment_path = pathlib.Path('//allen/programs/mindscope/workgroups/np-behavior/tissuecyte', mouse_id, 
-                                             'Probe_{}_channels_{}_warped.csv'.format(probe+day, mouse_id))
+    ccf_alignment_path = pathlib.Path(tissuecyte_path, mouse_id, 'Probe_{}_channels_{}_warped.csv'.format(probe+day, mouse_id))
     if ccf_alignment_path.exists():
-        df_ccf_coords = pd.read_csv(ccf_alignment_path)
-
-        ccf_annotation_array = get_annotation_volume()
-
-        vertical_position = 20
-        horizontal_position_even = [43, 59]
-        horizontal_position = horizontal_position_even[0]
-        horizontal_position_even_index = 0
-        horizontal_position_odd = [11, 27]
-        horizontal_position_odd_index = 0
-
-        for index, row in df_ccf_coords.iterrows():
-            channel_id = str(uuid.uuid4())
-            if index != 0 and index % 2 == 0:
-                vertical_position += 20
-            
-            if index == 0:
-                horizontal_position = horizontal_position_even[0]
-            elif index == 1:
-                horizontal_position = horizontal_position_odd[0]
-            elif index != 0 and index % 2 == 0:
-                if horizontal_position_even_index == 0:
-                    horizontal_position_even_index = 1
-                    horizontal_position = horizontal_position_even[horizontal_position_even_index]
-                else:
-                    horizontal_position_even_index = 0
-                    horizontal_position = horizontal_position_even[horizontal_position_even_index]
-            elif index != 1 and index % 1 == 0:
-                if horizontal_position_odd_index == 0:
-                    horizontal_position_odd_index = 1
-                    horizontal_position = horizontal_position_odd[horizontal_position_odd_index]
-                else:
-                    horizontal_position_odd_index = 0
-                    horizontal_position = horizontal_position_odd[horizontal_position_odd_index]
-
-            channel_dict = {
-                'probe_id': probe_id,
-                'probe_channel_number': row.channel,
-                'structure_id': int(ccf_annotation_array[row.AP, row.DV, row.ML]),
-                'structure_acronym': clean_region(row.region),
-                'anterior_posterior_ccf_coordinate': float(row.AP*25),
-                'dorsal_ventral_ccf_coordinate': float(row.DV*25),
-                'left_right_ccf_coordinate': float(row.ML*25),
-                'probe_horizontal_position': horizontal_position,
-                'probe_vertical_position': vertical_position,
-                'id': row.channel + 1,
-                'valid_data': True
-            }
-
-            channels.append(channel_dict)
-            #id_json_dict['channel_ids'].append(channel_id)
-
-            #channel_id += 1
-    else:
-        for i in range(384):
-            channel_id = str(uuid.uuid4())
-            channel_dict = {
-                'probe_id': probe_id,
-                'probe_channel_number': i,
-                'structure_id': -1,
-                'structure_acronym': 'No Area',
-                'anterior_posterior_ccf_coordinate': -1.0,
-                'dorsal_ventral_ccf_coordinate': -1.0,
-                'left_right_ccf_coordinate': -1.0,
-                'probe_horizontal_position': -1,
-                'probe_vertical_position': -1,
-                'id': i + 1,
-                'valid_data': True
-            }
-            
-            channels.append(channel_dict)
-            #id_json_dict['channel_ids'].append(channel_id)
-
-            #channel_id += 1
-
-    return channels
-
-def get_units_info_for_probe(current_probe:str, probe_metrics_path:dict, session:np_session.Session, channels:list[dict], id_json_dict:dict):
-    #probe_metrics_csv_file = probe_metrics_path[current_probe[-1]]
-    if '626791' in str(session.id):
-        probe_metrics_csv_file = probe_metrics_path[current_probe[-1]]
-    else:
-        probe_metrics_csv_file = list(session.datajoint_path.glob('*{}*/*/*100*/metrics.csv'.format(current_probe[-1])))[0]
+        df_ccf_coords = pd.read_csv(stage_file(ccf_alignment_path))
+        if annotation_path is None:
+            annotation_path = pathlib.Path(tissuecyte_path, 'field_reference', 'ccf_ano.mhd')
+        ccf_annotation_array = get_annotation_volume(annotation_path)
+
+        return get_channels_table(probe_id, df_ccf_coords, ccf_annotation_array, first_id=first_id)
+
+    return get_channels_table(probe_id, first_id=first_id)
+
+def get_channels_table(probe_id:int, df_ccf_coords:Optional[pd.DataFrame]=None, 
+                       ccf_annotation_array:Optional[np.ndarray]=None, n_channels:int=384,
+                       first_id:Optional[int]=None) -> pd.DataFrame:
+    """
+    Channel table from warped CCF coordinates (`channel`, `AP`, `DV`, `ML`, `region`, 
+    in 25 um voxels), or placeholder values for `n_channels` channels if there are none.
+
+    Channel ids are the channel number + 1, or consecutive from `first_id`.
+    """
+    if df_ccf_coords is None:
+        channel_numbers = np.arange(n_channels)
+        return pd.DataFrame({
+            'probe_id': probe_id,
+            'probe_channel_number': channel_numbers,
+            'structure_id': -1,
+            'structure_acronym': 'No Area',
+            'anterior_posterior_ccf_coordinate': -1.0,
+            'dorsal_ventral_ccf_coordinate': -1.0,
+            'left_right_ccf_coordinate': -1.0,
+            'probe_horizontal_position': -1,
+            'probe_vertical_position': -1,
+            'id': channel_numbers + 1 if first_id is None else first_id + np.arange(n_channels),
+            'valid_data': True
+        })
+
+    ap = df_ccf_coords['AP'].to_numpy()
+    dv = df_ccf_coords['DV'].to_numpy()
+    ml = df_ccf_coords['ML'].to_numpy()
+    horizontal_position, vertical_position = get_np1_channel_positions(len(df_ccf_coords))
+
+    return pd.DataFrame({
+        'probe_id': probe_id,
+        'probe_channel_number': df_ccf_coords['channel'].to_numpy(),
+        'structure_id': np.asarray(ccf_annotation_array[ap, dv, ml]).astype(int),
+        'structure_acronym': df_ccf_coords['region'].where(df_ccf_coords['region'].notna(), 'No Area').to_numpy(),
+        'anterior_posterior_ccf_coordinate': (ap * 25).astype(float),
+        'dorsal_ventral_ccf_coordinate': (dv * 25).astype(float),
+        'left_right_ccf_coordinate': (ml * 25).astype(float),
+        'probe_horizontal_position': horizontal_position,
+        'probe_vertical_position': vertical_position,
+        'id': df_ccf_coords['channel'].to_numpy() + 1 if first_id is None else first_id + np.arange(len(df_ccf_coords)),
+        'valid_data': True
+    })
+
+def get_channels_info_for_probe(current_probe:str, probe_id:int, session:'np_session.Session', id_json_dict:dict[str, list]) -> list:
+    """Channel table as a list of dicts, as `Probes.from_json` expects."""
+    return get_channels_table_for_probe(current_probe, probe_id, session).to_dict('records')
+
+def get_units_table_for_probe(current_probe:str, session:'np_session.Session', 
+                              channels:Union[pd.DataFrame, list[dict]], first_id:Optional[int]=None,
+                              units_query:Optional[str]=None) -> pd.DataFrame:
+    """One row per unit in the probe's `metrics.csv`, with the same fields as `get_units_info_for_probe`."""
+    probe_metrics_csv_file = get_probe_path(session, current_probe, 'metrics_path')
     
     if '_test' in str(probe_metrics_csv_file):
-        df_metrics = pd.read_csv(probe_metrics_csv_file)
-        df_waveforms = pd.read_csv(pathlib.Path(probe_metrics_csv_file.parent, 'waveform_metrics.csv'))
+        df_metrics = pd.read_csv(stage_file(probe_metrics_csv_file))
+        df_waveforms = pd.read_csv(stage_file(pathlib.Path(probe_metrics_csv_file.parent, 'waveform_metrics.csv')))
         df_metrics = df_metrics.merge(df_waveforms, on='cluster_id')
     else:
-        df_metrics = pd.read_csv(probe_metrics_csv_file)
+        df_metrics = pd.read_csv(stage_file(probe_metrics_csv_file))
 
-    df_metrics.fillna(0, inplace=True)
+    return get_units_table(df_metrics, channels, first_id, units_query)
 
-    local_index = 0
-    
+def get_units_table(df_metrics:pd.DataFrame, channels:Union[pd.DataFrame, list[dict]],
+                    first_id:Optional[int]=None, units_query:Optional[str]=None) -> pd.DataFrame:
     """
-    if len(id_json_dict['unit_ids']) > 0:
-        unit_id = id_json_dict['unit_ids'][-1] + 1
-    else:
-        unit_id = 0
+    Unit table from Kilosort/ecephys `metrics.csv` columns, with NaN (and 
+    infinite snr) replaced by 0 and peak channels mapped to channel ids.
+
+    Unit ids are random UUID strings, or consecutive integers from `first_id`.
+
+    `units_query` selects units with a `DataFrame.query` expression on the unit
+    fields, e.g. `quality == 'good' and isi_violations < 0.5 and snr > 1`, before
+    ids are assigned: the spikes of other clusters are then never read.
     """
-    units = []
-    
-    for index, row in df_metrics.iterrows():
-        unit_id = str(uuid.uuid4())
-        unit_dict = {
-            'peak_channel_id': channels[row.peak_channel]['id'],
-            'cluster_id': row.cluster_id,
-            'quality': row.quality if 'quality' in df_metrics.columns else 'good',
-            'snr': row.snr if not pd.isna(row.snr) and not np.isinf(row.snr) else 0,
-            'firing_rate': row.firing_rate if not pd.isna(row.firing_rate) else 0,
-            'isi_violations': row.isi_viol if not pd.isna(row.isi_viol) else 0,
-            'presence_ratio': row.presence_ratio if not pd.isna(row.presence_ratio) else 0,
-            'amplitude_cutoff': row.amplitude_cutoff if not pd.isna(row.amplitude_cutoff) else 0,
-            'isolation_distance': row.isolation_distance if not pd.isna(row.isolation_distance) else 0,
-            'l_ratio': row.l_ratio if not pd.isna(row.l_ratio) else 0,
-            'd_prime': row.d_prime if not pd.isna(row.d_prime) else 0,
-            'nn_hit_rate': row.nn_hit_rate if not pd.isna(row.nn_hit_rate) else 0,
-            'nn_miss_rate': row.nn_miss_rate if not pd.isna(row.nn_miss_rate) else 0,
-            'silhouette_score': row.silhouette_score if not pd.isna(row.silhouette_score) else 0,
-            'max_drift': row.max_drift if not pd.isna(row.max_drift) else 0,
-            'cumulative_drift': row.cumulative_drift if not pd.isna(row.cumulative_drift) else 0,
-            'waveform_duration': row.duration if not pd.isna(row.duration) else 0,
-            'waveform_halfwidth': row.halfwidth if not pd.isna(row.halfwidth) else 0,
-            'PT_ratio': row.PT_ratio if not pd.isna(row.PT_ratio) else 0,
-            'repolarization_slope': row.repolarization_slope if not pd.isna(row.repolarization_slope) else 0,
-            'recovery_slope': row.recovery_slope if not pd.isna(row.recovery_slope) else 0,
-            'amplitude': row.amplitude if not pd.isna(row.amplitude) else 0,
-            'spread': row.spread if not pd.isna(row.spread) else 0,
-            'velocity_above': row.velocity_above if not pd.isna(row.velocity_above) else 0,
-            'velocity_below': row.velocity_below if not pd.isna(row.velocity_below) else 0,
-            'local_index': channels[row.peak_channel]['probe_id'],
-            'id': unit_id
-        }
-
-        #id_json_dict['unit_ids'].append(unit_id)
-        units.append(unit_dict)
-        local_index += 1
-        #unit_id += 1
-
-    return units
\ No newline at end of file
+    df_metrics = df_metrics.fillna(0)
+    if 'quality' not in df_metrics.columns:
+        df_metrics['quality'] = 'good'
+
+    channels = pd.DataFrame(channels)
+    peak_channels = df_metrics['peak_channel'].to_numpy(dtype=int)
+
+    units = df_metrics[list(UNIT_METRICS_COLUMNS)].rename(columns=UNIT_METRICS_COLUMNS)
+    units['snr'] = units['snr'].replace([np.inf, -np.inf], 0)
+    units.insert(0, 'peak_channel_id', channels['id'].to_numpy()[peak_channels])
+    units['local_index'] = channels['probe_id'].to_numpy()[peak_channels]
+    if units_query is not None:
+        units = units.query(units_query).reset_index(drop=True)
+    units['id'] = [str(uuid.uuid4()) for _ in range(len(units))] if first_id is None else first_id + np.arange(len(units))
+
+    return units.reset_index(drop=True)
+
+def get_units_info_for_probe(current_probe:str, session:'np_session.Session', channels:list[dict], id_json_dict:dict,
+                             units_query:Optional[str]=None):
+    """Unit table as a list of dicts, as `Probes.from_json` expects."""
+    return get_units_table_for_probe(current_probe, session, channels, units_query=units_query).to_dict('records')
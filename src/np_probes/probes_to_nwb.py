@@ -5,30 +5,81 @@ import numpy as np
 import pandas as pd
 from np_probes.probe_channel_units import get_channels_info_for_probe
 from np_probes.probe_channel_units import get_units_info_for_probe
-from np_probes.utils import get_probe_metrics_path
+from np_probes.probe_channel_units import get_channels_table_for_probe, get_units_table_for_probe
+from np_probes.session_index import get_session_index, get_probe_path
 from np_probes.align_barcode_timestamps import get_align_timestamps_output_dictionary
-from allensdk.brain_observatory.ecephys.probes import Probes
-from allensdk.brain_observatory.ecephys._probe import Probe
-from allensdk.brain_observatory.ecephys._lfp import LFP
 import pynwb
 import uuid
-from typing import Union, Optional
-from np_probes.utils import init_nwb, load_nwb, save_nwb
+from typing import TYPE_CHECKING, Union, Optional, Iterator, Callable
+from np_probes.utils import init_nwb, load_nwb, save_nwb, get_nwb_size, is_zarr_nwb, import_hdmf_zarr, NWB_SUFFIXES
+from np_probes.utils import check_extendable, extend_table
 import datetime
+import tempfile
+import shutil
+import contextlib
+import time
+import concurrent.futures
 from np_probes.lfp_subsampling_json import create_lfp_json
+from np_probes.data_io import get_data_io
 from collections.abc import Iterable
+from np_probes.profiling import profile_stage, profiled
+from np_probes.staging import stage_file, pin_staged_files
+from np_probes.csd import get_csd_path
 
+if TYPE_CHECKING:
+    from allensdk.brain_observatory.ecephys.probes import Probes
+    from allensdk.brain_observatory.ecephys._probe import Probe
+    from allensdk.brain_observatory.ecephys._lfp import LFP
 
-def generate_probe_dictionary(session:np_session.Session, current_probe:str, probe_metrics_path:dict[str, pathlib.Path],
-                              align_timestamps_probe_outputs:dict) -> dict:
-    #ap_path = probe_metrics_path[current_probe[-1]].parent
-    if '626791' in str(session.id):
-        ap_path = probe_metrics_path[current_probe[-1]].parent
-    else:
-        ap_path = list(session.datajoint_path.glob('*{}*/*/*100*/metrics.csv'.format(current_probe[-1])))[0].parent
+# converts raw LFP samples to volts (bits -> uV -> V), as in `LFP.from_json`
+LFP_AMPLITUDE_SCALE_FACTOR = 0.195e-6
+# converts raw spike amplitudes to volts, as in `Units.from_json`
+SPIKE_AMPLITUDE_SCALE_FACTOR = 0.195e-6
+SPIKE_CHUNK_SIZE = 10_000_000
+# columns written through `data_io.get_data_io` with `units_data_io_options`
+UNITS_DATA_IO_COLUMNS = ('spike_times', 'spike_amplitudes')
+TEMPLATE_BLOCK_SIZE = 64
+# unit columns of `Probes.get_units_table`, in its order (`quality` is dropped, and `Unit` has no `waveform_halfwidth`)
+UNITS_TABLE_COLUMNS = ('PT_ratio', 'amplitude', 'amplitude_cutoff', 'cluster_id', 'cumulative_drift', 'd_prime', 'firing_rate',
+                       'isi_violations', 'isolation_distance', 'l_ratio', 'max_drift', 'nn_hit_rate', 'nn_miss_rate',
+                       'peak_channel_id', 'presence_ratio', 'recovery_slope', 'repolarization_slope', 'silhouette_score',
+                       'snr', 'spread', 'velocity_above', 'velocity_below', 'waveform_duration')
+# default of AllenSDK `Channel`
+ELECTRODE_FILTERING = 'AP band: 500 Hz high-pass; LFP band: 1000 Hz low-pass'
+
+def get_probe_fields(session:np_session.Session, current_probe:str, probe_id:Union[str, int], probe_information:dict) -> dict:
+    """Fields of a probes dictionary entry other than `channels` and `units`."""
+    ap_path = get_probe_path(session, current_probe, 'ap_path')
+    npexp_path = get_session_index(session)['npexp_path']
+    csd_path = get_csd_path(session, current_probe)
+
+    return {
+        'name': current_probe,
+        'sampling_rate': probe_information['global_probe_sampling_rate'][0],
+        'temporal_subsampling_factor': 2,
+        'lfp_sampling_rate': probe_information['global_probe_lfp_sampling_rate'][0],
+
+        # written by `csd.compute_session_csd`
+        'csd_path': csd_path.as_posix() if csd_path.exists() else None,
+
+        'lfp': None,
+
+        'id': probe_id,
+
+        'inverse_whitening_matrix_path': stage_file(pathlib.Path(ap_path, 'whitening_mat_inv.npy')).as_posix(),
+        'mean_waveforms_path': stage_file(pathlib.Path(ap_path, 'mean_waveforms.npy')).as_posix(),
+        'spike_amplitudes_path': stage_file(pathlib.Path(ap_path, 'amplitudes.npy')).as_posix(),
+        'spike_clusters_file': stage_file(pathlib.Path(ap_path, 'spike_clusters.npy')).as_posix(),
+        'spike_templates_path': stage_file(pathlib.Path(ap_path, 'spike_templates.npy')).as_posix(),
+        'templates_path': stage_file(pathlib.Path(ap_path, 'templates.npy')).as_posix(),
+        'spike_times_path': pathlib.Path(npexp_path, 'SDK_outputs', 'spike_times_{}_aligned.npy'.format(current_probe[-1])).as_posix()
+    }
+
+def generate_probe_dictionary(session:np_session.Session, current_probe:str, align_timestamps_probe_outputs:dict,
+                              units_query:Optional[str]=None, probe_id:Optional[str]=None) -> dict:
     id_json_dict = None
     
-    probe_id = str(uuid.uuid4())
+    probe_id = probe_id if probe_id is not None else str(uuid.uuid4())
     # unique ids for probe, channel, and units
     """
     id_json_path = pathlib.Path('//allen/programs/mindscope/workgroups/dynamicrouting', 'dynamic_routing_unique_ids.json')
@@ -43,38 +94,16 @@ def generate_probe_dictionary(session:np_session.Session, current_probe:str, pro
         id_json_dict = {'probe_ids': [], 'channel_ids': [], 'unit_ids': []}
     """
 
-    if 'Data2' in str(session.npexp_path):
-        npexp_path = session.storage_dirs[1] / session.id
-    else:
-        npexp_path = session.npexp_path
-    
     probe_information = [probe_info for probe_info in align_timestamps_probe_outputs if probe_info['name'] == current_probe][0]
-    probe_dict = {
-        'name': current_probe,
-        'sampling_rate': probe_information['global_probe_sampling_rate'][0],
-        'temporal_subsampling_factor': 2,
-        'lfp_sampling_rate': probe_information['global_probe_lfp_sampling_rate'][0],
-
-        'csd_path': None,
-
-        'lfp': None,
-
-        'id': probe_id,
-
-        'inverse_whitening_matrix_path': pathlib.Path(ap_path, 'whitening_mat_inv.npy').as_posix(),
-        'mean_waveforms_path': pathlib.Path(ap_path, 'mean_waveforms.npy').as_posix(),
-        'spike_amplitudes_path': pathlib.Path(ap_path, 'amplitudes.npy').as_posix(),
-        'spike_clusters_file': pathlib.Path(ap_path, 'spike_clusters.npy').as_posix(),
-        'spike_templates_path': pathlib.Path(ap_path, 'spike_templates.npy').as_posix(),
-        'templates_path': pathlib.Path(ap_path, 'templates.npy').as_posix(),
-        'spike_times_path': pathlib.Path(npexp_path, 'SDK_outputs', 'spike_times_{}_aligned.npy'.format(current_probe[-1])).as_posix()
-    }
+    probe_dict = get_probe_fields(session, current_probe, probe_id, probe_information)
 
     #id_json_dict['probe_ids'].append(probe_id)
 
-    channels = get_channels_info_for_probe(current_probe, probe_id, session=session, id_json_dict=id_json_dict)
+    with profile_stage('get_channels_info_for_probe', probe=current_probe):
+        channels = get_channels_info_for_probe(current_probe, probe_id, session=session, id_json_dict=id_json_dict)
     probe_dict['channels'] = channels
-    units = get_units_info_for_probe(current_probe, probe_metrics_path, session, channels, id_json_dict)
+    with profile_stage('get_units_info_for_probe', probe=current_probe):
+        units = get_units_info_for_probe(current_probe, session, channels, id_json_dict, units_query)
     probe_dict['units'] = units
     
     """
@@ -83,45 +112,143 @@ def generate_probe_dictionary(session:np_session.Session, current_probe:str, pro
     """
     return probe_dict
 
-def generate_probes_dictionary(session:np_session.Session) -> tuple[dict, dict]:
+def generate_probes_dictionary(session:np_session.Session, units_query:Optional[str]=None,
+                               probe_ids:Optional[dict[str, str]]=None) -> tuple[dict, dict]:
+    """
+    Probes dictionary for `Probes.from_json`, and the alignment output.
+
+    `units_query` (e.g. `quality == 'good'`) selects the units included, before
+    any spike data is read (see `probe_channel_units.get_units_table`).
+
+    Probe ids are new UUIDs, except those given in `probe_ids` by probe name
+    (e.g. to match files written from an earlier dictionary).
+    """
     align_timestamps_output_dictionary = get_align_timestamps_output_dictionary(session)
     align_timestamps_probe_outputs = align_timestamps_output_dictionary['probe_outputs']
 
     probes_dictionary: dict[str, list] = {'probes': []}
-    probe_metrics_path = get_probe_metrics_path(session)
-
-    for probe in probe_metrics_path:
+    for probe in get_session_index(session)['probes']:
         current_probe = 'probe' + probe
-        probe_dictionary = generate_probe_dictionary(session, current_probe, probe_metrics_path, align_timestamps_probe_outputs)
+        probe_dictionary = generate_probe_dictionary(session, current_probe, align_timestamps_probe_outputs, units_query,
+                                                     (probe_ids or {}).get(current_probe))
         probes_dictionary['probes'].append(probe_dictionary)
     
     return probes_dictionary, align_timestamps_output_dictionary
 
-def add_lfp_to_object(session:np_session.Session, probes_object:Probes, align_timestamps_probe_outputs:dict) -> Probes:
+def generate_probe_tables(session:np_session.Session, units_query:Optional[str]=None) -> tuple[dict[str, pd.DataFrame], dict]:
+    """
+    Columnar equivalent of `generate_probes_dictionary`: `probes` (the fields
+    of `get_probe_fields`), `channels` and `units` DataFrames for all probes of
+    the session.
+
+    Ids are integers assigned in bulk, consecutive across the session: probes,
+    channels and units are each numbered from 0, so channel and unit ids are
+    unique in the session (unlike `channel number + 1`). `units_query` selects
+    units as for `generate_probes_dictionary`.
+    """
+    align_timestamps_output_dictionary = get_align_timestamps_output_dictionary(session)
+    probe_outputs = {probe_info['name']: probe_info for probe_info in align_timestamps_output_dictionary['probe_outputs']}
+
+    probes, channels, units = [], [], []
+    n_channels = n_units = 0
+    for probe_id, probe in enumerate(get_session_index(session)['probes']):
+        current_probe = 'probe' + probe
+        probes.append(get_probe_fields(session, current_probe, probe_id, probe_outputs[current_probe]))
+        with profile_stage('get_channels_table_for_probe', probe=current_probe):
+            probe_channels = get_channels_table_for_probe(current_probe, probe_id, session, first_id=n_channels)
+        with profile_stage('get_units_table_for_probe', probe=current_probe):
+            probe_units = get_units_table_for_probe(current_probe, session, probe_channels, first_id=n_units, units_query=units_query)
+        n_channels += len(probe_channels)
+        n_units += len(probe_units)
+        channels.append(probe_channels)
+        units.append(probe_units)
+
+    probe_tables = {
+        'probes': pd.DataFrame(probes),
+        'channels': pd.concat(channels, ignore_index=True),
+        'units': pd.concat(units, ignore_index=True),
+    }
+    return probe_tables, align_timestamps_output_dictionary
+
+def select_probe_tables(probe_tables:dict[str, pd.DataFrame], probe_names:Iterable[str]) -> dict[str, pd.DataFrame]:
+    """Rows of `generate_probe_tables` for the probes in `probe_names` (e.g. `['probeA']`)."""
+    probes = probe_tables['probes'][probe_tables['probes']['name'].isin(list(probe_names))].reset_index(drop=True)
+    return {
+        'probes': probes,
+        'channels': probe_tables['channels'][probe_tables['channels']['probe_id'].isin(probes['id'])].reset_index(drop=True),
+        'units': probe_tables['units'][probe_tables['units']['local_index'].isin(probes['id'])].reset_index(drop=True),
+    }
+
+def get_probes_dictionary_from_tables(probe_tables:dict[str, pd.DataFrame]) -> dict:
+    """
+    Probes dictionary for `export_lfp_nwbs` and `add_ragged_spike_data_to_units`, 
+    with each probe's `channels` and `units` as slices of the tables.
+    """
+    channels = probe_tables['channels'].groupby('probe_id', sort=False)
+    units = probe_tables['units'].groupby('local_index', sort=False)
+    probes = []
+    for probe in probe_tables['probes'].to_dict('records'):
+        probe['channels'] = channels.get_group(probe['id']) if probe['id'] in channels.groups else probe_tables['channels'].iloc[:0]
+        probe['units'] = units.get_group(probe['id']) if probe['id'] in units.groups else probe_tables['units'].iloc[:0]
+        probes.append(probe)
+
+    return {'probes': probes}
+
+def get_lfp_paths(session:np_session.Session, current_probe:str) -> dict[str, pathlib.Path]:
+    npexp_path = get_session_index(session)['npexp_path']
+
+    return {
+        'input_data_path': pathlib.Path(npexp_path, 'SDK_outputs', '{}_lfp.dat'.format(current_probe)).as_posix(),
+        'input_timestamps_path': pathlib.Path(npexp_path, 'SDK_outputs', '{}_lfp_timestamps.npy'.format(current_probe)).as_posix(),
+        'input_channels_path': pathlib.Path(npexp_path, 'SDK_outputs', '{}_lfp_channels.npy'.format(current_probe)),
+        'output_path': pathlib.Path(npexp_path, 'SDK_outputs', '{}_{}_{}_lfp.nwb'.format(str(session.id), current_probe, '061123'))
+    }
+
+def get_memmapped_lfp(lfp_paths:dict, sampling_rate:float) -> 'LFP':
+    """
+    `LFP` backed by the raw int16 samples in `probeX_lfp.dat`, without loading
+    or scaling them (see `add_lfp_to_nwb`).
+    """
+    from allensdk.brain_observatory.ecephys._lfp import LFP
+
+    channels = np.load(lfp_paths['input_channels_path'], allow_pickle=False)
+    data = np.memmap(lfp_paths['input_data_path'], dtype=np.int16, mode='r').reshape(-1, len(channels))
+    timestamps = np.load(lfp_paths['input_timestamps_path'], mmap_mode='r')
+
+    return LFP(data=data, timestamps=timestamps, channels=channels, sampling_rate=sampling_rate)
+
+def add_lfp_to_object(session:np_session.Session, probes_object:'Probes', align_timestamps_probe_outputs:dict,
+                      memmap:bool=False) -> 'Probes':
+    from allensdk.brain_observatory.ecephys._lfp import LFP
+    from allensdk.brain_observatory.ecephys._current_source_density import CurrentSourceDensity
+
     for probe_object in probes_object.probes:
         current_probe = probe_object.name
         probe_information = [probe_info for probe_info in align_timestamps_probe_outputs if probe_info['name'] == current_probe][0]
 
-        if 'Data2' in str(session.npexp_path):
-            npexp_path = session.storage_dirs[1] / session.id
-        else:
-            npexp_path = session.npexp_path
-
         probe_meta = {
-            'lfp': {
-                'input_data_path': pathlib.Path(npexp_path, 'SDK_outputs', '{}_lfp.dat'.format(current_probe)).as_posix(),
-                'input_timestamps_path': pathlib.Path(npexp_path, 'SDK_outputs', '{}_lfp_timestamps.npy'.format(current_probe)).as_posix(),
-                'input_channels_path': pathlib.Path(npexp_path, 'SDK_outputs', '{}_lfp_channels.npy'.format(current_probe)),
-                'output_path': pathlib.Path(npexp_path, 'SDK_outputs', '{}_{}_{}_lfp.nwb'.format(str(session.id), current_probe, '061123'))
-            },
+            'lfp': get_lfp_paths(session, current_probe),
             'lfp_sampling_rate': probe_information['global_probe_lfp_sampling_rate'][0],
             'temporal_subsampling_factor': 2.0
         }
-        probe_object._lfp = LFP.from_json(probe_meta)
+        if memmap:
+            probe_object._lfp = get_memmapped_lfp(probe_meta['lfp'], 
+                                                  probe_meta['lfp_sampling_rate'] / probe_meta['temporal_subsampling_factor'])
+        else:
+            probe_object._lfp = LFP.from_json(probe_meta)
+        if get_csd_path(session, current_probe).exists():
+            probe_object._current_source_density = CurrentSourceDensity.from_json({'csd_path': get_csd_path(session, current_probe)})
     
     return probes_object
 
-def add_lfp_to_nwb(probe: Probe, session_id: str, session_start_time, main_nwb:pynwb.NWBFile) -> pynwb.NWBFile:
+def add_lfp_to_nwb(probe: 'Probe', session_id: str, session_start_time, main_nwb:Optional[pynwb.NWBFile]=None,
+                   data_io_options:Optional[dict]=None) -> pynwb.NWBFile:
+    """
+    If `data_io_options` is given (keyword arguments for `data_io.get_data_io`, 
+    e.g. `chunk_shape`, `buffer_gb`, `compression`), LFP data and timestamps are 
+    streamed to disk in chunks when the file is written, instead of being held 
+    in memory. Raw int16 samples are scaled to volts as in `LFP.from_json`.
+    """
     nwbfile = pynwb.NWBFile(
         session_description='LFP data and associated info for one probe',
         identifier=f"{probe._id}",
@@ -143,10 +270,17 @@ def add_lfp_to_nwb(probe: Probe, session_id: str, session_start_time, main_nwb:p
         description=f"lfp channels on probe {probe._name}"
     )
 
+    lfp_data = probe._lfp.data
+    lfp_timestamps = probe._lfp.timestamps
+    if data_io_options is not None:
+        scale = LFP_AMPLITUDE_SCALE_FACTOR if np.issubdtype(lfp_data.dtype, np.integer) else None
+        lfp_data = get_data_io(lfp_data, scale=scale, dtype=np.float32, **data_io_options)
+        lfp_timestamps = get_data_io(lfp_timestamps, **data_io_options)
+
     electrial_series = lfp_nwb.create_electrical_series(
         name=f"{session_id}_{probe._name}_lfp_data",
-        data=probe._lfp.data,
-        timestamps=probe._lfp.timestamps,
+        data=lfp_data,
+        timestamps=lfp_timestamps,
         electrodes=electrode_table_region
     )
 
@@ -169,6 +303,121 @@ def add_lfp_to_nwb(probe: Probe, session_id: str, session_start_time, main_nwb:p
 
     return nwbfile
 
+def get_lfp_probe(probe_dict:dict, lfp_paths:dict, lfp_sampling_rate:float) -> 'Probe':
+    """
+    `Probe` with the channels of a probes dictionary entry, memory-mapped LFP
+    and the CSD at `csd_path`, if any, but no units: all `add_lfp_to_nwb` needs.
+    """
+    from allensdk.brain_observatory.ecephys._probe import Probe
+    from allensdk.brain_observatory.ecephys._channels import Channels
+    from allensdk.brain_observatory.ecephys._units import Units
+    from allensdk.brain_observatory.ecephys._current_source_density import CurrentSourceDensity
+
+    temporal_subsampling_factor = probe_dict['temporal_subsampling_factor']
+    channels = probe_dict['channels']
+    if isinstance(channels, pd.DataFrame):
+        channels = channels.to_dict('records')
+    return Probe(
+        id=str(probe_dict['id']),
+        name=probe_dict['name'],
+        channels=Channels.from_json(channels=channels),
+        units=Units(units=[]),
+        sampling_rate=probe_dict['sampling_rate'],
+        lfp=get_memmapped_lfp(lfp_paths, lfp_sampling_rate / temporal_subsampling_factor),
+        current_source_density=CurrentSourceDensity.from_json(probe_dict) if probe_dict.get('csd_path') else None,
+        temporal_subsampling_factor=temporal_subsampling_factor
+    )
+
+def write_lfp_nwb(probe_dict:dict, lfp_paths:dict, lfp_sampling_rate:float, session_id:str, session_start_time,
+                  output_path:Union[str, pathlib.Path], data_io_options:Optional[dict]=None, backend:str='hdf5',
+                  write_jobs:int=1, io_lock=None) -> dict:
+    """
+    Stream one probe's LFP to its own NWB file, returning the path and stats of
+    the file. `io_lock` (e.g. a semaphore shared by a batch) is held while it is written.
+    """
+    start_time = time.perf_counter()
+    probe = get_lfp_probe(probe_dict, lfp_paths, lfp_sampling_rate)
+    lfp_nwb = add_lfp_to_nwb(probe, session_id, session_start_time, None, 
+                             data_io_options={**(data_io_options or {}), 'backend': backend})
+    with io_lock if io_lock is not None else contextlib.nullcontext():
+        save_nwb(lfp_nwb, output_path, backend=backend, number_of_jobs=write_jobs)
+
+    return {
+        'name': probe_dict['name'],
+        'path': pathlib.Path(output_path).as_posix(),
+        'size_bytes': get_nwb_size(output_path),
+        'n_samples': probe._lfp.data.shape[0],
+        'n_channels': probe._lfp.data.shape[1],
+        'seconds': time.perf_counter() - start_time
+    }
+
+@profiled()
+def export_lfp_nwbs(session:np_session.Session, probes_dictionary:dict, align_timestamps_probe_outputs:list[dict],
+                    output_dir:Optional[Union[str, pathlib.Path]]=None, processes:Optional[int]=None,
+                    data_io_options:Optional[dict]=None, probe_names:Optional[list[str]]=None,
+                    backend:str='hdf5', write_jobs:int=1,
+                    io_lock=None, on_written:Optional[Callable[[str, dict], None]]=None) -> dict[str, dict]:
+    """
+    Write `{session}_{probe}_lfp.nwb` for each probe (or those in `probe_names`)
+    to `output_dir` (`SDK_outputs` by default), one probe per worker process with
+    up to `processes` workers (one per probe by default). Each worker streams
+    its probe's LFP from disk (see `add_lfp_to_nwb`).
+
+    With `backend='zarr'`, each file is an NWB-Zarr directory (`.nwb.zarr`),
+    whose LFP chunks are written by `write_jobs` processes per probe (see
+    `utils.save_nwb`); `data_io_options` then takes zarr compressors.
+
+    `io_lock` is held while each file is written (see `write_lfp_nwb`), not for
+    the whole export. `on_written` is called with the name and stats of each
+    probe as soon as its file is written (e.g. to checkpoint it), so probes that
+    finish are kept even if another fails; the first failure is raised once
+    every probe is done.
+
+    Returns the path and stats of each file by probe name.
+    """
+    output_dir = pathlib.Path(output_dir if output_dir is not None else get_session_index(session)['sdk_outputs_path'])
+    probe_dicts = [probe_dict for probe_dict in probes_dictionary['probes'] if probe_names is None or probe_dict['name'] in probe_names]
+
+    jobs = []
+    for probe_dict in probe_dicts:
+        probe_information = [probe_info for probe_info in align_timestamps_probe_outputs if probe_info['name'] == probe_dict['name']][0]
+        jobs.append({
+            'probe_dict': {key: probe_dict[key] for key in ('id', 'name', 'channels', 'sampling_rate', 'temporal_subsampling_factor', 'csd_path')},
+            'lfp_paths': get_lfp_paths(session, probe_dict['name']),
+            'lfp_sampling_rate': probe_information['global_probe_lfp_sampling_rate'][0],
+            'session_id': str(session.id),
+            'session_start_time': session.start,
+            'output_path': pathlib.Path(output_dir, '{}_{}_lfp{}'.format(session.id, probe_dict['name'], NWB_SUFFIXES[backend])),
+            'data_io_options': data_io_options,
+            'backend': backend,
+            'write_jobs': write_jobs,
+            'io_lock': io_lock
+        })
+
+    lfp_stats = {}
+    def add_stats(name:str, stats:dict) -> None:
+        lfp_stats[name] = stats
+        if on_written is not None:
+            on_written(name, stats)
+
+    if processes == 1 or len(jobs) <= 1:
+        for job in jobs:
+            add_stats(job['probe_dict']['name'], write_lfp_nwb(**job))
+        return lfp_stats
+
+    errors = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes or len(jobs)) as executor:
+        futures = {executor.submit(write_lfp_nwb, **job): job['probe_dict']['name'] for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                errors.append(future.exception())
+                continue
+            add_stats(futures[future], future.result())
+    if errors:
+        raise errors[0]
+
+    return lfp_stats
+
 def dict_to_indexed_array(dc, order=None):
     ''' Given a dictionary and an ordered arr, build a concatenation of the dictionary's values and an index describing
     how that concatenation can be unpacked
@@ -220,7 +469,7 @@ def add_ragged_data_to_dynamic_table(
 
     """
 
-    identifiers = table.to_dataframe()['unit_id'].values
+    identifiers = table['unit_id'].data
     idx, values = dict_to_indexed_array(data, identifiers)
     del data
 
@@ -231,28 +480,322 @@ def add_ragged_data_to_dynamic_table(
         index=idx
     )
 
-def add_to_nwb(session_folder: Union[str, pathlib.Path], nwb_file: Optional[Union[str, pathlib.Path, pynwb.NWBFile]]=None,
-                output_file: Optional[Union[str, pathlib.Path]] = None,
-                with_lfp=True) -> tuple[pynwb.NWBFile, dict[str, pynwb.NWBFile]]:
-    session_folder = pathlib.Path(session_folder)
-    session = np_session.Session(session_folder)
+def get_unit_ids_index(unit_ids) -> pd.Index:
+    """Index of unit ids: integers as they are, anything else (UUIDs) as strings."""
+    unit_ids = np.asarray(unit_ids)
+    return pd.Index(unit_ids if np.issubdtype(unit_ids.dtype, np.integer) else unit_ids.astype(str))
 
-    if not isinstance(nwb_file, pynwb.NWBFile) and nwb_file is not None:
-        nwb_file = load_nwb(nwb_file) 
-    
-    if nwb_file is None:
-        nwb_file = init_nwb(session)
+def get_probe_table(probe:dict, key:str, columns:Optional[list[str]]) -> pd.DataFrame:
+    """Columns (all if None) of a probe's `units` or `channels`, given as a list of dicts or a DataFrame."""
+    table = probe[key]
+    if isinstance(table, pd.DataFrame):
+        return table[columns] if columns is not None else table
+    return pd.DataFrame(table, columns=columns)
 
+def get_probe_unit_ids(probe:dict) -> tuple[np.ndarray, pd.Index]:
+    """Cluster ids and unit ids of a probe's `units`."""
+    units = get_probe_table(probe, 'units', ['cluster_id', 'id'])
+    return units['cluster_id'].to_numpy(dtype=np.int64), get_unit_ids_index(units['id'])
 
-    probes_dictionary, align_timestamps_output_dictionary = generate_probes_dictionary(session)
-    if with_lfp:
-        create_lfp_json(session)
-        
-    probes_object = Probes.from_json(probes_dictionary['probes'])
+def get_peak_channel_numbers(probe:dict) -> np.ndarray:
+    """Probe channel number of the peak channel of each of a probe's `units`, -1 if it isn't in its `channels`."""
+    units = get_probe_table(probe, 'units', ['peak_channel_id'])
+    channels = get_probe_table(probe, 'channels', ['id', 'probe_channel_number'])
+    rows = pd.Index(channels['id']).get_indexer(units['peak_channel_id'])
+    return np.where(rows >= 0, channels['probe_channel_number'].to_numpy(dtype=np.int64)[rows], -1)
+
+def get_cluster_rows(unit_ids:pd.Index, probe:dict, max_cluster_id:int) -> np.ndarray:
+    """Row of each cluster id of the probe in the units table, -1 for clusters not in the table."""
+    cluster_ids, probe_unit_ids = get_probe_unit_ids(probe)
+    cluster_rows = np.full(max(max_cluster_id, cluster_ids.max(initial=-1)) + 1, -1, dtype=np.int64)
+    cluster_rows[cluster_ids] = unit_ids.get_indexer(probe_unit_ids)
+    return cluster_rows
+
+def get_template_amplitudes(probe:dict, block_size:int=TEMPLATE_BLOCK_SIZE) -> np.ndarray:
+    """
+    Peak-to-peak amplitude of each unwhitened template on its largest channel, as in `Units.from_json`.
+    Templates are memory-mapped and unwhitened `block_size` at a time.
+    """
+    templates = np.squeeze(np.load(probe['templates_path'], mmap_mode='r'))
+    inverse_whitening_matrix = np.squeeze(np.load(probe['inverse_whitening_matrix_path'], mmap_mode='r'))
+    amplitudes = np.empty(len(templates), dtype=templates.dtype)
+    for start in range(0, len(templates), block_size):
+        block = np.matmul(templates[start:start + block_size], inverse_whitening_matrix).astype(templates.dtype, copy=False)
+        amplitudes[start:start + block_size] = (block.max(axis=1) - block.min(axis=1)).max(axis=1)
+
+    return amplitudes
+
+def is_sorted(array:np.ndarray, chunk_size:int=SPIKE_CHUNK_SIZE) -> bool:
+    """Whether a (memmapped) 1D array is in ascending order, checked `chunk_size` values at a time."""
+    for start in range(0, len(array), chunk_size):
+        if np.any(np.diff(array[max(start - 1, 0):start + chunk_size]) < 0):
+            return False
+
+    return True
+
+def get_ragged_spike_data(unit_ids:pd.Index, probes:list[dict], amplitude_scale_factor:float=SPIKE_AMPLITUDE_SCALE_FACTOR,
+                          output_dir:Optional[pathlib.Path]=None, 
+                          chunk_size:int=SPIKE_CHUNK_SIZE) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Index, spike times and scaled spike amplitudes of every unit in `unit_ids`,
+    concatenated in that order, from the probes' memmapped spike files.
+
+    Matches `Probes.from_json` followed by `dict_to_indexed_array`: spikes with
+    negative times are dropped and each unit's spikes are sorted by time.
+
+    Only `spike_clusters` is read in full: times, amplitudes and templates are
+    gathered for the spikes of units in `unit_ids` only, so selecting units
+    (e.g. leaving out noise clusters) cuts the data read accordingly.
+
+    Probes whose spike times are already in order (as Kilosort writes them) are
+    sorted by unit `chunk_size` spikes at a time; others are sorted in one go.
+    If `output_dir` is given, spike times and amplitudes are written to
+    `units_spike_times.npy` and `units_spike_amplitudes.npy` there and returned
+    as memmaps, so memory is bounded by the chunk size rather than the spike count.
+    """
+    probe_cluster_rows = []
+    counts = np.zeros(len(unit_ids), dtype=np.int64)
+    for probe in probes:
+        spike_clusters = np.squeeze(np.load(probe['spike_clusters_file'], mmap_mode='r'))
+        spike_times = np.squeeze(np.load(probe['spike_times_path'], mmap_mode='r'))
+        cluster_rows = get_cluster_rows(unit_ids, probe, int(spike_clusters.max(initial=0)))
+        for start in range(0, len(spike_clusters), chunk_size):
+            spike_rows = cluster_rows[spike_clusters[start:start + chunk_size]]
+            selected = np.flatnonzero(spike_rows >= 0)
+            spike_rows = spike_rows[selected[spike_times[start + selected] >= 0]]
+            counts += np.bincount(spike_rows, minlength=len(unit_ids))
+        probe_cluster_rows.append(cluster_rows)
+
+    index = np.cumsum(counts)
+    n_spikes = int(index[-1]) if len(index) else 0
+    if output_dir is None:
+        times = np.empty(n_spikes, dtype=np.float64)
+        amplitudes = np.empty_like(times)
+    else:
+        times = np.lib.format.open_memmap(pathlib.Path(output_dir, 'units_spike_times.npy'), mode='w+', 
+                                          dtype=np.float64, shape=(n_spikes,))
+        amplitudes = np.lib.format.open_memmap(pathlib.Path(output_dir, 'units_spike_amplitudes.npy'), mode='w+', 
+                                               dtype=np.float64, shape=(n_spikes,))
+
+    # next free position of each unit in the output
+    unit_cursors = index - counts
+    for probe, cluster_rows in zip(probes, probe_cluster_rows):
+        spike_clusters = np.squeeze(np.load(probe['spike_clusters_file'], mmap_mode='r'))
+        spike_times = np.squeeze(np.load(probe['spike_times_path'], mmap_mode='r'))
+        spike_amplitudes = np.squeeze(np.load(probe['spike_amplitudes_path'], mmap_mode='r'))
+        spike_templates = np.squeeze(np.load(probe['spike_templates_path'], mmap_mode='r'))
+        template_amplitudes = get_template_amplitudes(probe)
+        scale_factor = probe.get('amplitude_scale_factor', amplitude_scale_factor)
+        probe_chunk_size = chunk_size if is_sorted(spike_times, chunk_size) else max(len(spike_times), 1)
+
+        for start in range(0, len(spike_times), probe_chunk_size):
+            spike_rows = cluster_rows[spike_clusters[start:start + probe_chunk_size]]
+            selected = np.flatnonzero(spike_rows >= 0)
+            chunk_times = spike_times[start + selected]
+            spike_rows = spike_rows[selected]
+            keep = np.flatnonzero(chunk_times >= 0)
+            keep = keep[np.lexsort((chunk_times[keep], spike_rows[keep]))]
+            chunk_times, spike_rows = chunk_times[keep], spike_rows[keep]
+            spike_indices = start + selected[keep]
+
+            # position of each spike: next free position of its unit + rank among the chunk's spikes of that unit
+            chunk_counts = np.bincount(spike_rows, minlength=len(unit_ids))
+            chunk_starts = np.cumsum(chunk_counts) - chunk_counts
+            destination = unit_cursors[spike_rows] + np.arange(len(spike_rows)) - chunk_starts[spike_rows]
+            unit_cursors += chunk_counts
+
+            times[destination] = chunk_times
+            amplitudes[destination] = template_amplitudes[spike_templates[spike_indices]] * spike_amplitudes[spike_indices] * scale_factor
+
+    return index, times, amplitudes
+
+def get_ragged_waveforms(unit_ids:pd.Index, probes:list[dict]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Index and data of the (channels x samples) mean waveform of every unit in `unit_ids`.
+
+    Only the waveforms of those units are read from the memmapped
+    `mean_waveforms.npy`, but all of them are held in memory: every channel
+    of every unit (see `get_peak_channel_waveforms` for less).
+    """
+    waveforms = None
+    for probe in probes:
+        probe_waveforms = np.squeeze(np.load(probe['mean_waveforms_path'], mmap_mode='r'))
+        if waveforms is None:
+            waveforms = np.zeros((len(unit_ids), *probe_waveforms.shape[1:]), dtype=probe_waveforms.dtype)
+
+        cluster_ids, probe_unit_ids = get_probe_unit_ids(probe)
+        rows = unit_ids.get_indexer(probe_unit_ids)
+        in_table = (rows >= 0) & (cluster_ids < len(probe_waveforms))
+        waveforms[rows[in_table]] = probe_waveforms[cluster_ids[in_table]] / probe.get('scale_mean_waveform_and_csd', 1)
+
+    n_rows = waveforms.shape[1]
+    return np.arange(1, len(unit_ids) + 1) * n_rows, waveforms.reshape(len(unit_ids) * n_rows, waveforms.shape[2])
+
+@profiled('peak_channel_waveforms')
+def get_peak_channel_waveforms(unit_ids:pd.Index, probes:list[dict], neighborhood:int=0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Index and data of the mean waveform of every unit in `unit_ids` on its peak
+    channel and the `neighborhood` channels either side ((2 * neighborhood + 1) 
+    x samples, NaN past the ends of the probe), as float32.
+
+    Each probe's traces are gathered from the memmapped `mean_waveforms.npy`
+    with one index, so only those traces are read rather than every channel.
+    """
+    offsets = np.arange(-neighborhood, neighborhood + 1)
+    waveforms = None
+    for probe in probes:
+        probe_waveforms = np.squeeze(np.load(probe['mean_waveforms_path'], mmap_mode='r'))
+        if waveforms is None:
+            waveforms = np.full((len(unit_ids), len(offsets), probe_waveforms.shape[2]), np.nan, dtype=np.float32)
+
+        cluster_ids, probe_unit_ids = get_probe_unit_ids(probe)
+        rows = unit_ids.get_indexer(probe_unit_ids)
+        in_table = (rows >= 0) & (cluster_ids < len(probe_waveforms))
+        peak_channels = get_peak_channel_numbers(probe)[in_table]
+        if np.any(peak_channels < 0):
+            missing = probe_unit_ids[in_table][peak_channels < 0]
+            raise ValueError(f"Peak channels of units {', '.join(map(str, missing[:5]))}{'...' if len(missing) > 5 else ''} "
+                             f"of {probe.get('name', 'probe')} are not in its channels")
+        channels = peak_channels[:, None] + offsets
+        clusters = np.broadcast_to(cluster_ids[in_table, None], channels.shape)
+        on_probe = (channels >= 0) & (channels < probe_waveforms.shape[1])
+
+        unit_waveforms = waveforms[rows[in_table]]
+        unit_waveforms[on_probe] = probe_waveforms[clusters[on_probe], channels[on_probe]] / probe.get('scale_mean_waveform_and_csd', 1)
+        waveforms[rows[in_table]] = unit_waveforms
+
+    if waveforms is None:
+        waveforms = np.empty((0, len(offsets), 0), dtype=np.float32)
+    return np.arange(1, len(unit_ids) + 1) * len(offsets), waveforms.reshape(len(unit_ids) * len(offsets), waveforms.shape[2])
+
+@contextlib.contextmanager
+def units_spike_data_dir(output_dir:Optional[Union[str, pathlib.Path]]=None) -> Iterator[pathlib.Path]:
+    """
+    New directory in `output_dir` (the system temporary directory if None) for
+    the spike memmaps of one units table (see `add_ragged_spike_data_to_units`),
+    removed on exit, by which time the NWB file must be written.
+    """
+    path = pathlib.Path(tempfile.mkdtemp(prefix='units_spike_data_', dir=output_dir))
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def get_backend_data_io_options(data_io_options:Optional[dict[str, dict]], backend:str) -> Optional[dict[str, dict]]:
+    """Per-column `data_io.get_data_io` options with `backend` set."""
+    if data_io_options is None:
+        return None
+    return {column: {**data_io_options.get(column, {}), 'backend': backend} for column in (*UNITS_DATA_IO_COLUMNS, *data_io_options)}
+
+def add_ragged_column(table:pynwb.misc.Units, name:str, description:str, data, index:np.ndarray) -> None:
+    """Add a ragged column, with one entry per row in `index`, also to a table with no rows."""
+    if len(index):
+        # `add_column` only accepts an index as a list for predefined columns
+        table.add_column(name=name, description=description, data=data, index=index.tolist())
+        return
+    table.add_column(name=name, description=description, data=data, index=True)
+    # hdmf can't write the empty list it indexes an empty column with
+    table[name].transform(lambda _: np.empty(0, dtype=np.uint64))
+
+@profiled('ragged_columns')
+def add_ragged_spike_data_to_units(table:pynwb.misc.Units, probes:list[dict], data_io_options:Optional[dict[str, dict]]=None,
+                                   output_dir:Optional[Union[str, pathlib.Path]]=None, 
+                                   waveform_neighborhood:Optional[int]=None) -> None:
+    """
+    Add `spike_times`, `spike_amplitudes` and `waveform_mean` columns to the
+    units table, built directly from the files of the probes in a probes dictionary.
+
+    With `data_io_options` (column name -> keyword arguments for `data_io.get_data_io`,
+    e.g. `{'spike_times': {'chunk_shape': (100_000,), 'compression': 'gzip'}}`),
+    spike times and amplitudes are streamed to the file in chunks. With
+    `output_dir` too (e.g. from `units_spike_data_dir`), they are sorted into
+    memmaps there rather than in memory, and the directory must exist until
+    the file is written.
+
+    With `waveform_neighborhood`, `waveform_mean` holds only each unit's peak
+    channel and that many channels either side, as float32 (see
+    `get_peak_channel_waveforms`), instead of every channel.
+    """
+    unit_ids = get_unit_ids_index(table['unit_id'].data)
+    index, spike_times, spike_amplitudes = get_ragged_spike_data(unit_ids, probes, output_dir=output_dir if data_io_options is not None else None)
+    if data_io_options is not None:
+        spike_times = get_data_io(spike_times, **data_io_options.get('spike_times', {}))
+        spike_amplitudes = get_data_io(spike_amplitudes, **data_io_options.get('spike_amplitudes', {}))
+    add_ragged_column(table, 'spike_times', 'times (s) of detected spiking events', spike_times, index)
+    del spike_times
+
+    add_ragged_column(table, 'spike_amplitudes', 'amplitude (s) of detected spiking events', spike_amplitudes, index)
+    del spike_amplitudes
+
+    if waveform_neighborhood is None:
+        waveform_index, waveforms = get_ragged_waveforms(unit_ids, probes)
+    else:
+        waveform_index, waveforms = get_peak_channel_waveforms(unit_ids, probes, waveform_neighborhood)
+    add_ragged_column(table, 'waveform_mean', 'mean waveforms on peak channels (over samples)', waveforms, waveform_index)
+
+def get_units_from_dataframe(units:pd.DataFrame) -> pynwb.misc.Units:
+    """`Units.from_dataframe`, also for a table with no units (e.g. none left by `units_query`), which it can't build."""
+    if len(units):
+        return pynwb.misc.Units.from_dataframe(units, name='units')
+
+    table = pynwb.misc.Units(name='units')
+    for column in units.columns:
+        table.add_column(name=column, description='no description', data=units[column].to_numpy())
+    return table
+
+def get_probes_without_spike_data(probes:list[dict]) -> 'Probes':
+    """
+    AllenSDK `Probes` of a probes dictionary, as `Probes.from_json` builds them
+    but without reading any spike data: units have no spike times, amplitudes
+    or mean waveforms (see `add_ragged_spike_data_to_units`), and no LFP.
+    """
+    from allensdk.brain_observatory.ecephys.probes import Probes
+    from allensdk.brain_observatory.ecephys._probe import Probe
+    from allensdk.brain_observatory.ecephys._channels import Channels
+    from allensdk.brain_observatory.ecephys._units import Units
+    from allensdk.brain_observatory.ecephys._unit import Unit
+
+    probe_objects = []
+    for probe in sorted(probes, key=lambda probe: probe['name']):
+        units = [Unit(**unit, spike_times=np.empty(0), spike_amplitudes=np.empty(0), mean_waveforms=None, 
+                      filter_and_sort_spikes=False) for unit in get_probe_table(probe, 'units', None).to_dict('records')]
+        probe_objects.append(Probe(
+            id=probe['id'],
+            name=probe['name'],
+            channels=Channels.from_json(channels=get_probe_table(probe, 'channels', None).to_dict('records')),
+            units=Units(units=units),
+            sampling_rate=probe['sampling_rate'],
+            lfp=None,
+            current_source_density=None,
+            temporal_subsampling_factor=probe['temporal_subsampling_factor']
+        ))
+
+    return Probes(probes=probe_objects)
+
+def add_probes_to_nwb(session:np_session.Session, nwb_file:pynwb.NWBFile, probes_dictionary:dict,
+                      units_data_io_options:Optional[dict[str, dict]]=None, waveform_neighborhood:Optional[int]=None,
+                      spike_data_dir:Optional[Union[str, pathlib.Path]]=None) -> 'Probes':
+    """
+    Add the probes' devices, electrode groups, electrodes and units to `nwb_file`.
+    Spike columns are read from the probes' files, for the units in the table
+    only, and sorted into memmaps in `spike_data_dir`, if given (see
+    `add_ragged_spike_data_to_units`).
+
+    Returns the probes as AllenSDK `Probes`, without spike data (see
+    `get_probes_without_spike_data`).
+    """
+    with profile_stage('get_probes_without_spike_data'):
+        probes_object = get_probes_without_spike_data(probes_dictionary['probes'])
     for probe_object in probes_object:
-        nwb_file = probe_object.to_nwb(nwb_file)[0]
+        with profile_stage('to_nwb', probe=probe_object.name):
+            nwb_file = probe_object.to_nwb(nwb_file)[0]
 
-    units = probes_object.get_units_table()
+    with profile_stage('units_table'):
+        if any(len(probe.units.value) for probe in probes_object.probes):
+            units = probes_object.get_units_table()
+        else:
+            # `get_units_table` can't build a table with no units
+            units = pd.DataFrame(columns=[*UNITS_TABLE_COLUMNS, 'local_index'], index=pd.Index([], name='id'))
     electrodes = nwb_file.electrodes.to_dataframe()
     electrodes['channel_id'] = electrodes.index.values
     units_channels = units.merge(electrodes[['location', 'x', 'y', 'z', 'probe_id', 'channel_id', 'group_name']], 
@@ -262,48 +805,303 @@ def add_to_nwb(session_folder: Union[str, pathlib.Path], nwb_file: Optional[Unio
     units_channels['unit_id'] = pd.Series(units.index.values.tolist(), dtype='string')
     units_channels.index = list(range(units_channels.shape[0]))
 
-    nwb_file.units = pynwb.misc.Units.from_dataframe(
-            units_channels,
-            name='units')
+    nwb_file.units = get_units_from_dataframe(units_channels)
     
-    add_ragged_data_to_dynamic_table(
-            table=nwb_file.units,
-            data=probes_object.spike_times,
-            column_name="spike_times",
-            column_description="times (s) of detected spiking events",
-    )
+    add_ragged_spike_data_to_units(nwb_file.units, probes_dictionary['probes'], data_io_options=units_data_io_options,
+                                   output_dir=spike_data_dir, waveform_neighborhood=waveform_neighborhood)
 
-    add_ragged_data_to_dynamic_table(
-            table=nwb_file.units,
-            data=probes_object.spike_amplitudes,
-            column_name="spike_amplitudes",
-            column_description="amplitude (s) of detected spiking events"
-    )
+    return probes_object
 
-    add_ragged_data_to_dynamic_table(
-            table=nwb_file.units,
-            data=probes_object.mean_waveforms,
-            column_name="waveform_mean",
-            column_description="mean waveforms on peak channels (over "
-                               "samples)",
-    )
+def get_rows_by_id(ids:np.ndarray, lookup_ids:np.ndarray) -> np.ndarray:
+    """Row of each of `lookup_ids` in a table with integer `ids`, by direct lookup (-1 if absent)."""
+    rows = np.full(max(ids.max(initial=-1), lookup_ids.max(initial=-1)) + 1, -1, dtype=np.int64)
+    rows[ids] = np.arange(len(ids))
+    return rows[lookup_ids]
 
-    #nwb_file = probes_object.to_nwb(nwb_file)[0]
+def get_electrode_locations(channels:pd.DataFrame) -> np.ndarray:
+    """Structure acronyms without the subregion (`LGd-sh` -> `LGd`), as AllenSDK `Channel` reports them."""
+    return channels['structure_acronym'].str.split('-').str[0].to_numpy()
 
-    if not with_lfp:
-        return nwb_file, {}
+def get_units_electrodes_table(probe_tables:dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """
+    Units table as `add_probes_to_nwb` writes it, from `generate_probe_tables`:
+    good units on valid channels, with the location, CCF coordinates and probe
+    of their peak channel, looked up by channel id rather than merged.
+    """
+    probes, channels, units = probe_tables['probes'], probe_tables['channels'], probe_tables['units']
+    rows = get_rows_by_id(channels['id'].to_numpy(), units['peak_channel_id'].to_numpy())
+    keep = ((rows >= 0) & channels['valid_data'].to_numpy()[rows] & channels['structure_acronym'].notna().to_numpy()[rows] 
+            & (units['quality'] == 'good').to_numpy())
+    rows = rows[keep]
+
+    table = units.loc[keep, list(UNITS_TABLE_COLUMNS)].reset_index(drop=True)
+    table['location'] = get_electrode_locations(channels)[rows]
+    table['x'] = channels['anterior_posterior_ccf_coordinate'].to_numpy()[rows]
+    table['y'] = channels['dorsal_ventral_ccf_coordinate'].to_numpy()[rows]
+    table['z'] = channels['left_right_ccf_coordinate'].to_numpy()[rows]
+    probe_rows = get_rows_by_id(probes['id'].to_numpy(), channels['probe_id'].to_numpy()[rows])
+    table['group_name'] = probes['name'].to_numpy()[probe_rows]
+    table['unit_id'] = units['id'].to_numpy()[keep]
+
+    return table
+
+def add_probe_tables_to_nwb(session:np_session.Session, nwb_file:pynwb.NWBFile, probe_tables:dict[str, pd.DataFrame],
+                            units_data_io_options:Optional[dict[str, dict]]=None, 
+                            waveform_neighborhood:Optional[int]=None,
+                            spike_data_dir:Optional[Union[str, pathlib.Path]]=None) -> pynwb.NWBFile:
+    """
+    Columnar equivalent of `add_probes_to_nwb`, from `generate_probe_tables`:
+    electrodes and units are added from the tables' columns, without building
+    AllenSDK `Probes`, `Channel` and `Unit` objects.
+    """
+    from allensdk.brain_observatory.ecephys.nwb_util import add_probe_to_nwbfile, _add_ecephys_electrode_columns
+
+    probes, channels = probe_tables['probes'], probe_tables['channels']
+    electrode_groups = {}
+    for probe in probes.itertuples(index=False):
+        # the device's probe_id is text, as for the UUIDs of `generate_probes_dictionary`
+        nwb_file, _, electrode_groups[probe.id] = add_probe_to_nwbfile(nwb_file, probe_id=str(probe.id), name=probe.name, 
+                                                                       sampling_rate=probe.sampling_rate, 
+                                                                       lfp_sampling_rate=np.nan, has_lfp_data=False)
+
+    with profile_stage('electrodes'):
+        _add_ecephys_electrode_columns(nwb_file)
+        for channel, location in zip(channels.itertuples(index=False), get_electrode_locations(channels)):
+            nwb_file.add_electrode(
+                id=channel.id,
+                x=channel.anterior_posterior_ccf_coordinate,
+                y=channel.dorsal_ventral_ccf_coordinate,
+                z=channel.left_right_ccf_coordinate,
+                probe_vertical_position=channel.probe_vertical_position,
+                probe_horizontal_position=channel.probe_horizontal_position,
+                probe_channel_number=channel.probe_channel_number,
+                valid_data=channel.valid_data,
+                probe_id=channel.probe_id,
+                group=electrode_groups[channel.probe_id],
+                location=location,
+                imp=np.nan,
+                filtering=ELECTRODE_FILTERING
+            )
+
+    with profile_stage('units_table'):
+        nwb_file.units = get_units_from_dataframe(get_units_electrodes_table(probe_tables))
+
+    add_ragged_spike_data_to_units(nwb_file.units, get_probes_dictionary_from_tables(probe_tables)['probes'],
+                                   data_io_options=units_data_io_options,
+                                   output_dir=spike_data_dir, waveform_neighborhood=waveform_neighborhood)
+
+    return nwb_file
+
+# staged inputs (see `get_probe_fields`) are kept until the file is written
+@pin_staged_files()
+def add_to_nwb(session_folder: Union[str, pathlib.Path], nwb_file: Optional[Union[str, pathlib.Path, pynwb.NWBFile]]=None,
+                output_file: Optional[Union[str, pathlib.Path]] = None,
+                with_lfp=True, stream_lfp=False, lfp_data_io_options:Optional[dict]=None,
+                units_data_io_options:Optional[dict[str, dict]]=None, lfp_output_dir:Optional[Union[str, pathlib.Path]]=None,
+                lfp_processes:Optional[int]=None, columnar:bool=False,
+                units_query:Optional[str]=None, 
+                waveform_neighborhood:Optional[int]=None, 
+                backend:str='hdf5', spike_data_dir:Optional[Union[str, pathlib.Path]]=None) -> tuple[pynwb.NWBFile, dict[str, Union[pynwb.NWBFile, dict]]]:
+    """
+    With `stream_lfp`, each probe's LFP is memory-mapped from `probeX_lfp.dat` 
+    and written in chunks (see `add_lfp_to_nwb`), so peak memory is bounded by
+    the buffer size rather than the length of the recording.
+
+    With `units_data_io_options`, the units' spike times and amplitudes are 
+    written in chunks, with per-column chunking and compression (see
+    `add_ragged_spike_data_to_units`). They are sorted into memmaps in a new
+    directory in `SDK_outputs` if `output_file` is given, removed once it is
+    written, or in `spike_data_dir` (see `units_spike_data_dir`), which must
+    exist until the returned file is written. Otherwise they are held in memory.
+
+    With `lfp_output_dir`, each probe's LFP NWB is written there in parallel by
+    `export_lfp_nwbs`, and the path and stats of each file are returned instead
+    of the `NWBFile` objects.
+
+    With `columnar`, probes, channels and units are kept as DataFrames with
+    integer ids (see `generate_probe_tables` and `add_probe_tables_to_nwb`);
+    LFP NWBs then need `lfp_output_dir`.
+
+    `units_query` (e.g. `quality == 'good' and isi_violations < 0.5`) selects the
+    units written, before any of their spike data is read.
+
+    With `waveform_neighborhood` (e.g. `0`), each unit's `waveform_mean` is only
+    its peak channel and that many channels either side, as float32, gathered
+    from the memmapped mean waveforms (see `get_peak_channel_waveforms`).
+    Otherwise every channel of each unit's mean waveform is held in memory
+    until the file is written (see `get_ragged_waveforms`).
+
+    With `backend='zarr'`, `output_file` and the LFP NWBs in `lfp_output_dir`
+    are written as NWB-Zarr directories, and the streamed datasets are wrapped
+    for zarr (see `utils.save_nwb`).
+
+    To add probes to an existing NWB file without rewriting it, use `append_to_nwb`.
+    """
+    if columnar and with_lfp and lfp_output_dir is None:
+        raise ValueError('With `columnar`, LFP NWBs are only written to `lfp_output_dir`')
+    units_data_io_options = get_backend_data_io_options(units_data_io_options, backend)
+
+    session_folder = pathlib.Path(session_folder)
+    session = np_session.Session(session_folder)
+
+    if not isinstance(nwb_file, pynwb.NWBFile) and nwb_file is not None:
+        nwb_file = load_nwb(nwb_file) 
     
-    probes_object_with_lfp = add_lfp_to_object(session, probes_object, align_timestamps_output_dictionary['probe_outputs'])
-    lfp_nwbs:dict = {}
+    if nwb_file is None:
+        nwb_file = init_nwb(session)
+
+    spike_data_context = contextlib.nullcontext(spike_data_dir)
+    if spike_data_dir is None and units_data_io_options is not None and output_file is not None:
+        spike_data_context = units_spike_data_dir(get_session_index(session)['sdk_outputs_path'])
+
+    with spike_data_context as spike_data_dir:
+        if columnar:
+            probe_tables, align_timestamps_output_dictionary = generate_probe_tables(session, units_query)
+            probes_dictionary = get_probes_dictionary_from_tables(probe_tables)
+        else:
+            probes_dictionary, align_timestamps_output_dictionary = generate_probes_dictionary(session, units_query)
+        if with_lfp:
+            create_lfp_json(session)
+            
+        if columnar:
+            add_probe_tables_to_nwb(session, nwb_file, probe_tables, units_data_io_options, waveform_neighborhood, spike_data_dir)
+        else:
+            probes_object = add_probes_to_nwb(session, nwb_file, probes_dictionary, units_data_io_options, waveform_neighborhood,
+                                              spike_data_dir)
 
-    for probe in probes_object_with_lfp:
-        lfp_nwbs[probe.name] = add_lfp_to_nwb(probe, str(session.id), session.start, nwb_file)
+        #nwb_file = probes_object.to_nwb(nwb_file)[0]
 
-    if output_file is not None:
-        save_nwb(nwb_file, output_file)
+        if not with_lfp:
+            if output_file is not None:
+                save_nwb(nwb_file, output_file, backend=backend)
+            return nwb_file, {}
+
+        if lfp_output_dir is not None:
+            if output_file is not None:
+                save_nwb(nwb_file, output_file, backend=backend)
+            lfp_stats = export_lfp_nwbs(session, probes_dictionary, align_timestamps_output_dictionary['probe_outputs'],
+                                        output_dir=lfp_output_dir, processes=lfp_processes, data_io_options=lfp_data_io_options,
+                                        backend=backend)
+            return nwb_file, lfp_stats
+        
+        with profile_stage('add_lfp_to_object'):
+            probes_object_with_lfp = add_lfp_to_object(session, probes_object, align_timestamps_output_dictionary['probe_outputs'],
+                                                       memmap=stream_lfp)
+        if stream_lfp:
+            lfp_data_io_options = {**(lfp_data_io_options or {}), 'backend': backend}
+        lfp_nwbs:dict = {}
+
+        for probe in probes_object_with_lfp:
+            with profile_stage('add_lfp_to_nwb', probe=probe.name):
+                lfp_nwbs[probe.name] = add_lfp_to_nwb(probe, str(session.id), session.start, nwb_file,
+                                                      data_io_options=lfp_data_io_options)
+
+        if output_file is not None:
+            save_nwb(nwb_file, output_file, backend=backend)
 
     return nwb_file, lfp_nwbs
 
+def add_probe_devices(nwb_file:pynwb.NWBFile, probes_file:pynwb.NWBFile) -> None:
+    """Add copies of the devices and electrode groups of `probes_file` (in memory) to `nwb_file`."""
+    existing = set(nwb_file.devices) | set(nwb_file.electrode_groups)
+    added = set(probes_file.devices) | set(probes_file.electrode_groups)
+    if existing & added:
+        raise ValueError(f"{', '.join(sorted(existing & added))} already in the file")
+
+    devices = {}
+    for name, device in probes_file.devices.items():
+        devices[name] = type(device)(name=name, **device.fields)
+        nwb_file.add_device(devices[name])
+    for name, group in probes_file.electrode_groups.items():
+        nwb_file.add_electrode_group(type(group)(name=name, **{**group.fields, 'device': devices[group.device.name]}))
+
+# staged inputs (see `get_probe_fields`) are kept until the file is written
+@pin_staged_files()
+def append_to_nwb(session_folder: Union[str, pathlib.Path], nwb_path: Union[str, pathlib.Path],
+                  probe_names:Optional[list[str]]=None, with_lfp=True, lfp_output_dir:Optional[Union[str, pathlib.Path]]=None,
+                  lfp_processes:Optional[int]=None, lfp_data_io_options:Optional[dict]=None,
+                  units_data_io_options:Optional[dict[str, dict]]=None, columnar:bool=False,
+                  units_query:Optional[str]=None, waveform_neighborhood:Optional[int]=None) -> dict[str, dict]:
+    """
+    Add the probes' devices, electrodes and units to an existing NWB file in
+    place: the file is opened with `mode='a'` and only the new groups are
+    written, so acquisition, stimulus and anything else already in the file
+    are neither read nor rewritten.
+
+    `probe_names` (e.g. `['probeA']`) restricts which probes are added. If the
+    file already has electrodes and units, e.g. from an earlier call for other
+    probes, the new rows are appended to those tables (see `utils.extend_table`).
+    Their columns must match and their ids must be new, as they are for probes
+    of one session with `columnar`. Probes already in the file can't be
+    replaced. Tables written before datasets were resizable can't be extended.
+
+    LFP NWBs are written to `lfp_output_dir` (default `SDK_outputs`) by
+    `export_lfp_nwbs`, and their paths and stats are returned.
+
+    With `columnar`, probes are added from `generate_probe_tables`, and
+    `units_query` selects the units added and `waveform_neighborhood` the
+    channels of their mean waveforms (see `add_to_nwb`).
+
+    NWB-Zarr directories are opened with `mode='r+'`, and their LFP NWBs are
+    also written as NWB-Zarr.
+    """
+    session = np_session.Session(pathlib.Path(session_folder))
+    backend = 'zarr' if is_zarr_nwb(nwb_path) else 'hdf5'
+    units_data_io_options = get_backend_data_io_options(units_data_io_options, backend)
+    if columnar:
+        probe_tables, align_timestamps_output_dictionary = generate_probe_tables(session, units_query)
+        probes_dictionary = get_probes_dictionary_from_tables(probe_tables)
+    else:
+        probes_dictionary, align_timestamps_output_dictionary = generate_probes_dictionary(session, units_query)
+    if probe_names is not None:
+        missing = set(probe_names) - {probe['name'] for probe in probes_dictionary['probes']}
+        if missing:
+            raise ValueError(f"No {', '.join(sorted(missing))} in session {session.id}")
+        probes_dictionary = {**probes_dictionary, 'probes': [probe for probe in probes_dictionary['probes'] if probe['name'] in probe_names]}
+        if columnar:
+            probe_tables = select_probe_tables(probe_tables, probe_names)
+
+    io_class = import_hdmf_zarr().nwb.NWBZarrIO if backend == 'zarr' else pynwb.NWBHDF5IO
+    mode = 'r+' if backend == 'zarr' else 'a'
+    spike_data_context = units_spike_data_dir(get_session_index(session)['sdk_outputs_path']) if units_data_io_options is not None else contextlib.nullcontext()
+    with spike_data_context as spike_data_dir:
+        with io_class(str(nwb_path), mode=mode) as io:
+            nwb_file = io.read()
+            extend = nwb_file.electrodes is not None or nwb_file.units is not None
+            if extend and (nwb_file.electrodes is None or nwb_file.units is None):
+                raise ValueError(f'{nwb_path} has electrodes or units but not both, so neither can be extended')
+
+            # new rows are built in memory and appended to the existing tables once their groups are written
+            probes_file = init_nwb(session) if extend else nwb_file
+            if columnar:
+                add_probe_tables_to_nwb(session, probes_file, probe_tables, units_data_io_options, waveform_neighborhood, spike_data_dir)
+            else:
+                add_probes_to_nwb(session, probes_file, probes_dictionary, units_data_io_options, waveform_neighborhood, spike_data_dir)
+            if extend:
+                add_probe_devices(nwb_file, probes_file)
+                check_extendable(nwb_file.electrodes, probes_file.electrodes)
+                # unit table ids are row numbers: units are identified by `unit_id`
+                check_extendable(nwb_file.units, probes_file.units, renumber_ids=True)
+            io.write(nwb_file)
+
+        if extend:
+            with io_class(str(nwb_path), mode=mode) as io:
+                nwb_file = io.read()
+                extend_table(nwb_file.electrodes, probes_file.electrodes, nwb_file.electrode_groups)
+                extend_table(nwb_file.units, probes_file.units, renumber_ids=True)
+            if backend == 'zarr':
+                import zarr
+                # the consolidated metadata `NWBZarrIO` reads still has the tables' old shapes
+                zarr.consolidate_metadata(store=str(nwb_path))
+
+    if not with_lfp:
+        return {}
+
+    create_lfp_json(session)
+    return export_lfp_nwbs(session, probes_dictionary, align_timestamps_output_dictionary['probe_outputs'],
+                           output_dir=lfp_output_dir, processes=lfp_processes, data_io_options=lfp_data_io_options,
+                           backend=backend)
+
 if __name__ == '__main__':
     session = np_session.Session('DRpilot_649943_20230216')
     
@@ -0,0 +1,254 @@
+import os
+import sys
+import csv
+import json
+import time
+import pathlib
+import threading
+import itertools
+import functools
+import contextlib
+import np_logging
+from typing import Optional, Union, Callable, Iterator
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = np_logging.getLogger(__name__)
+
+_enabled = bool(os.environ.get('NP_PROBES_PROFILE'))
+_session_id: Optional[str] = None
+_records: list[dict] = []
+_records_lock = threading.Lock()
+_stages = threading.local()
+_null_context = contextlib.nullcontext()
+# seconds between samples of the RSS of open stages
+RSS_SAMPLE_INTERVAL = 0.01
+# records kept in memory (e.g. with `NP_PROBES_PROFILE` set and no report written), the oldest dropped first
+PROFILE_MAX_RECORDS = 100_000
+_stage_peaks: dict[int, Optional[int]] = {}
+_stage_peaks_lock = threading.Lock()
+_stage_keys = itertools.count()
+_rss_sampler: Optional[threading.Thread] = None
+
+def enable_profiling(enabled:bool=True) -> None:
+    """Turn stage timers on or off (also on if `NP_PROBES_PROFILE` is set)."""
+    global _enabled
+    _enabled = enabled
+
+def is_profiling_enabled() -> bool:
+    return _enabled
+
+def get_peak_rss() -> Optional[int]:
+    """
+    Peak resident memory of this process so far, in bytes: the peak of the
+    whole process, not of any one stage (see `get_rss`).
+    """
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+    if psutil is not None:
+        return psutil.Process().memory_info().peak_wset
+
+    return None
+
+def get_rss() -> Optional[int]:
+    """Resident memory of this process now, in bytes."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def max_rss(peak:Optional[int], rss:Optional[int]) -> Optional[int]:
+    return rss if peak is None else peak if rss is None else max(peak, rss)
+
+def _sample_rss() -> None:
+    """Raise the peak of every open stage to the current RSS, until no stage is open."""
+    global _rss_sampler
+    while True:
+        rss = get_rss()
+        with _stage_peaks_lock:
+            if not _stage_peaks:
+                _rss_sampler = None
+                return
+            for key, peak in _stage_peaks.items():
+                _stage_peaks[key] = max_rss(peak, rss)
+        time.sleep(RSS_SAMPLE_INTERVAL)
+
+def _open_stage_peak() -> int:
+    """Start tracking the peak RSS of a stage, sampled every `RSS_SAMPLE_INTERVAL` in a thread."""
+    global _rss_sampler
+    key = next(_stage_keys)
+    rss = get_rss()
+    with _stage_peaks_lock:
+        _stage_peaks[key] = rss
+        if _rss_sampler is None and rss is not None:
+            _rss_sampler = threading.Thread(target=_sample_rss, name='np_probes_rss_sampler', daemon=True)
+            _rss_sampler.start()
+    return key
+
+def _close_stage_peak(key:int) -> Optional[int]:
+    """Stop tracking a stage and return its peak RSS (a lower bound: allocations freed between samples are missed)."""
+    rss = get_rss()
+    with _stage_peaks_lock:
+        return max_rss(_stage_peaks.pop(key), rss)
+
+def get_io_bytes() -> tuple[Optional[int], Optional[int]]:
+    """
+    Bytes read and written by this process so far, including reads served from
+    the page cache or a network share (`rchar`/`wchar`, not only block device I/O).
+    """
+    if psutil is not None:
+        counters = psutil.Process().io_counters()
+        return getattr(counters, 'read_chars', counters.read_bytes), getattr(counters, 'write_chars', counters.write_bytes)
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def get_usage() -> dict:
+    read_bytes, write_bytes = get_io_bytes()
+    return {'wall': time.perf_counter(), 'cpu': time.process_time(), 'rss': get_rss(),
+            'read_bytes': read_bytes, 'write_bytes': write_bytes}
+
+def difference(end:Optional[int], start:Optional[int]) -> Optional[int]:
+    return end - start if end is not None and start is not None else None
+
+@contextlib.contextmanager
+def _profile_stage(stage:str, **labels) -> Iterator[None]:
+    stack = _stages.__dict__.setdefault('stack', [])
+    parent = stack[-1] if stack else None
+    stack.append(stage)
+    peak_key = _open_stage_peak()
+    start = get_usage()
+    try:
+        yield
+    finally:
+        end = get_usage()
+        peak_rss = _close_stage_peak(peak_key)
+        stack.pop()
+        record = {
+            'session': _session_id,
+            'stage': stage,
+            'parent': parent,
+            **labels,
+            'wall_s': round(end['wall'] - start['wall'], 3),
+            'cpu_s': round(end['cpu'] - start['cpu'], 3),
+            'start_rss_bytes': start['rss'],
+            'peak_rss_bytes': peak_rss,
+            'process_peak_rss_bytes': get_peak_rss(),
+            'read_bytes': difference(end['read_bytes'], start['read_bytes']),
+            'write_bytes': difference(end['write_bytes'], start['write_bytes']),
+        }
+        with _records_lock:
+            _records.append(record)
+            if len(_records) > PROFILE_MAX_RECORDS:
+                del _records[:len(_records) - PROFILE_MAX_RECORDS]
+        logger.info(f"{stage}{''.join(f' {key}={value}' for key, value in labels.items())}: "
+                    f"{record['wall_s']}s wall, {record['cpu_s']}s cpu, peak RSS {record['peak_rss_bytes']}, "
+                    f"read {record['read_bytes']}, written {record['write_bytes']}")
+
+def profile_stage(stage:str, **labels) -> contextlib.AbstractContextManager:
+    """
+    Context manager recording the wall time, CPU time, peak RSS and bytes
+    read/written of a stage of the pipeline, labelled with e.g. `probe=`.
+
+    The peak RSS of a stage is sampled while it runs, by a thread shared by
+    all open stages; the process-lifetime peak is recorded alongside it.
+
+    Does nothing (returns a shared `nullcontext`) while profiling is off.
+    """
+    if not _enabled:
+        return _null_context
+
+    return _profile_stage(stage, **labels)
+
+def profiled(stage:Optional[str]=None) -> Callable:
+    """Decorator recording each call of a function as a stage (see `profile_stage`)."""
+    def decorator(function:Callable) -> Callable:
+        name = stage if stage is not None else function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _profile_stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def get_profile_records() -> list[dict]:
+    with _records_lock:
+        return list(_records)
+
+def clear_profile_records() -> None:
+    with _records_lock:
+        _records.clear()
+
+def write_profile_report(report_path:Union[str, pathlib.Path], records:Optional[list[dict]]=None) -> pathlib.Path:
+    """
+    Write stage records as JSON, or as CSV if `report_path` ends in `.csv`: by
+    default those recorded so far, which are then cleared.
+    """
+    report_path = pathlib.Path(report_path)
+    if records is None:
+        with _records_lock:
+            records = list(_records)
+            _records.clear()
+
+    tmp_path = report_path.with_name(report_path.name + '.tmp')
+    with open(tmp_path, 'w', newline='') as f:
+        if report_path.suffix == '.csv':
+            fields = list(dict.fromkeys(key for record in records for key in record))
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            json.dump(records, f, indent=2)
+    os.replace(tmp_path, report_path)
+
+    return report_path
+
+@contextlib.contextmanager
+def profile_session(session_id:str, report_path:Optional[Union[str, pathlib.Path]]=None) -> Iterator[list[dict]]:
+    """
+    Profile everything run inside the `with` block as stages of one session,
+    yielding the list of its records, which is filled in as stages finish and
+    written to `report_path` (JSON or CSV) on exit.
+
+    Stages run in worker processes are not recorded, only the stage that
+    launched them.
+    """
+    global _session_id, _records
+    previous_enabled, previous_session_id = _enabled, _session_id
+    enable_profiling()
+    _session_id = session_id
+    # the session's records are kept apart, and dropped from memory once it exits
+    session_records: list[dict] = []
+    with _records_lock:
+        previous_records, _records = _records, session_records
+
+    try:
+        with _profile_stage('session'):
+            yield session_records
+    finally:
+        with _records_lock:
+            _records = previous_records
+        enable_profiling(previous_enabled)
+        _session_id = previous_session_id
+        if report_path is not None:
+            write_profile_report(report_path, session_records)
@@ -0,0 +1,321 @@
+import pathlib
+import json
+import os
+import fnmatch
+import glob
+import threading
+import time
+import np_logging
+import concurrent.futures
+from np_probes.utils import get_probe_metrics_path
+from np_probes.profiling import profile_stage
+from np_probes.staging import stage_file
+from typing import TYPE_CHECKING, Optional, Union
+
+if TYPE_CHECKING:
+    import np_session
+
+logger = np_logging.getLogger(__name__)
+
+SESSION_INDEX_FILENAME = 'session_index.json'
+SESSION_INDEX_VERSION = 2
+# depth of the deepest directory searched under each root (`*/*/*/*/events/*X-AP/*` for `states.npy`,
+# `*X*/events/*/*` for `event_timestamps.npy`)
+NPEXP_WALK_DEPTH = 7
+DATAJOINT_WALK_DEPTH = 4
+WALK_EXCLUDE = ('SDK_outputs',)
+# seconds between checks of the directories of an index kept in memory
+SESSION_INDEX_RECHECK_INTERVAL = 30
+
+_session_indexes: dict[str, dict] = {}
+_session_index_check_times: dict[str, float] = {}
+_session_indexes_lock = threading.Lock()
+
+def get_npexp_path(session:'np_session.Session') -> pathlib.Path:
+    """Session directory, on the second storage directory for sessions on `Data2`."""
+    if 'Data2' in str(session.npexp_path):
+        return session.storage_dirs[1] / session.id
+
+    return session.npexp_path
+
+def is_weird_session(session:'np_session.Session') -> bool:
+    """626791 sessions keep sorted data next to the raw data instead of on datajoint."""
+    return '626791' in str(session.id)
+
+def walk_directory(root:pathlib.Path, max_depth:int, exclude:tuple[str, ...]=WALK_EXCLUDE) -> dict[str, float]:
+    """Relative path -> mtime of every directory under `root`, down to `max_depth` levels."""
+    directories = {}
+    stack = [(root, '', 0)]
+    while stack:
+        path, relative_path, depth = stack.pop()
+        if depth >= max_depth:
+            continue
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name in exclude or not entry.is_dir():
+                continue
+            entry_path = f'{relative_path}/{entry.name}' if relative_path else entry.name
+            directories[entry_path] = entry.stat().st_mtime
+            stack.append((pathlib.Path(entry.path), entry_path, depth + 1))
+
+    return directories
+
+def walk_directories(root:pathlib.Path, max_depth:int, max_workers:Optional[int]=8) -> dict[str, float]:
+    """
+    `walk_directory`, with each top-level subdirectory walked in its own thread
+    (listing directories on network shares is mostly waiting).
+    """
+    top_level = walk_directory(root, 1)
+    directories = dict(top_level)
+    if max_depth <= 1:
+        return directories
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        subdirectories = executor.map(lambda name: walk_directory(root / name, max_depth - 1), top_level)
+        for name, subdirectory in zip(top_level, subdirectories):
+            directories.update({f'{name}/{path}': mtime for path, mtime in subdirectory.items()})
+
+    return directories
+
+def match_directories(root:pathlib.Path, directories:dict[str, float], pattern:str) -> list[pathlib.Path]:
+    """Directories matching a glob `pattern`, as `sorted(root.glob(pattern))` would find them."""
+    pattern_parts = pattern.split('/')
+    matches = []
+    for relative_path in directories:
+        parts = relative_path.split('/')
+        if len(parts) == len(pattern_parts) and all(fnmatch.fnmatch(part, p) for part, p in zip(parts, pattern_parts)):
+            matches.append(root / relative_path)
+
+    return sorted(matches)
+
+def first_match(path:Optional[pathlib.Path], pattern:str) -> Optional[pathlib.Path]:
+    if path is None:
+        return None
+
+    return next(iter(sorted(path.glob(pattern))), None)
+
+def match_file(root:Optional[pathlib.Path], directories:dict[str, float], max_depth:int, path:Optional[pathlib.Path],
+               pattern:str) -> Optional[pathlib.Path]:
+    """
+    `first_match(path, pattern)` for a `path` under `root`, with the directories
+    of `pattern` matched among those walked under `root` (down to `max_depth`)
+    rather than globbed, so only the file itself is looked for on disk.
+    """
+    if path is None:
+        return None
+    *directory_parts, filename = pattern.split('/')
+    relative_path = path.relative_to(root).as_posix() if root is not None and path.is_relative_to(root) else None
+    if relative_path is None:
+        return first_match(path, pattern)
+    parts = [*([glob.escape(relative_path)] if relative_path != '.' else []), *directory_parts]
+    if len(parts) > max_depth:
+        return first_match(path, pattern)
+
+    matches = match_directories(root, directories, '/'.join(parts)) if parts else [root]
+    return next((directory / filename for directory in matches if (directory / filename).exists()), None)
+
+def get_day(npexp_path:pathlib.Path, session:'np_session.Session') -> str:
+    """Day of the session in the mouse's DRpilot sessions, from 1."""
+    sessions_mouse = sorted(list(npexp_path.parent.glob('DRpilot*{}*'.format(session.mouse))))
+    day = [i + 1 for i in range(len(sessions_mouse)) if str(session.id) in str(sessions_mouse[i])][0]
+    return str(day)
+
+def get_probe_paths(probe:str, npexp_path:pathlib.Path, npexp_directories:dict[str, float],
+                    datajoint_path:Optional[pathlib.Path], datajoint_directories:dict[str, float]) -> dict[str, Optional[pathlib.Path]]:
+    """Artifacts of one probe for a regular session, with sorted data on datajoint."""
+    metrics_path = next((path / 'metrics.csv' for path in match_directories(datajoint_path, datajoint_directories, '*{}*/*/*100*'.format(probe))
+                         if (path / 'metrics.csv').exists()), None) if datajoint_path is not None else None
+    ap_path = metrics_path.parent if metrics_path is not None else None
+    event_path = ap_path.parent.parent / 'events' if ap_path is not None else None
+    continuous_path = next(iter(match_directories(npexp_path, npexp_directories, '*/*/*/*/continuous/*{}-AP'.format(probe))), None)
+    continuous_path = continuous_path.parent if continuous_path is not None else None
+    state_event_path = continuous_path.parent / 'events' if continuous_path is not None else None
+
+    return {
+        'metrics_path': metrics_path,
+        'ap_path': ap_path,
+        'event_path': event_path,
+        'continuous_path': continuous_path,
+        'state_event_path': state_event_path,
+        'states_path': match_file(npexp_path, npexp_directories, NPEXP_WALK_DEPTH, state_event_path, '*{}-AP/*/states.npy'.format(probe)),
+        'event_timestamps_path': match_file(datajoint_path, datajoint_directories, DATAJOINT_WALK_DEPTH, event_path, '*/*/event_timestamps.npy'),
+        'ap_sample_numbers_path': None,
+        'spike_sample_numbers_path': None,
+        'lfp_sample_numbers_path': match_file(npexp_path, npexp_directories, NPEXP_WALK_DEPTH, continuous_path, '*{}-LFP/sample_numbers.npy'.format(probe)),
+        'lfp_continuous_path': match_file(npexp_path, npexp_directories, NPEXP_WALK_DEPTH, continuous_path, '*{}-LFP/continuous.dat'.format(probe)),
+    }
+
+def get_weird_probe_paths(probe:str, metrics_path:pathlib.Path, npexp_path:pathlib.Path,
+                          npexp_directories:dict[str, float]) -> dict[str, Optional[pathlib.Path]]:
+    """Artifacts of one probe for 626791 sessions, sorted next to the raw data."""
+    ap_path = metrics_path.parent
+    event_path = ap_path.parent.parent / 'events'
+    continuous_path = ap_path.parent
+
+    return {
+        'metrics_path': metrics_path,
+        'ap_path': ap_path,
+        'event_path': event_path,
+        'continuous_path': continuous_path,
+        'state_event_path': event_path,
+        'states_path': match_file(npexp_path, npexp_directories, NPEXP_WALK_DEPTH, event_path, '*{}-AP/*/states.npy'.format(probe)),
+        'event_timestamps_path': None,
+        'ap_sample_numbers_path': match_file(npexp_path, npexp_directories, NPEXP_WALK_DEPTH, event_path, '*{}-AP/*/sample_numbers.npy'.format(probe)),
+        'spike_sample_numbers_path': match_file(npexp_path, npexp_directories, NPEXP_WALK_DEPTH, ap_path, 'sample_numbers.npy'),
+        'lfp_sample_numbers_path': match_file(npexp_path, npexp_directories, NPEXP_WALK_DEPTH, continuous_path, '*{}-LFP/sample_numbers.npy'.format(probe)),
+        'lfp_continuous_path': match_file(npexp_path, npexp_directories, NPEXP_WALK_DEPTH, continuous_path, '*{}-LFP/continuous.dat'.format(probe)),
+    }
+
+def build_session_index(session:'np_session.Session', max_workers:Optional[int]=8) -> dict:
+    """
+    Resolve every per-probe artifact of a session with one walk of the session
+    directory and one of its datajoint directory.
+    """
+    npexp_path = get_npexp_path(session)
+    sdk_outputs_path = pathlib.Path(npexp_path, 'SDK_outputs')
+    sdk_outputs_path.mkdir(exist_ok=True)
+    with profile_stage('get_probe_metrics_path'):
+        probe_metrics_path = get_probe_metrics_path(session)
+
+    with profile_stage('walk_directories'):
+        npexp_directories = walk_directories(npexp_path, NPEXP_WALK_DEPTH, max_workers)
+        datajoint_path = None if is_weird_session(session) else pathlib.Path(session.datajoint_path)
+        datajoint_directories = walk_directories(datajoint_path, DATAJOINT_WALK_DEPTH, max_workers) if datajoint_path is not None else {}
+
+    probes = {}
+    for probe in probe_metrics_path:
+        if is_weird_session(session):
+            probes[probe] = get_weird_probe_paths(probe, pathlib.Path(probe_metrics_path[probe]), npexp_path, npexp_directories)
+        else:
+            probes[probe] = get_probe_paths(probe, npexp_path, npexp_directories, datajoint_path, datajoint_directories)
+
+    directory_mtimes = {npexp_path.as_posix(): npexp_path.stat().st_mtime}
+    directory_mtimes.update({(npexp_path / path).as_posix(): mtime for path, mtime in npexp_directories.items()})
+    if datajoint_path is not None:
+        directory_mtimes[datajoint_path.as_posix()] = datajoint_path.stat().st_mtime
+        directory_mtimes.update({(datajoint_path / path).as_posix(): mtime for path, mtime in datajoint_directories.items()})
+
+    return {
+        'version': SESSION_INDEX_VERSION,
+        'session_id': str(session.id),
+        'npexp_path': npexp_path,
+        'sdk_outputs_path': sdk_outputs_path,
+        'sync_path': first_match(session.npexp_path, '*.h5'),
+        'day': get_day(npexp_path, session),
+        'day_mtime': npexp_path.parent.stat().st_mtime,
+        'probes': probes,
+        'directory_mtimes': directory_mtimes,
+    }
+
+def to_json_paths(value):
+    if isinstance(value, dict):
+        return {key: to_json_paths(item) for key, item in value.items()}
+    if isinstance(value, pathlib.PurePath):
+        return value.as_posix()
+    return value
+
+def from_json_paths(session_index:dict) -> dict:
+    path_keys = ('npexp_path', 'sdk_outputs_path', 'sync_path')
+    session_index.update({key: pathlib.Path(session_index[key]) if session_index[key] is not None else None for key in path_keys})
+    session_index['probes'] = {probe: {key: pathlib.Path(path) if path is not None else None for key, path in paths.items()}
+                               for probe, paths in session_index['probes'].items()}
+    return session_index
+
+def get_mtime(path:str) -> Optional[float]:
+    try:
+        return pathlib.Path(path).stat().st_mtime
+    except OSError:
+        return None
+
+def is_session_index_current(session_index:dict, max_workers:Optional[int]=8) -> bool:
+    """Whether no directory walked to build the index has been modified since."""
+    paths = list(session_index['directory_mtimes'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        mtimes = executor.map(get_mtime, paths)
+        return all(mtime == session_index['directory_mtimes'][path] for path, mtime in zip(paths, mtimes))
+
+def read_session_index(index_path:pathlib.Path, session:'np_session.Session', max_workers:Optional[int]=8) -> Optional[dict]:
+    if not index_path.exists():
+        return None
+    with open(index_path, 'r') as f:
+        session_index = json.load(f)
+
+    if session_index.get('version') != SESSION_INDEX_VERSION or session_index.get('session_id') != str(session.id):
+        return None
+    if not is_session_index_current(session_index, max_workers):
+        return None
+
+    session_index = from_json_paths(session_index)
+    if get_mtime(session_index['npexp_path'].parent) != session_index['day_mtime']:
+        session_index['day'] = get_day(session_index['npexp_path'], session)
+        session_index['day_mtime'] = get_mtime(session_index['npexp_path'].parent)
+        write_session_index(index_path, session_index)
+
+    return session_index
+
+def write_session_index(index_path:pathlib.Path, session_index:dict) -> None:
+    # unique per thread, as indexes of one session may be built by several at once
+    tmp_path = index_path.with_name(f'{index_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(to_json_paths(session_index), f, indent=2)
+    os.replace(tmp_path, index_path)
+
+def get_session_index(session:'np_session.Session', use_cache:bool=True, max_workers:Optional[int]=8) -> dict:
+    """
+    Paths of every per-probe artifact of a session (`probes[letter][key]`), plus
+    `npexp_path`, `sdk_outputs_path`, `sync_path` and `day`.
+
+    The index is kept in memory and in `SDK_outputs/session_index.json`, and is
+    rebuilt if any directory walked to build it has been modified. The
+    directories of an index in memory are checked again at most every
+    `SESSION_INDEX_RECHECK_INTERVAL` seconds.
+
+    The lock on the indexes in memory is only held to look them up and publish
+    one, not while directories are checked or walked, so threads indexing other
+    sessions aren't held up (threads indexing the same session may each build it).
+    """
+    session_id = str(session.id)
+    with _session_indexes_lock:
+        session_index = _session_indexes.get(session_id) if use_cache else None
+        check_time = _session_index_check_times.get(session_id)
+
+    if session_index is not None:
+        if time.monotonic() - check_time < SESSION_INDEX_RECHECK_INTERVAL:
+            return session_index
+        if is_session_index_current(session_index, max_workers):
+            with _session_indexes_lock:
+                _session_index_check_times[session_id] = time.monotonic()
+            return session_index
+
+    index_path = pathlib.Path(get_npexp_path(session), 'SDK_outputs', SESSION_INDEX_FILENAME)
+    session_index = read_session_index(index_path, session, max_workers) if use_cache else None
+    if session_index is None:
+        logger.info(f'Indexing files for session {session.id}')
+        session_index = build_session_index(session, max_workers)
+        write_session_index(index_path, session_index)
+
+    with _session_indexes_lock:
+        _session_indexes[session_id] = session_index
+        _session_index_check_times[session_id] = time.monotonic()
+    return session_index
+
+def get_probe_path(session:'np_session.Session', probe:str, key:str, staged:bool=False) -> pathlib.Path:
+    """
+    Path of one artifact of a probe (letter or `probeX`), raising if it wasn't found.
+
+    With `staged`, the path of its local copy if staging is on (see `staging.stage_file`),
+    for files that are only read: outputs are written next to the original.
+    """
+    path = get_session_index(session)['probes'][probe[-1]][key]
+    if path is None:
+        raise FileNotFoundError(f'No {key} found for probe {probe[-1]} in session {session.id}')
+
+    return stage_file(path) if staged else path
+
+def clear_session_indexes() -> None:
+    with _session_indexes_lock:
+        _session_indexes.clear()
+        _session_index_check_times.clear()
@@ -0,0 +1,296 @@
+import os
+import uuid
+import hashlib
+import pathlib
+import threading
+import contextlib
+import time
+import json
+import np_logging
+import concurrent.futures
+from np_probes.profiling import profile_stage
+from typing import TYPE_CHECKING, Optional, Union, Iterable, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+if TYPE_CHECKING:
+    import np_session
+
+logger = np_logging.getLogger(__name__)
+
+STAGING_DIR_ENV = 'NP_PROBES_STAGING_DIR'
+STAGING_MAX_BYTES_ENV = 'NP_PROBES_STAGING_MAX_BYTES'
+# pin file of the open `pin_staged_files` block, inherited by worker processes
+STAGING_PIN_ENV = 'NP_PROBES_STAGING_PIN'
+DEFAULT_STAGING_MAX_BYTES = 200 * 1024**3
+COPY_BLOCK_BYTES = 16 * 1024**2
+# Kilosort and ecephys outputs read from each probe's `ap_path`
+KILOSORT_FILES = ('spike_times.npy', 'spike_clusters.npy', 'amplitudes.npy', 'spike_templates.npy', 'templates.npy',
+                  'whitening_mat_inv.npy', 'mean_waveforms.npy', 'metrics.csv', 'waveform_metrics.csv')
+# session index keys of per-probe input files
+PROBE_INPUT_KEYS = ('metrics_path', 'states_path', 'event_timestamps_path', 'ap_sample_numbers_path',
+                    'spike_sample_numbers_path', 'lfp_sample_numbers_path')
+
+_staging_locks: dict[str, threading.Lock] = {}
+_staging_locks_lock = threading.Lock()
+
+def get_staging_dir() -> Optional[pathlib.Path]:
+    """Local staging directory, `NP_PROBES_STAGING_DIR`; staging is off if it isn't set."""
+    staging_dir = os.environ.get(STAGING_DIR_ENV)
+    return pathlib.Path(staging_dir) if staging_dir else None
+
+def get_staging_max_bytes() -> int:
+    return int(os.environ.get(STAGING_MAX_BYTES_ENV, DEFAULT_STAGING_MAX_BYTES))
+
+def get_source_key(path:pathlib.Path, stat:os.stat_result) -> str:
+    return hashlib.sha1(f'{path.as_posix()}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+
+def get_staging_lock(key:str) -> threading.Lock:
+    with _staging_locks_lock:
+        return _staging_locks.setdefault(key, threading.Lock())
+
+@contextlib.contextmanager
+def lock_staging_dir(staging_dir:pathlib.Path, exclusive:bool=False) -> Iterator[None]:
+    """
+    Lock shared by processes using `staging_dir`: shared while a copy is
+    looked up or added and pinned, exclusive while copies are evicted. Does
+    nothing without `fcntl` (Windows).
+    """
+    if fcntl is None:
+        yield
+        return
+
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    with open(pathlib.Path(staging_dir, 'lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def is_process_running(pid:int) -> bool:
+    if os.name != 'posix':
+        # os.kill would end the process: pins of a crashed run are kept
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def pin_staged(object_path:pathlib.Path) -> None:
+    """Add a staged copy to the pin file of the open `pin_staged_files` block, if any."""
+    pin_path = os.environ.get(STAGING_PIN_ENV)
+    if not pin_path:
+        return
+    # single short appends, so lines from several processes don't interleave
+    with open(pin_path, 'a') as f:
+        f.write(object_path.as_posix() + '\n')
+
+def get_pinned_paths(staging_dir:pathlib.Path) -> set[pathlib.Path]:
+    """Staged copies pinned by running processes. Pin files of processes that have exited are deleted."""
+    pinned = set()
+    for pin_path in pathlib.Path(staging_dir, 'pins').glob('*.txt'):
+        if not is_process_running(int(pin_path.stem.split('-')[0])):
+            pin_path.unlink(missing_ok=True)
+            continue
+        with contextlib.suppress(OSError):
+            pinned.update(pathlib.Path(line) for line in pin_path.read_text().splitlines() if line)
+
+    return pinned
+
+@contextlib.contextmanager
+def pin_staged_files(staging_dir:Optional[Union[str, pathlib.Path]]=None) -> Iterator[None]:
+    """
+    Keep every file staged inside the `with` block, by this process or worker
+    processes started in it, from being evicted until the block exits (e.g.
+    the inputs of a session, while its stages read them), even if the cache
+    goes over its size meanwhile. Nested blocks share the outer block's pins.
+    """
+    staging_dir = pathlib.Path(staging_dir) if staging_dir is not None else get_staging_dir()
+    if staging_dir is None or os.environ.get(STAGING_PIN_ENV):
+        yield
+        return
+
+    pin_path = pathlib.Path(staging_dir, 'pins', f'{os.getpid()}-{uuid.uuid4().hex}.txt')
+    pin_path.parent.mkdir(parents=True, exist_ok=True)
+    pin_path.touch()
+    os.environ[STAGING_PIN_ENV] = str(pin_path)
+    try:
+        yield
+    finally:
+        os.environ.pop(STAGING_PIN_ENV, None)
+        pin_path.unlink(missing_ok=True)
+
+def read_staged_ref(ref_path:pathlib.Path, stat:os.stat_result) -> Optional[pathlib.Path]:
+    """Staged copy recorded for a source file, if it still matches the source's size and mtime."""
+    try:
+        with open(ref_path, 'r') as f:
+            ref = json.load(f)
+        object_stat = pathlib.Path(ref['object_path']).stat()
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if ref['size'] != stat.st_size or ref['mtime_ns'] != stat.st_mtime_ns or object_stat.st_size != stat.st_size:
+        return None
+
+    return pathlib.Path(ref['object_path'])
+
+def copy_to_staging(path:pathlib.Path, stat:os.stat_result, staging_dir:pathlib.Path) -> pathlib.Path:
+    """
+    Copy a file to `objects/<sha1 of its content>/<name>`, hashing it as it is
+    copied, so a file reached by several paths is stored once. The copy is
+    moved into place and pinned under the staging lock, so it can't be
+    evicted before it is pinned.
+    """
+    tmp_dir = pathlib.Path(staging_dir, 'tmp')
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = pathlib.Path(tmp_dir, uuid.uuid4().hex)
+    content_hash = hashlib.sha1()
+    try:
+        with open(path, 'rb') as source, open(tmp_path, 'wb') as f:
+            while block := source.read(COPY_BLOCK_BYTES):
+                content_hash.update(block)
+                f.write(block)
+
+        object_path = pathlib.Path(staging_dir, 'objects', content_hash.hexdigest()[:2], content_hash.hexdigest(), path.name)
+        # keep the source mtime, so file fingerprints match the source
+        os.utime(tmp_path, ns=(time.time_ns(), stat.st_mtime_ns))
+        with lock_staging_dir(staging_dir):
+            object_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, object_path)
+            pin_staged(object_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    return object_path
+
+def write_staged_ref(ref_path:pathlib.Path, path:pathlib.Path, stat:os.stat_result, object_path:pathlib.Path) -> None:
+    ref_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = ref_path.with_name(ref_path.name + f'.{uuid.uuid4().hex}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({'source': path.as_posix(), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                   'object_path': object_path.as_posix()}, f, indent=2)
+    os.replace(tmp_path, ref_path)
+
+def touch_staged(object_path:pathlib.Path) -> None:
+    """Mark a staged copy as used now (its atime), keeping its mtime."""
+    with contextlib.suppress(OSError):
+        os.utime(object_path, ns=(time.time_ns(), object_path.stat().st_mtime_ns))
+
+def evict_staged(staging_dir:pathlib.Path, max_bytes:int, keep:Iterable[pathlib.Path]=()) -> int:
+    """
+    Delete least recently used staged copies until the cache is under `max_bytes`,
+    returning the bytes freed. Copies in `keep` or pinned by a running process
+    (see `pin_staged_files`) are not deleted.
+    """
+    with lock_staging_dir(staging_dir, exclusive=True):
+        return _evict_staged(staging_dir, max_bytes, {pathlib.Path(path) for path in keep} | get_pinned_paths(staging_dir))
+
+def _evict_staged(staging_dir:pathlib.Path, max_bytes:int, keep:set[pathlib.Path]) -> int:
+    staged = []
+    for object_path in pathlib.Path(staging_dir, 'objects').glob('*/*/*'):
+        try:
+            stat = object_path.stat()
+        except OSError:
+            continue
+        staged.append((stat.st_atime, stat.st_size, object_path))
+
+    total = sum(size for _, size, _ in staged)
+    freed = 0
+    for _, size, object_path in sorted(staged, key=lambda item: item[0]):
+        if total - freed <= max_bytes:
+            break
+        if object_path in keep:
+            continue
+        # refs to a deleted copy are misses, so they are left to be overwritten
+        object_path.unlink(missing_ok=True)
+        with contextlib.suppress(OSError):
+            object_path.parent.rmdir()
+        freed += size
+
+    if freed:
+        logger.info(f'Evicted {freed} bytes from {staging_dir}')
+    return freed
+
+def stage_file(path:Union[str, pathlib.Path], staging_dir:Optional[Union[str, pathlib.Path]]=None,
+               max_bytes:Optional[int]=None) -> pathlib.Path:
+    """
+    Local copy of a file on a network share, copied on first use and reused while
+    the source's size and mtime are unchanged. Least recently used copies are
+    evicted to keep the cache under `max_bytes` (`NP_PROBES_STAGING_MAX_BYTES`).
+
+    Inside `pin_staged_files`, the copy is kept until the block exits;
+    otherwise only until the next file is staged, so callers reading staged
+    files over a run should pin them.
+
+    Returns `path` unchanged if staging is off (`NP_PROBES_STAGING_DIR` isn't
+    set), or if it isn't a file, for the caller to read or raise as before.
+    """
+    path = pathlib.Path(path)
+    staging_dir = pathlib.Path(staging_dir) if staging_dir is not None else get_staging_dir()
+    if staging_dir is None:
+        return path
+    try:
+        stat = path.stat()
+    except OSError:
+        return path
+    if not path.is_file():
+        return path
+
+    key = get_source_key(path, stat)
+    ref_path = pathlib.Path(staging_dir, 'refs', key[:2], f'{key}.json')
+    with get_staging_lock(key):
+        with lock_staging_dir(staging_dir):
+            object_path = read_staged_ref(ref_path, stat)
+            if object_path is not None:
+                touch_staged(object_path)
+                pin_staged(object_path)
+                return object_path
+
+        logger.info(f'Staging {path} ({stat.st_size} bytes)')
+        with profile_stage('stage_file'):
+            object_path = copy_to_staging(path, stat, staging_dir)
+        write_staged_ref(ref_path, path, stat, object_path)
+
+    evict_staged(staging_dir, max_bytes if max_bytes is not None else get_staging_max_bytes(), keep=[object_path])
+    return object_path
+
+def get_session_input_paths(session:'np_session.Session', with_lfp:bool=True) -> list[pathlib.Path]:
+    """Network-share files read by the pipeline for a session: sync, per-probe and warped channel files."""
+    from np_probes.session_index import get_session_index
+    from np_probes.probe_channel_units import get_tissuecyte_path
+
+    session_index = get_session_index(session)
+    paths = [session_index['sync_path']]
+    for probe_paths in session_index['probes'].values():
+        paths.extend(probe_paths[key] for key in PROBE_INPUT_KEYS)
+        if probe_paths['ap_path'] is not None:
+            paths.extend(pathlib.Path(probe_paths['ap_path'], name) for name in KILOSORT_FILES)
+        if with_lfp:
+            paths.append(probe_paths['lfp_continuous_path'])
+    paths.extend(sorted(pathlib.Path(get_tissuecyte_path(), str(session.mouse)).glob('Probe_*_warped.csv')))
+
+    return list(dict.fromkeys(path for path in paths if path is not None and path.is_file()))
+
+def prefetch_session_inputs(session:'np_session.Session', with_lfp:bool=True, max_workers:Optional[int]=8) -> dict[str, pathlib.Path]:
+    """
+    Stage a session's input files ahead of the stages that read them, several at
+    once (copying from a network share is mostly waiting). Source path -> staged path.
+
+    Run inside `pin_staged_files`, so the copies are still there when the
+    stages read them.
+    """
+    staging_dir = get_staging_dir()
+    if staging_dir is None:
+        return {}
+
+    paths = get_session_input_paths(session, with_lfp)
+    logger.info(f'Prefetching {len(paths)} input files for session {session.id} to {staging_dir}')
+    with profile_stage('prefetch_session_inputs'), concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return {path.as_posix(): staged_path for path, staged_path in zip(paths, executor.map(stage_file, paths))}
@@ -0,0 +1,146 @@
+import os
+import ast
+import uuid
+import pathlib
+import numpy as np
+import np_logging
+from np_probes.profiling import profiled
+from typing import TYPE_CHECKING, Optional, Union, Sequence
+
+if TYPE_CHECKING:
+    import np_session
+
+logger = np_logging.getLogger(__name__)
+
+SYNC_CHUNK_SIZE = 10_000_000
+SYNC_EDGES_FILENAME = '{}_edges.npz'
+SYNC_BARCODE_LINE_LABELS = ('barcode', 'barcodes', 'barcode_ephys')
+COUNTER_ROLLOVER = 1 << 32
+
+def read_sync_meta(sync_h5_path:Union[str, pathlib.Path]) -> dict:
+    import h5py
+
+    with h5py.File(sync_h5_path, 'r') as f:
+        meta = f['meta'][()]
+    return ast.literal_eval(meta.decode() if isinstance(meta, bytes) else meta)
+
+def get_sync_line_bit(line_labels:Sequence[str], line:Union[int, str]) -> int:
+    """Bit of a sync line, given its number or label; `barcode` finds any of `SYNC_BARCODE_LINE_LABELS`."""
+    if isinstance(line, (int, np.integer)):
+        return int(line)
+    labels = SYNC_BARCODE_LINE_LABELS if line in SYNC_BARCODE_LINE_LABELS else (line,)
+    bits = [list(line_labels).index(label) for label in labels if label in line_labels]
+    if not bits:
+        raise ValueError(f'No sync line labelled {line}: lines are {list(line_labels)}')
+    return bits[0]
+
+def extract_line_edges(sync_h5_path:Union[str, pathlib.Path], bits:Sequence[int], counter_bits:Optional[int]=32,
+                       chunk_size:int=SYNC_CHUNK_SIZE) -> dict[int, tuple[np.ndarray, np.ndarray]]:
+    """
+    Rising and falling edge sample counts of each line in `bits`, read from a
+    sync `.h5` file `chunk_size` events at a time, with counter rollovers
+    corrected if the counter isn't 32 bits. As in `get_sync_barcodes`, the
+    first event is never an edge.
+    """
+    import h5py
+
+    bits = np.asarray(bits, dtype=np.uint32)
+    rising: list[list[np.ndarray]] = [[] for _ in bits]
+    falling: list[list[np.ndarray]] = [[] for _ in bits]
+    previous_time = previous_states = None
+    rollovers = 0
+    with h5py.File(sync_h5_path, 'r') as f:
+        events = f['data']
+        for start in range(0, len(events), chunk_size):
+            chunk = events[start:start + chunk_size]
+            times = chunk[:, 0].astype(np.int64)
+            # lines x events
+            states = ((chunk[:, -1].astype(np.uint32) >> bits[:, None]) & 1).astype(np.int8)
+            if previous_time is None:
+                previous_time, previous_states = times[0], states[:, :1]
+
+            if counter_bits != 32:
+                wrapped = np.cumsum(np.diff(times, prepend=previous_time) < 0)
+                previous_time = times[-1]
+                times += (rollovers + wrapped) * COUNTER_ROLLOVER
+                rollovers += int(wrapped[-1])
+
+            changes = np.diff(states, axis=1, prepend=previous_states)
+            previous_states = states[:, -1:]
+            for line_index, line_changes in enumerate(changes):
+                rising[line_index].append(times[line_changes == 1])
+                falling[line_index].append(times[line_changes == -1])
+
+    return {int(bit): (np.concatenate(rising[line_index] or [np.empty(0, dtype=np.int64)]),
+                       np.concatenate(falling[line_index] or [np.empty(0, dtype=np.int64)]))
+            for line_index, bit in enumerate(bits)}
+
+def read_sync_edges_cache(cache_path:pathlib.Path, stat:os.stat_result) -> Optional[dict]:
+    """Cached edges of a sync file, if the file's size and mtime are unchanged."""
+    try:
+        with np.load(cache_path, allow_pickle=False) as cache:
+            cache = dict(cache)
+    except (OSError, ValueError):
+        return None
+    if int(cache['source_size']) != stat.st_size or int(cache['source_mtime_ns']) != stat.st_mtime_ns:
+        return None
+    return cache
+
+def write_sync_edges_cache(cache_path:pathlib.Path, cache:dict) -> None:
+    tmp_path = cache_path.with_name(f'{cache_path.name}.{uuid.uuid4().hex}.tmp.npz')
+    try:
+        np.savez(tmp_path, **cache)
+        os.replace(tmp_path, cache_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+@profiled('sync_edges')
+def get_sync_line_edges(sync_h5_path:Union[str, pathlib.Path], lines:Sequence[Union[int, str]]=('barcode',),
+                        cache_path:Optional[Union[str, pathlib.Path]]=None) -> tuple[dict[Union[int, str], tuple[np.ndarray, np.ndarray]], float]:
+    """
+    Rising and falling edge times (s) of sync `lines` (numbers or labels), and
+    the sample frequency of the sync clock.
+
+    With `cache_path`, edges are saved there as a small `.npz`, keyed by the sync
+    file's size and mtime, and lines already in it are not read again.
+    """
+    sync_h5_path = pathlib.Path(sync_h5_path)
+    stat = sync_h5_path.stat()
+    cache = read_sync_edges_cache(pathlib.Path(cache_path), stat) if cache_path is not None else None
+    if cache is None:
+        meta_data = read_sync_meta(sync_h5_path)
+        cache = {
+            'source_size': np.int64(stat.st_size),
+            'source_mtime_ns': np.int64(stat.st_mtime_ns),
+            'line_labels': np.array(meta_data['line_labels'], dtype=str),
+            'sample_frequency': np.float64(meta_data['ni_daq']['counter_output_freq']),
+            'counter_bits': np.int64(meta_data['ni_daq'].get('counter_bits') or 0),
+        }
+
+    bits = {line: get_sync_line_bit(cache['line_labels'].tolist(), line) for line in lines}
+    missing = sorted({bit for bit in bits.values() if f'rising_{bit}' not in cache})
+    if missing:
+        logger.info(f'Extracting sync lines {missing} from {sync_h5_path}')
+        counter_bits = int(cache['counter_bits']) or None
+        for bit, (rising, falling) in extract_line_edges(sync_h5_path, missing, counter_bits).items():
+            cache[f'rising_{bit}'], cache[f'falling_{bit}'] = rising, falling
+        if cache_path is not None:
+            write_sync_edges_cache(pathlib.Path(cache_path), cache)
+
+    sample_frequency = float(cache['sample_frequency'])
+    edges = {line: (cache[f'rising_{bit}'] / sample_frequency, cache[f'falling_{bit}'] / sample_frequency)
+             for line, bit in bits.items()}
+    return edges, sample_frequency
+
+def get_sync_edges_path(session:'np_session.Session') -> pathlib.Path:
+    """`SDK_outputs/<sync file stem>_edges.npz`"""
+    from np_probes.session_index import get_session_index
+
+    session_index = get_session_index(session)
+    return pathlib.Path(session_index['sdk_outputs_path'], SYNC_EDGES_FILENAME.format(pathlib.Path(session_index['sync_path']).stem))
+
+def get_session_sync_line_edges(session:'np_session.Session', lines:Sequence[Union[int, str]]=('barcode',)) -> dict[Union[int, str], tuple[np.ndarray, np.ndarray]]:
+    """Rising and falling edge times (s) of a session's sync `lines`, cached in `SDK_outputs`."""
+    from np_probes.session_index import get_session_index
+
+    return get_sync_line_edges(get_session_index(session)['sync_path'], lines, cache_path=get_sync_edges_path(session))[0]
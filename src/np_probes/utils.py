@@ -1,23 +1,51 @@
 import re
-import np_session
 import pathlib
 import np_logging
-import pynwb
 import uuid
-from typing import Union, Optional
+import contextlib
+from typing import TYPE_CHECKING, Union, Optional, Iterator, Sequence
 import tempfile
+from np_probes.profiling import profiled
+
+if TYPE_CHECKING:
+    import np_session
+    import pynwb
 
 logger = np_logging.getLogger(__name__)
 
+NWB_BACKENDS = ('hdf5', 'zarr')
+NWB_SUFFIXES = {'hdf5': '.nwb', 'zarr': '.nwb.zarr'}
+# dataset compressions supported by each backend (see `data_io.get_data_io`)
+NWB_COMPRESSIONS = {'hdf5': ('gzip', 'lzf', 'blosc'), 'zarr': ('gzip', 'blosc', 'zstd')}
+
+def import_hdmf_zarr():
+    try:
+        import hdmf_zarr.nwb
+    except ImportError as e:
+        raise ImportError("backend='zarr' requires hdmf-zarr: install np_probes[zarr]") from e
+    return hdmf_zarr
+
+def is_zarr_nwb(nwb_path: Union[str, pathlib.Path]) -> bool:
+    """NWB-Zarr files are directory stores."""
+    return pathlib.Path(nwb_path).is_dir()
+
+def get_nwb_size(nwb_path: Union[str, pathlib.Path]) -> int:
+    """Bytes in an NWB file, or in every file of an NWB-Zarr directory."""
+    nwb_path = pathlib.Path(nwb_path)
+    if not nwb_path.is_dir():
+        return nwb_path.stat().st_size
+    return sum(path.stat().st_size for path in nwb_path.rglob('*') if path.is_file())
 
 def init_nwb(
-    session: np_session.Session,
+    session: 'np_session.Session',
     description: str = 'Data and metadata for a Neuropixels ecephys session',
-) -> pynwb.NWBFile:
+) -> 'pynwb.NWBFile':
     """
     Init `NWBFile` with minimum required arguments from an
     `np_session.Session` instance.
     """
+    import pynwb
+
     return pynwb.NWBFile(
         session_description=description,
         identifier=str(uuid.uuid4()),  # globally unique for this nwb - not human-readable
@@ -27,35 +55,181 @@ def init_nwb(
 
 def load_nwb(
     nwb_path: Union[str, pathlib.Path],
-    ) -> pynwb.NWBFile:
-    """Load `pynb.NWBFile` instance from path."""
+    ) -> 'pynwb.NWBFile':
+    """
+    Load `pynb.NWBFile` instance from path (HDF5, or an NWB-Zarr directory).
+
+    The file is closed on return, so datasets that weren't read can't be
+    accessed: use `open_nwb` to keep them readable.
+    """
+    import pynwb
+
     logger.info(f'Loading .nwb file at {nwb_path}')
-    with pynwb.NWBHDF5IO(nwb_path, mode='r') as f:
+    io_class = import_hdmf_zarr().nwb.NWBZarrIO if is_zarr_nwb(nwb_path) else pynwb.NWBHDF5IO
+    with io_class(str(nwb_path), mode='r') as f:
         return f.read()
 
 
+@contextlib.contextmanager
+def open_nwb(
+    nwb_path: Union[str, pathlib.Path],
+    mode: str = 'r',
+    rdcc_nbytes: Optional[int] = None,
+    rdcc_nslots: Optional[int] = None,
+    processing_modules: Optional[Sequence[str]] = None,
+    ) -> Iterator['pynwb.NWBFile']:
+    """
+    Open `pynb.NWBFile` instance from path, keeping the file open until the
+    `with` block exits.
+
+    Datasets are h5py datasets read on access, so only the slices that are
+    indexed are read from disk. `rdcc_nbytes` and `rdcc_nslots` set the HDF5
+    chunk cache (1 MiB per dataset by default), e.g. to hold a whole row of
+    chunks when reading time slices of compressed LFP.
+
+    With `processing_modules`, only those processing modules are kept on the
+    returned file.
+
+    NWB-Zarr directories are opened with `NWBZarrIO`, whose datasets are zarr
+    arrays: chunks are read independently, so several processes can read one
+    file at once. The HDF5 chunk cache settings don't apply.
+    """
+    import pynwb
+
+    logger.info(f'Opening .nwb file at {nwb_path}')
+    with contextlib.ExitStack() as stack:
+        if is_zarr_nwb(nwb_path):
+            io = stack.enter_context(import_hdmf_zarr().nwb.NWBZarrIO(str(nwb_path), mode=mode))
+        else:
+            import h5py
+            h5_file = stack.enter_context(h5py.File(nwb_path, mode=mode, rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots))
+            io = stack.enter_context(pynwb.NWBHDF5IO(file=h5_file, mode=mode))
+        nwb_file = io.read()
+        if processing_modules is not None:
+            missing = set(processing_modules) - set(nwb_file.processing)
+            if missing:
+                raise KeyError(f"No processing module {', '.join(sorted(missing))} in {nwb_path}")
+            for name in set(nwb_file.processing) - set(processing_modules):
+                nwb_file.processing.pop(name)
+        yield nwb_file
+
+
+@profiled()
 def save_nwb(
-    nwb_file: pynwb.NWBFile,
+    nwb_file: 'pynwb.NWBFile',
     output_path: Optional[Union[str, pathlib.Path]] = None,
+    backend: str = 'hdf5',
+    number_of_jobs: int = 1,
     ) -> Union[str, pathlib.Path]:
     """
     Write `pynb.NWBFile` instance to disk.
     
     Temp dir is used if `output_path` isn't provided.
+
+    With `backend='zarr'` the file is an NWB-Zarr directory store (requires
+    hdmf-zarr), and datasets wrapped by `data_io.get_data_io(..., backend='zarr')`
+    are written `number_of_jobs` buffers at a time, in worker processes.
     """
+    import pynwb
+
+    if backend not in NWB_BACKENDS:
+        raise ValueError(f'Unknown backend {backend!r}: expected one of {", ".join(NWB_BACKENDS)}')
     if output_path is None:
-        output_path = pathlib.Path(tempfile.mkdtemp()) / f'{nwb_file.session_id}.nwb'
+        output_path = pathlib.Path(tempfile.mkdtemp()) / f'{nwb_file.session_id}{NWB_SUFFIXES[backend]}'
     
     nwb_file.set_modified()
     # not clear if this is necessary, but suggested by docs:
     # https://pynwb.readthedocs.io/en/stable/_modules/pynwb.html
 
     logger.info(f'Writing .nwb file `{nwb_file.session_id!r}` to {output_path}')
-    with pynwb.NWBHDF5IO(output_path, mode='w') as f:
-        f.write(nwb_file, cache_spec=True)
+    if backend == 'zarr':
+        with import_hdmf_zarr().nwb.NWBZarrIO(str(output_path), mode='w') as f:
+            f.write(nwb_file, cache_spec=True, number_of_jobs=number_of_jobs)
+    else:
+        with pynwb.NWBHDF5IO(output_path, mode='w') as f:
+            f.write(nwb_file, cache_spec=True)
     logger.debug(f'Writing complete for nwb file `{nwb_file.session_id!r}`')
     return output_path
 
+def is_resizable(dataset) -> bool:
+    """Whether rows can be appended to a dataset read from a file: zarr arrays always can, h5py datasets if chunked with no row limit."""
+    maxshape = getattr(getattr(dataset, 'dataset', dataset), 'maxshape', None)
+    return maxshape is None or maxshape[0] is None
+
+def extend_dataset(dataset, data) -> None:
+    """
+    Append the rows of `data` to a resizable h5py dataset or zarr array, in
+    place. `data` can be an array, a list, or a `DataIO` or chunk iterator
+    (e.g. from `data_io.get_data_io`), which is written one buffer at a time.
+    """
+    import numpy as np
+    from hdmf.data_utils import DataIO, AbstractDataChunkIterator
+
+    if isinstance(data, DataIO):
+        data = data.data
+    offset = dataset.shape[0]
+    if isinstance(data, AbstractDataChunkIterator):
+        dataset.resize((offset + data.maxshape[0], *dataset.shape[1:]))
+        for chunk in data:
+            rows = slice(offset + chunk.selection[0].start, offset + chunk.selection[0].stop)
+            dataset[(rows, *chunk.selection[1:])] = chunk.data
+        return
+
+    data = np.asarray(data, dtype=object if dataset.dtype == object else None)
+    dataset.resize((offset + len(data), *dataset.shape[1:]))
+    dataset[offset:] = data
+
+def check_extendable(table, new_table, renumber_ids: bool = False) -> None:
+    """Raise if `extend_table` can't append the rows of `new_table` to `table`."""
+    import numpy as np
+    from hdmf.common import DynamicTableRegion
+
+    columns = {column.name: column for column in table.columns}
+    new_columns = {column.name for column in new_table.columns}
+    if set(columns) != new_columns:
+        raise ValueError(f'Cannot extend {table.name}: columns differ ({", ".join(sorted(set(columns) ^ new_columns))})')
+    if any(isinstance(column, DynamicTableRegion) for column in columns.values()):
+        raise ValueError(f'Cannot extend {table.name}: it has rows of another table')
+    not_resizable = [name for name, column in (*columns.items(), ('id', table.id)) if not is_resizable(column.data)]
+    if not_resizable:
+        raise ValueError(f'Cannot extend {table.name}: {", ".join(not_resizable)} written with a fixed size')
+    if not renumber_ids and np.intersect1d(np.asarray(table.id.data[:]), np.asarray(new_table.id.data)).size:
+        raise ValueError(f'Cannot extend {table.name}: ids of new rows already in the table')
+
+def extend_table(table, new_table, containers: Optional[dict] = None, renumber_ids: bool = False) -> None:
+    """
+    Append the rows of `new_table`, built in memory, to `table`, read from a
+    file open for appending, by writing to its datasets directly (see
+    `check_extendable`). Container references (e.g. electrode `group`) are
+    appended as the container of the same name in `containers`, which must
+    already be written to the file.
+
+    With `renumber_ids`, for tables whose ids are row numbers, new rows are
+    numbered on from the last id in `table`.
+    """
+    import numpy as np
+    from hdmf.common import VectorIndex
+    from hdmf.query import ContainerResolver
+
+    check_extendable(table, new_table, renumber_ids)
+    columns = {column.name: column for column in table.columns}
+    new_columns = {column.name: column for column in new_table.columns}
+    # ragged column indexes are offset by the length of their data before any is extended
+    offsets = {name: len(column.target.data) for name, column in columns.items() if isinstance(column, VectorIndex)}
+    for name, column in columns.items():
+        data = new_columns[name].data
+        if name in offsets:
+            extend_dataset(column.data, np.asarray(data, dtype=column.data.dtype) + offsets[name])
+        elif isinstance(column.data, ContainerResolver):
+            for container in data:
+                column.data.append(containers[container.name])
+        else:
+            extend_dataset(column.data, data)
+    ids = np.asarray(new_table.id.data)
+    if renumber_ids:
+        ids = np.arange(len(ids)) + (int(table.id.data[-1]) + 1 if len(table.id.data) else 0)
+    extend_dataset(table.id.data, ids)
+
 def get_probes_from_metrics(metrics_path):
     if not metrics_path:
         return {}
@@ -69,7 +243,7 @@ def get_probes_from_metrics(metrics_path):
         return dict(zip(probe_letters, metrics_path))
     return {}
 
-def get_probe_metrics_path(session: np_session.Session) -> dict[str, pathlib.Path]:
+def get_probe_metrics_path(session: 'np_session.Session') -> dict[str, pathlib.Path]:
     if len(list(session.metrics_csv)) == 0:
         metrics_path = list(session.npexp_path.rglob('metrics_test.csv'))
     else:
@@ -0,0 +1,23 @@
+import os
+import pytest
+from np_probes.benchmark import make_synthetic_session
+
+@pytest.fixture(scope='session')
+def synthetic_session(tmp_path_factory):
+    """A one-probe session, 40 s long (the shortest with enough barcodes to align)."""
+    # written with SimpleITK (CCF volume) and h5py (sync file)
+    pytest.importorskip('SimpleITK')
+    pytest.importorskip('h5py')
+    session = make_synthetic_session(tmp_path_factory.mktemp('session'), n_probes=1, duration=40.0, n_units=20)
+    previous_tissuecyte_path = os.environ.get('NP_PROBES_TISSUECYTE_PATH')
+    os.environ['NP_PROBES_TISSUECYTE_PATH'] = str(session.tissuecyte_path)
+    yield session
+    if previous_tissuecyte_path is None:
+        os.environ.pop('NP_PROBES_TISSUECYTE_PATH', None)
+    else:
+        os.environ['NP_PROBES_TISSUECYTE_PATH'] = previous_tissuecyte_path
+
+@pytest.fixture(scope='session')
+def sorted_path(synthetic_session):
+    """Kilosort outputs of the session's probe."""
+    return synthetic_session.probe_letter_to_metrics_csv_path['A'].parent
@@ -0,0 +1,90 @@
+import os
+import pathlib
+import numpy as np
+import pytest
+from np_probes import align_barcode_timestamps
+from np_probes.align_barcode_timestamps import extract_barcodes_from_times, get_align_timestamps_input_dictionary
+from np_probes.align_barcode_timestamps import get_align_timestamps_output_dictionary, check_against_allensdk
+from np_probes.align_barcode_timestamps import get_align_timestamps_input_paths, apply_lfp_sample_number_adjustment
+from np_probes.align_barcode_timestamps import write_adjusted_sample_numbers
+from np_probes.benchmark import get_barcodes, get_barcode_edges, AP_SAMPLING_RATE
+
+def test_barcode_start_times():
+    barcode_times, barcodes = get_barcodes(100.0, np.random.default_rng(0))
+    starts, extracted = extract_barcodes_from_times(*get_barcode_edges(barcode_times, barcodes))
+    # the first barcode is skipped, as in AllenSDK
+    np.testing.assert_array_equal(starts, barcode_times[1:])
+    assert len(np.unique(extracted)) == len(extracted)
+
+def test_barcodes_match_allensdk():
+    pytest.importorskip('allensdk')
+    from allensdk.brain_observatory.ecephys.align_timestamps.barcode import extract_barcodes_from_times as allensdk_extract
+
+    on_times, off_times = get_barcode_edges(*get_barcodes(100.0, np.random.default_rng(0)))
+    # a barcode with no falling edge: dropped with its start time
+    on_times = np.append(on_times, on_times[-1] + 20)
+    starts, barcodes = extract_barcodes_from_times(on_times, off_times)
+    allensdk_starts, allensdk_barcodes = allensdk_extract(on_times, off_times)
+    np.testing.assert_array_equal(barcodes, allensdk_barcodes)
+    np.testing.assert_array_equal(starts, np.asarray(allensdk_starts)[:len(starts)])
+
+def test_numpy_alignment(synthetic_session):
+    output = get_align_timestamps_output_dictionary(synthetic_session, use_cache=False, engine='numpy')
+    [probe] = output['probe_outputs']
+    assert np.ravel(probe['global_probe_sampling_rate'])[0] == pytest.approx(AP_SAMPLING_RATE, rel=1e-4)
+    for path in probe['output_paths'].values():
+        assert np.all(np.diff(np.load(path, mmap_mode='r').ravel()) >= 0)
+
+def test_numpy_alignment_matches_allensdk(synthetic_session):
+    pytest.importorskip('allensdk')
+    check_against_allensdk(get_align_timestamps_input_dictionary(synthetic_session))
+
+def test_alignment_cache_is_invalidated_by_modified_inputs(synthetic_session, monkeypatch):
+    output = get_align_timestamps_output_dictionary(synthetic_session, use_cache=False, engine='numpy')
+    align = align_barcode_timestamps.align_probe_timestamps
+    calls = []
+    monkeypatch.setattr(align_barcode_timestamps, 'align_probe_timestamps', lambda *args, **kwargs: calls.append(1) or align(*args, **kwargs))
+
+    assert get_align_timestamps_output_dictionary(synthetic_session, engine='numpy') == output
+    assert not calls
+
+    # same size, newer mtime
+    input_path = get_align_timestamps_input_paths(get_align_timestamps_input_dictionary(synthetic_session))[-1]
+    stat = os.stat(input_path)
+    os.utime(input_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert get_align_timestamps_output_dictionary(synthetic_session, engine='numpy') == output
+    assert len(calls) == 1
+
+def test_adjusted_sample_numbers_are_written_in_blocks(tmp_path):
+    sample_numbers = np.arange(1000, 1010, dtype=np.int64)
+    write_adjusted_sample_numbers(sample_numbers, tmp_path / 'adjusted.npy', 1000, 12, block_size=3)
+    np.testing.assert_array_equal(np.load(tmp_path / 'adjusted.npy'), (sample_numbers - 1000) * 12)
+
+def test_lfp_sample_number_adjustment_is_only_rewritten_when_stale(tmp_path):
+    sample_number_path = tmp_path / 'sample_numbers.npy'
+    np.save(sample_number_path, np.arange(5, 15, dtype=np.int64)[::-1])
+    adjusted_path = pathlib.Path(apply_lfp_sample_number_adjustment(sample_number_path)['path'])
+    np.testing.assert_array_equal(np.load(adjusted_path), np.arange(0, 10)[::-1] * 12)
+
+    mtime_ns = adjusted_path.stat().st_mtime_ns
+    apply_lfp_sample_number_adjustment(sample_number_path)
+    assert adjusted_path.stat().st_mtime_ns == mtime_ns
+
+    # the lazy adjustment is left for the aligner, on the raw sample numbers
+    assert apply_lfp_sample_number_adjustment(sample_number_path, lazy=True) == {
+        'path': sample_number_path.as_posix(), 'offset': 5, 'scale': 12}
+
+    stat = os.stat(sample_number_path)
+    os.utime(sample_number_path, ns=(stat.st_atime_ns, mtime_ns + 1_000_000_000))
+    apply_lfp_sample_number_adjustment(sample_number_path)
+    assert adjusted_path.stat().st_mtime_ns != mtime_ns
+
+def test_lazy_sample_numbers_match_adjusted_files(synthetic_session):
+    [probe] = get_align_timestamps_output_dictionary(synthetic_session, use_cache=False, engine='numpy')['probe_outputs']
+    # both write the same output files
+    aligned = {name: np.load(path) for name, path in probe['output_paths'].items()}
+    [lazy_probe] = get_align_timestamps_output_dictionary(synthetic_session, use_cache=False, engine='numpy',
+                                                          lazy_sample_numbers=True)['probe_outputs']
+    assert lazy_probe['total_time_shift'] == probe['total_time_shift']
+    for name, path in lazy_probe['output_paths'].items():
+        np.testing.assert_array_equal(np.load(path), aligned[name])
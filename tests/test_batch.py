@@ -0,0 +1,54 @@
+import json
+import types
+import pathlib
+import pytest
+
+pytest.importorskip('pynwb')
+np_session = pytest.importorskip('np_session')
+from np_probes import probes_to_nwb
+from np_probes.batch import process_session, read_checkpoint, get_checkpoint_path, main
+
+def write_lfp_nwb_except_probe_b(probe_dict:dict, output_path:pathlib.Path, **kwargs) -> dict:
+    """`write_lfp_nwb` stand-in, failing for probeB."""
+    if probe_dict['name'] == 'probeB':
+        raise RuntimeError('probeB failed')
+    pathlib.Path(output_path).touch()
+    return {'name': probe_dict['name'], 'path': pathlib.Path(output_path).as_posix()}
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_finished_lfp_nwbs_are_reported_when_another_fails(tmp_path, monkeypatch, processes):
+    monkeypatch.setattr(probes_to_nwb, 'write_lfp_nwb', write_lfp_nwb_except_probe_b)
+    monkeypatch.setattr(probes_to_nwb, 'get_lfp_paths', lambda session, probe: {})
+    names = ['probeA', 'probeC', 'probeB'] if processes == 1 else ['probeA', 'probeB', 'probeC']
+    probes_dictionary = {'probes': [{'id': index, 'name': name, 'channels': [], 'sampling_rate': 30000.0,
+                                     'temporal_subsampling_factor': 2, 'csd_path': None} for index, name in enumerate(names)]}
+    probe_outputs = [{'name': name, 'global_probe_lfp_sampling_rate': [2500.0]} for name in names]
+    session = types.SimpleNamespace(id='session', start=None)
+    written = {}
+    with pytest.raises(RuntimeError, match='probeB failed'):
+        probes_to_nwb.export_lfp_nwbs(session, probes_dictionary, probe_outputs, output_dir=tmp_path, processes=processes,
+                                      on_written=lambda name, stats: written.update({name: stats['path']}))
+    assert sorted(written) == ['probeA', 'probeC']
+    assert all(pathlib.Path(path).exists() for path in written.values())
+
+def test_checkpointed_session_builds_nothing(synthetic_session, tmp_path, monkeypatch):
+    monkeypatch.setattr(np_session, 'Session', lambda *args, **kwargs: synthetic_session)
+    def build(*args, **kwargs):
+        raise AssertionError('probes built for a checkpointed session')
+    monkeypatch.setattr(probes_to_nwb, 'generate_probes_dictionary', build)
+    monkeypatch.setattr(probes_to_nwb, 'generate_probe_tables', build)
+
+    checkpoint_path = get_checkpoint_path(tmp_path, str(synthetic_session.id))
+    done = {'done': True, 'outputs': []}
+    stages = {stage: done for stage in ('alignment', 'lfp_subsampling', 'units_nwb')}
+    stages['lfp_nwb'] = {'probeA': done}
+    checkpoint_path.write_text(json.dumps({'stages': stages}))
+
+    process_session('session', tmp_path)
+    assert read_checkpoint(checkpoint_path)['stages'] == stages
+
+@pytest.mark.parametrize('backend, compression', [('hdf5', 'zstd'), ('zarr', 'lzf')])
+def test_compression_unsupported_by_backend_is_rejected(tmp_path, backend, compression, capsys):
+    with pytest.raises(SystemExit):
+        main(['session', '--output-dir', str(tmp_path), '--backend', backend, '--compression', compression])
+    assert f'--compression {compression} is not supported with --backend {backend}' in capsys.readouterr().err
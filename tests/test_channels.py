@@ -0,0 +1,70 @@
+import os
+import sys
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('SimpleITK')
+from np_probes.probe_channel_units import get_local_annotation_volume, get_annotation_volume, get_channels_table_for_probe
+from np_probes.probe_channel_units import get_channels_table, get_units_table, UNIT_METRICS_COLUMNS
+
+@pytest.fixture
+def annotation_path(synthetic_session, tmp_path):
+    """A copy of the session's annotation volume, to modify."""
+    shutil.copytree(synthetic_session.tissuecyte_path / 'field_reference', tmp_path / 'field_reference')
+    return tmp_path / 'field_reference' / 'ccf_ano.mhd'
+
+def test_annotation_volume_cache_follows_the_source(annotation_path, tmp_path, monkeypatch):
+    cache_dir = tmp_path / 'cache'
+    volume = np.asarray(get_local_annotation_volume(annotation_path, cache_dir))
+    [cached_path] = cache_dir.iterdir()
+
+    # reused without reading the source
+    monkeypatch.setitem(sys.modules, 'SimpleITK', None)
+    np.testing.assert_array_equal(get_local_annotation_volume(annotation_path, cache_dir), volume)
+    monkeypatch.undo()
+
+    # rebuilt, replacing the copy of the earlier source, once the source changes
+    stat = os.stat(annotation_path)
+    os.utime(annotation_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    np.testing.assert_array_equal(get_local_annotation_volume(annotation_path, cache_dir), volume)
+    [rebuilt_path] = cache_dir.iterdir()
+    assert rebuilt_path != cached_path
+
+def test_channels_table_from_ccf_coordinates(synthetic_session):
+    channels = get_channels_table_for_probe('probeA', 7, synthetic_session)
+    ccf = pd.read_csv(synthetic_session.tissuecyte_path / str(synthetic_session.mouse) /
+                      f'Probe_A1_channels_{synthetic_session.mouse}_warped.csv')
+    annotation = get_annotation_volume(synthetic_session.tissuecyte_path / 'field_reference' / 'ccf_ano.mhd')
+
+    assert len(channels) == len(ccf)
+    np.testing.assert_array_equal(channels['id'], ccf['channel'] + 1)
+    np.testing.assert_array_equal(channels['structure_id'], annotation[ccf['AP'], ccf['DV'], ccf['ML']])
+    np.testing.assert_array_equal(channels['structure_acronym'], ccf['region'].fillna('No Area'))
+    np.testing.assert_array_equal(channels['dorsal_ventral_ccf_coordinate'], ccf['DV'] * 25.0)
+    assert (channels['probe_id'] == 7).all()
+    np.testing.assert_array_equal(channels['probe_vertical_position'][:4], [20, 20, 40, 40])
+
+def test_placeholder_channels_table():
+    channels = get_channels_table(3, n_channels=4, first_id=10)
+    np.testing.assert_array_equal(channels['id'], [10, 11, 12, 13])
+    assert (channels['structure_acronym'] == 'No Area').all() and (channels['structure_id'] == -1).all()
+
+def test_units_table_from_metrics():
+    metrics = pd.DataFrame({column: np.arange(4.0) for column in UNIT_METRICS_COLUMNS})
+    metrics['quality'] = ['good', 'noise', 'good', 'good']
+    metrics['snr'] = [1.0, np.inf, np.nan, 2.0]
+    metrics['peak_channel'] = [3, 2, 1, 0]
+    channels = get_channels_table(0, n_channels=4, first_id=100)
+
+    units = get_units_table(metrics, channels, first_id=20)
+    np.testing.assert_array_equal(units['snr'], [1.0, 0.0, 0.0, 2.0])
+    np.testing.assert_array_equal(units['peak_channel_id'], [103, 102, 101, 100])
+    np.testing.assert_array_equal(units['id'], [20, 21, 22, 23])
+
+    # selected before ids are assigned
+    units = get_units_table(metrics, channels.to_dict('records'), first_id=20, units_query="quality == 'good' and snr > 0")
+    np.testing.assert_array_equal(units['cluster_id'], [0.0, 3.0])
+    np.testing.assert_array_equal(units['id'], [20, 21])
+    assert get_units_table(metrics, channels, units_query='snr > 10').empty
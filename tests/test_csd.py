@@ -0,0 +1,14 @@
+import numpy as np
+from np_probes.csd import accumulate_event_windows, get_event_windows
+
+def test_accumulate_event_windows():
+    rng = np.random.default_rng(0)
+    lfp = rng.normal(size=(5000, 8)).astype(np.float32)
+    window = 40
+    starts = get_event_windows(np.arange(len(lfp)) / 2500.0, rng.uniform(0, 2, 300), 10, window - 10)
+    windows = np.stack([lfp[start:start + window] for start in starts])
+
+    # more events in a block than fit in one batch
+    window_sum, std_sum = accumulate_event_windows(lfp, starts, window, block_samples=1000)
+    np.testing.assert_allclose(window_sum, windows.sum(axis=0, dtype=np.float64), rtol=1e-5)
+    np.testing.assert_allclose(std_sum, windows.std(axis=1).sum(axis=0, dtype=np.float64), rtol=1e-5)
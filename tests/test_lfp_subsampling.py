@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('scipy')
+from np_probes.lfp_subsampling import subsample_probe_lfp, select_channels
+
+N_CHANNELS = 64
+# longer than the default filter context either side of a block
+N_SAMPLES = 40_000
+
+@pytest.fixture
+def probe(tmp_path) -> dict:
+    """An LFP `continuous.dat` of slow oscillations plus noise, with its timestamps."""
+    rng = np.random.default_rng(0)
+    t = np.arange(N_SAMPLES)[:, None] / 2500
+    lfp = 200 * np.sin(2 * np.pi * 8 * t + rng.uniform(0, np.pi, N_CHANNELS)) + rng.normal(0, 20, (N_SAMPLES, N_CHANNELS))
+    lfp.astype(np.int16).tofile(tmp_path / 'continuous.dat')
+    np.save(tmp_path / 'timestamps.npy', np.arange(N_SAMPLES) / 2500)
+    return {
+        'name': 'probeA',
+        'lfp_input_file_path': tmp_path / 'continuous.dat',
+        'lfp_timestamps_input_path': tmp_path / 'timestamps.npy',
+        'lfp_sampling_rate': 2500.0,
+        'surface_channel': 40,
+        'reference_channels': [30],
+    }
+
+def get_outputs(probe:dict, tmp_path, name:str, **kwargs) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    paths = {key: tmp_path / f'{name}_{key}{suffix}' for key, suffix in
+             (('lfp_data_path', '.dat'), ('lfp_timestamps_path', '.npy'), ('lfp_channel_info_path', '.npy'))}
+    subsample_probe_lfp({**probe, **paths}, total_channels=N_CHANNELS, **kwargs)
+    channels = np.load(paths['lfp_channel_info_path'])
+    lfp = np.fromfile(paths['lfp_data_path'], dtype=np.int16).reshape(-1, len(channels))
+    return lfp, np.load(paths['lfp_timestamps_path']), channels
+
+def test_blockwise_subsampling_matches_one_block(probe, tmp_path):
+    lfp, timestamps, channels = get_outputs(probe, tmp_path, 'blocks', block_samples=5000)
+    whole_lfp, whole_timestamps, whole_channels = get_outputs(probe, tmp_path, 'whole', block_samples=N_SAMPLES)
+
+    np.testing.assert_array_equal(channels, select_channels(N_CHANNELS, 40, 40, 2, 4, np.array([30]), False))
+    np.testing.assert_array_equal(channels, whole_channels)
+    np.testing.assert_array_equal(timestamps, np.arange(N_SAMPLES)[::2] / 2500)
+    np.testing.assert_array_equal(timestamps, whole_timestamps)
+    assert lfp.shape == whole_lfp.shape == (N_SAMPLES // 2, len(channels))
+    assert np.abs(lfp.astype(int) - whole_lfp).max() <= 2
+
+def test_reference_channels_can_be_removed(probe, tmp_path):
+    _, _, channels = get_outputs(probe, tmp_path, 'removed', remove_reference_channels=True)
+    assert 30 not in channels
@@ -0,0 +1,25 @@
+import json
+from np_probes import profiling
+from np_probes.profiling import profile_session, profile_stage, enable_profiling, get_profile_records, write_profile_report
+
+def test_profile_records_do_not_accumulate(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, '_enabled', False)
+    monkeypatch.setattr(profiling, '_records', [])
+    monkeypatch.setattr(profiling, 'PROFILE_MAX_RECORDS', 3)
+
+    with profile_session('session', tmp_path / 'profile.json') as records:
+        with profile_stage('stage'):
+            pass
+    assert [record['stage'] for record in records] == ['stage', 'session']
+    assert len(json.loads((tmp_path / 'profile.json').read_text())) == 2
+    # dropped once the session is reported
+    assert get_profile_records() == []
+
+    enable_profiling()
+    for index in range(5):
+        with profile_stage('stage', index=index):
+            pass
+    enable_profiling(False)
+    assert [record['index'] for record in get_profile_records()] == [2, 3, 4]
+    write_profile_report(tmp_path / 'profile.csv')
+    assert get_profile_records() == []
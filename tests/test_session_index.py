@@ -0,0 +1,57 @@
+import pathlib
+import pytest
+from np_probes import session_index
+from np_probes.session_index import get_session_index, clear_session_indexes, match_file, walk_directories, first_match
+
+@pytest.fixture
+def build_calls(monkeypatch) -> list:
+    """Sessions indexed by walking their directories, from a clean in-memory cache."""
+    clear_session_indexes()
+    build = session_index.build_session_index
+    calls = []
+    monkeypatch.setattr(session_index, 'build_session_index', lambda session, *args: calls.append(session.id) or build(session, *args))
+    yield calls
+    clear_session_indexes()
+
+def test_session_index_paths_match_globs(synthetic_session, build_calls):
+    index = get_session_index(synthetic_session, use_cache=False)
+    paths = index['probes']['A']
+    assert paths['metrics_path'] == synthetic_session.probe_letter_to_metrics_csv_path['A']
+    globs = {
+        'states_path': (paths['state_event_path'], '*A-AP/*/states.npy'),
+        'event_timestamps_path': (paths['event_path'], '*/*/event_timestamps.npy'),
+        'lfp_continuous_path': (paths['continuous_path'], '*A-LFP/continuous.dat'),
+        'lfp_sample_numbers_path': (paths['continuous_path'], '*A-LFP/sample_numbers.npy'),
+    }
+    for key, (path, pattern) in globs.items():
+        assert paths[key] is not None and paths[key] == first_match(path, pattern)
+
+def test_session_index_is_cached_until_directories_change(synthetic_session, build_calls, monkeypatch):
+    index = get_session_index(synthetic_session, use_cache=False)
+    assert get_session_index(synthetic_session) is index
+
+    # from SDK_outputs/session_index.json, without walking the session again
+    clear_session_indexes()
+    assert get_session_index(synthetic_session) == index
+    assert len(build_calls) == 1
+
+    # a new directory changes the mtime of a walked directory
+    monkeypatch.setattr(session_index, 'SESSION_INDEX_RECHECK_INTERVAL', 0)
+    new_path = pathlib.Path(index['probes']['A']['continuous_path'], 'new')
+    new_path.mkdir()
+    try:
+        get_session_index(synthetic_session)
+        assert len(build_calls) == 2
+    finally:
+        new_path.rmdir()
+
+def test_match_file_escapes_walked_paths(tmp_path):
+    states_path = pathlib.Path(tmp_path, 'Record Node [1]', 'events', 'Probe-AP', 'TTL', 'states.npy')
+    states_path.parent.mkdir(parents=True)
+    states_path.touch()
+    directories = walk_directories(tmp_path, 4)
+    event_path = tmp_path / 'Record Node [1]' / 'events'
+    assert match_file(tmp_path, directories, 4, event_path, '*-AP/*/states.npy') == states_path
+    # deeper than walked: globbed instead
+    assert match_file(tmp_path, walk_directories(tmp_path, 2), 2, event_path, '*-AP/*/states.npy') == states_path
+    assert match_file(tmp_path, directories, 4, event_path, '*-LFP/*/states.npy') is None
@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+import pathlib
+import pytest
+from np_probes.staging import stage_file, pin_staged_files, evict_staged, STAGING_PIN_ENV, STAGING_DIR_ENV
+
+def write_sources(source_dir:pathlib.Path, n_files:int=3, size:int=8192) -> list[pathlib.Path]:
+    source_dir.mkdir()
+    paths = [source_dir / f'{index}.bin' for index in range(n_files)]
+    for index, path in enumerate(paths):
+        path.write_bytes(bytes([index]) * size)
+    return paths
+
+def test_pinned_files_are_not_evicted(tmp_path):
+    paths = write_sources(tmp_path / 'share')
+    staging_dir = tmp_path / 'staging'
+    with pin_staged_files(staging_dir):
+        staged = [stage_file(path, staging_dir, max_bytes=9000) for path in paths]
+        assert all(path.exists() for path in staged)
+        assert os.environ[STAGING_PIN_ENV]
+    assert STAGING_PIN_ENV not in os.environ
+
+    # unpinned, so evicted down to the size of the cache, least recently used first
+    evict_staged(staging_dir, 9000)
+    assert [path.exists() for path in staged] == [False, False, True]
+
+def test_files_pinned_by_another_process_are_not_evicted(tmp_path):
+    [path] = write_sources(tmp_path / 'share', n_files=1)
+    staging_dir = tmp_path / 'staging'
+    script = ('import sys; from np_probes.staging import stage_file, pin_staged_files\n'
+              'with pin_staged_files(sys.argv[1]):\n'
+              '    print(stage_file(sys.argv[2], sys.argv[1]), flush=True); sys.stdin.read()\n')
+    with subprocess.Popen([sys.executable, '-c', script, str(staging_dir), str(path)],
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True) as process:
+        staged = pathlib.Path(process.stdout.readline().strip())
+        evict_staged(staging_dir, 0)
+        assert staged.exists()
+        process.kill()
+
+    # the pins of processes that have ended, even without unpinning, no longer count
+    evict_staged(staging_dir, 0)
+    assert not staged.exists()
+
+def test_nwb_entry_points_pin_staged_files(tmp_path, monkeypatch):
+    probes_to_nwb = pytest.importorskip('np_probes.probes_to_nwb')
+    monkeypatch.setenv(STAGING_DIR_ENV, str(tmp_path / 'staging'))
+    pins = []
+    def session(*args, **kwargs):
+        pins.append(os.environ.get(STAGING_PIN_ENV))
+        raise RuntimeError('stop')
+    monkeypatch.setattr(probes_to_nwb.np_session, 'Session', session)
+    for entry_point in (probes_to_nwb.add_to_nwb, probes_to_nwb.append_to_nwb):
+        with pytest.raises(RuntimeError):
+            entry_point(tmp_path, tmp_path / 'session.nwb')
+        assert STAGING_PIN_ENV not in os.environ
+    assert len(pins) == 2 and all(pins)
@@ -0,0 +1,37 @@
+import pathlib
+import numpy as np
+from np_probes.sync import extract_line_edges, get_sync_line_edges, read_sync_meta, get_sync_line_bit
+from np_probes.benchmark import SYNC_SAMPLE_FREQUENCY
+
+def get_sync_path(session) -> pathlib.Path:
+    return pathlib.Path(session.npexp_path, f'{session.id}.h5')
+
+def get_edges_in_one_read(sync_path:pathlib.Path, bit:int) -> tuple[np.ndarray, np.ndarray]:
+    import h5py
+
+    with h5py.File(sync_path, 'r') as f:
+        data = f['data'][()]
+    changes = np.diff(((data[:, -1] >> bit) & 1).astype(np.int8))
+    times = data[1:, 0].astype(np.int64)
+    return times[changes == 1], times[changes == -1]
+
+def test_chunked_edges_match_one_read(synthetic_session):
+    sync_path = get_sync_path(synthetic_session)
+    bit = get_sync_line_bit(read_sync_meta(sync_path)['line_labels'], 'barcode')
+    rising, falling = get_edges_in_one_read(sync_path, bit)
+    assert len(rising) and len(falling)
+    for chunk_size in (7, 1000, 10**6):
+        chunk_rising, chunk_falling = extract_line_edges(sync_path, [bit], chunk_size=chunk_size)[bit]
+        np.testing.assert_array_equal(chunk_rising, rising)
+        np.testing.assert_array_equal(chunk_falling, falling)
+
+def test_cached_edges_match(synthetic_session, tmp_path):
+    sync_path = get_sync_path(synthetic_session)
+    cache_path = tmp_path / 'sync_edges.npz'
+    edges, sample_frequency = get_sync_line_edges(sync_path, ['barcode'], cache_path)
+    assert cache_path.exists()
+    assert sample_frequency == SYNC_SAMPLE_FREQUENCY
+
+    cached_edges, _ = get_sync_line_edges(sync_path, ['barcode'], cache_path)
+    for array, cached_array in zip(edges['barcode'], cached_edges['barcode']):
+        np.testing.assert_array_equal(array, cached_array)
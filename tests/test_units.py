@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pynwb')
+pytest.importorskip('np_session')
+from np_probes.probes_to_nwb import get_ragged_spike_data, get_peak_channel_waveforms, get_template_amplitudes
+from np_probes.probes_to_nwb import SPIKE_AMPLITUDE_SCALE_FACTOR
+
+@pytest.fixture
+def probe(sorted_path) -> dict:
+    """Spike files of the session's probe, with every other cluster as a unit, in reverse order."""
+    n_clusters = len(np.load(sorted_path / 'templates.npy', mmap_mode='r'))
+    cluster_ids = np.arange(n_clusters)[::-2]
+    n_channels = np.load(sorted_path / 'mean_waveforms.npy', mmap_mode='r').shape[1]
+    return {
+        'spike_clusters_file': sorted_path / 'spike_clusters.npy',
+        'spike_times_path': sorted_path / 'spike_times.npy',
+        'spike_amplitudes_path': sorted_path / 'amplitudes.npy',
+        'spike_templates_path': sorted_path / 'spike_templates.npy',
+        'templates_path': sorted_path / 'templates.npy',
+        'inverse_whitening_matrix_path': sorted_path / 'whitening_mat_inv.npy',
+        'mean_waveforms_path': sorted_path / 'mean_waveforms.npy',
+        'units': pd.DataFrame({'cluster_id': cluster_ids, 'id': cluster_ids + 100,
+                               # the first unit on the first channel, to check traces past the end of the probe
+                               'peak_channel_id': np.r_[0, cluster_ids[1:] % n_channels]}),
+        'channels': pd.DataFrame({'id': np.arange(n_channels), 'probe_channel_number': np.arange(n_channels)}),
+    }
+
+def test_ragged_spike_data_matches_per_unit_selection(probe, tmp_path):
+    spike_clusters = np.load(probe['spike_clusters_file']).ravel()
+    spike_times = np.load(probe['spike_times_path']).ravel()
+    amplitudes = (get_template_amplitudes(probe)[np.load(probe['spike_templates_path']).ravel()]
+                  * np.load(probe['spike_amplitudes_path']).ravel() * SPIKE_AMPLITUDE_SCALE_FACTOR)
+    expected_times, expected_amplitudes = [], []
+    for cluster_id in probe['units']['cluster_id']:
+        spikes = np.flatnonzero(spike_clusters == cluster_id)
+        spikes = spikes[np.argsort(spike_times[spikes], kind='stable')]
+        expected_times.append(spike_times[spikes])
+        expected_amplitudes.append(amplitudes[spikes])
+
+    unit_ids = pd.Index(probe['units']['id'])
+    for chunk_size, output_dir in ((10**7, None), (100, tmp_path)):
+        index, times, spike_amplitudes = get_ragged_spike_data(unit_ids, [probe], output_dir=output_dir, chunk_size=chunk_size)
+        np.testing.assert_array_equal(index, np.cumsum([len(unit_times) for unit_times in expected_times]))
+        np.testing.assert_array_equal(times, np.concatenate(expected_times))
+        np.testing.assert_allclose(spike_amplitudes, np.concatenate(expected_amplitudes), rtol=1e-6)
+
+def test_peak_channel_waveforms(probe):
+    mean_waveforms = np.load(probe['mean_waveforms_path'])
+    unit_ids = pd.Index(probe['units']['id'])
+    index, waveforms = get_peak_channel_waveforms(unit_ids, [probe], neighborhood=1)
+    np.testing.assert_array_equal(index, np.arange(1, len(unit_ids) + 1) * 3)
+
+    waveforms = waveforms.reshape(len(unit_ids), 3, -1)
+    for unit_waveforms, cluster_id, peak_channel in zip(waveforms, probe['units']['cluster_id'], probe['units']['peak_channel_id']):
+        for offset, trace in zip((-1, 0, 1), unit_waveforms):
+            channel = peak_channel + offset
+            if 0 <= channel < mean_waveforms.shape[1]:
+                np.testing.assert_array_equal(trace, mean_waveforms[cluster_id, channel])
+            else:
+                assert np.isnan(trace).all()
+
+def test_peak_channel_waveforms_with_unknown_peak_channel(probe):
+    units = probe['units'].copy()
+    units.loc[1, 'peak_channel_id'] = len(probe['channels'])
+    with pytest.raises(ValueError, match='not in its channels'):
+        get_peak_channel_waveforms(pd.Index(units['id']), [{**probe, 'units': units}])
+
+@pytest.mark.parametrize('waveform_neighborhood', [None, 0])
+def test_empty_units_table(probe, tmp_path, waveform_neighborhood):
+    import datetime
+    import types
+    from np_probes.probes_to_nwb import add_ragged_spike_data_to_units, get_units_from_dataframe
+    from np_probes.utils import init_nwb, save_nwb, load_nwb
+
+    nwb_file = init_nwb(types.SimpleNamespace(start=datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)))
+    nwb_file.units = get_units_from_dataframe(pd.DataFrame({'unit_id': pd.Series([], dtype=int),
+                                                            'location': pd.Series([], dtype=object)}))
+    add_ragged_spike_data_to_units(nwb_file.units, [{**probe, 'units': probe['units'].iloc[:0]}],
+                                   data_io_options={'spike_times': {'compression': 'gzip'}, 'spike_amplitudes': {}},
+                                   output_dir=tmp_path, waveform_neighborhood=waveform_neighborhood)
+    units = load_nwb(save_nwb(nwb_file, tmp_path / 'units.nwb')).units
+    assert len(units) == 0
+    assert len(units['spike_times'].target.data) == 0
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_units_nwb_has_the_selected_units(synthetic_session, sorted_path, tmp_path, monkeypatch, columnar):
+    pytest.importorskip('allensdk')
+    from np_probes import probes_to_nwb
+    from np_probes.utils import open_nwb
+
+    monkeypatch.setattr(probes_to_nwb.np_session, 'Session', lambda *args, **kwargs: synthetic_session)
+    nwb_path = tmp_path / 'units.nwb'
+    probes_to_nwb.add_to_nwb(synthetic_session.npexp_path, output_file=nwb_path, with_lfp=False, columnar=columnar,
+                             units_query="quality == 'good'", units_data_io_options={'spike_times': {}})
+
+    metrics = pd.read_csv(sorted_path / 'metrics.csv')
+    good = metrics.query("quality == 'good'")
+    spike_clusters = np.load(sorted_path / 'spike_clusters.npy').ravel()
+    # negative aligned times are dropped, as by AllenSDK
+    spike_clusters = spike_clusters[np.load(synthetic_session.npexp_path / 'SDK_outputs' / 'spike_times_A_aligned.npy').ravel() >= 0]
+    with open_nwb(nwb_path) as nwb_file:
+        units = nwb_file.units.to_dataframe()
+    assert 0 < len(units) < len(metrics)
+    assert sorted(units['cluster_id']) == sorted(good['cluster_id'])
+    for cluster_id, spike_times in zip(units['cluster_id'], units['spike_times']):
+        assert len(spike_times) == np.sum(spike_clusters == cluster_id)
+        assert np.all(np.diff(spike_times) >= 0)
+    if columnar:
+        np.testing.assert_array_equal(units.index, np.arange(len(units)))
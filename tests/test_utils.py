@@ -0,0 +1,34 @@
+import datetime
+import types
+import numpy as np
+import pytest
+
+pynwb = pytest.importorskip('pynwb')
+h5py = pytest.importorskip('h5py')
+from np_probes.utils import init_nwb, save_nwb, load_nwb, open_nwb
+
+@pytest.fixture
+def nwb_path(tmp_path):
+    """An NWB file with two processing modules of one time series each."""
+    nwb_file = init_nwb(types.SimpleNamespace(start=datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)))
+    for name in ('ecephys', 'behavior'):
+        module = nwb_file.create_processing_module(name=name, description=name)
+        module.add(pynwb.TimeSeries(name=f'{name}_series', data=np.arange(100.0), unit='V', rate=10.0))
+    return save_nwb(nwb_file, tmp_path / 'session.nwb')
+
+def test_open_nwb_reads_datasets_lazily(nwb_path):
+    with open_nwb(nwb_path, rdcc_nbytes=1024**2) as nwb_file:
+        data = nwb_file.processing['ecephys']['ecephys_series'].data
+        assert isinstance(data, h5py.Dataset)
+        np.testing.assert_array_equal(data[10:20], np.arange(10.0, 20.0))
+    # closed once the block exits
+    assert not data
+
+def test_open_nwb_keeps_selected_processing_modules(nwb_path):
+    with open_nwb(nwb_path, processing_modules=['behavior']) as nwb_file:
+        assert list(nwb_file.processing) == ['behavior']
+        np.testing.assert_array_equal(nwb_file.processing['behavior']['behavior_series'].data[:], np.arange(100.0))
+    with pytest.raises(KeyError, match='No processing module lfp'):
+        with open_nwb(nwb_path, processing_modules=['behavior', 'lfp']):
+            pass
+    assert set(load_nwb(nwb_path).processing) == {'ecephys', 'behavior'}
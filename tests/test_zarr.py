@@ -0,0 +1,63 @@
+import pickle
+import datetime
+import types
+import numpy as np
+import pytest
+
+pytest.importorskip('hdmf_zarr')
+import pynwb
+from np_probes.data_io import ArrayChunkIterator, get_data_io
+from np_probes.utils import init_nwb, save_nwb, load_nwb, open_nwb, is_zarr_nwb
+
+@pytest.fixture
+def lfp_memmap(tmp_path) -> np.memmap:
+    data = np.lib.format.open_memmap(tmp_path / 'lfp.npy', mode='w+', dtype=np.int16, shape=(10_000, 16))
+    data[:] = np.random.default_rng(0).integers(-1000, 1000, data.shape)
+    data.flush()
+    return np.load(tmp_path / 'lfp.npy', mmap_mode='r')
+
+def get_nwb_file(data) -> pynwb.NWBFile:
+    nwb_file = init_nwb(types.SimpleNamespace(start=datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)))
+    nwb_file.add_acquisition(pynwb.TimeSeries(name='lfp', data=data, unit='V', rate=2500.0))
+    return nwb_file
+
+def test_chunk_iterator_pickles_memmap_as_file(lfp_memmap):
+    iterator = ArrayChunkIterator(lfp_memmap, scale=0.5, dtype=np.float32, chunk_shape=(1000, 16), buffer_shape=(3000, 16))
+    payload = pickle.dumps(iterator)
+    assert len(payload) < lfp_memmap.nbytes
+    copy = pickle.loads(payload)
+    for chunk, copied_chunk in zip(iterator, copy):
+        assert chunk.selection == copied_chunk.selection
+        np.testing.assert_array_equal(chunk.data, copied_chunk.data)
+
+@pytest.mark.parametrize('number_of_jobs', [1, 2])
+def test_save_load_open_zarr(lfp_memmap, tmp_path, number_of_jobs):
+    data = get_data_io(lfp_memmap, chunk_shape=(1000,), buffer_gb=1e-5, scale=0.5, dtype=np.float32,
+                       compression='gzip', backend='zarr')
+    nwb_path = save_nwb(get_nwb_file(data), tmp_path / 'session.nwb.zarr', backend='zarr', number_of_jobs=number_of_jobs)
+    assert is_zarr_nwb(nwb_path)
+
+    expected = lfp_memmap.astype(np.float32) * np.float32(0.5)
+    np.testing.assert_array_equal(load_nwb(nwb_path).acquisition['lfp'].data[:], expected)
+    with open_nwb(nwb_path) as nwb_file:
+        np.testing.assert_array_equal(nwb_file.acquisition['lfp'].data[100:200, 3], expected[100:200, 3])
+
+def test_append_to_zarr(synthetic_session, tmp_path, monkeypatch):
+    pytest.importorskip('allensdk')
+    from np_probes import probes_to_nwb
+
+    monkeypatch.setattr(probes_to_nwb.np_session, 'Session', lambda *args, **kwargs: synthetic_session)
+    nwb_path = save_nwb(get_nwb_file(np.arange(100.0)), tmp_path / 'session.nwb.zarr', backend='zarr')
+    units_data_io_options = {'spike_times': {'chunk_shape': (500,)}}
+    probes_to_nwb.append_to_nwb(synthetic_session.npexp_path, nwb_path, with_lfp=False, columnar=True,
+                                units_data_io_options=units_data_io_options)
+    with pytest.raises(ValueError, match='already in the file'):
+        probes_to_nwb.append_to_nwb(synthetic_session.npexp_path, nwb_path, with_lfp=False, columnar=True)
+
+    probe_tables, _ = probes_to_nwb.generate_probe_tables(synthetic_session)
+    with open_nwb(nwb_path) as nwb_file:
+        np.testing.assert_array_equal(nwb_file.acquisition['lfp'].data[:], np.arange(100.0))
+        assert sorted(nwb_file.devices) == ['probeA']
+        assert len(nwb_file.electrodes) == len(probe_tables['channels'])
+        assert len(nwb_file.units) == len(probes_to_nwb.get_units_electrodes_table(probe_tables))
+        assert len(nwb_file.units['spike_times'].target.data) > 0